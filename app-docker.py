@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 import xml.etree.ElementTree as ET
 import threading
 from threading import Thread
+from collections import deque
 import logging
 
 # Fast JSON library (10x faster than standard json)
@@ -291,6 +292,13 @@ import secrets
 import waitress
 import sqlite3
 import atexit
+import asyncio
+import heapq
+import re
+import sys
+from urllib.parse import unquote
+from werkzeug.wsgi import FileWrapper
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as futures_wait
 from utils import (
     validate_mac_address,
     validate_url,
@@ -300,7 +308,8 @@ from utils import (
     is_hls_url,
     validate_proxy_url,
     get_proxy_type,
-    parse_proxy_url
+    parse_proxy_url,
+    shadowsocks_tunnels
 )
 
 app = Flask(__name__)
@@ -341,7 +350,6 @@ logger.info(f"Using database file: {dbPath}")
 vodsDbPath = os.path.join(log_dir, "vods.db")
 logger.info(f"Using VOD database file: {vodsDbPath}")
 
-occupied = {}
 config = {}
 cached_lineup = []
 cached_playlist = None
@@ -349,43 +357,194 @@ last_playlist_host = None
 cached_xmltv = None  # Deprecated - XMLTV now served from file for memory efficiency
 last_updated = 0
 hls_manager = None
+hls_ingest_port = 8001  # Port ffmpeg PUTs in-memory HLS output to (waitress)
 
 
-def cleanup_occupied_streams():
-    """Automatically clean up old/expired streams from occupied dictionary to prevent memory leaks."""
-    global occupied
-    current_time = time.time()
-    max_age = 7200  # 2 hours (conservative to avoid killing long-running streams)
+class OccupancyHandle:
+    """One occupied MAC slot; release() is idempotent."""
     
-    try:
-        cleaned_count = 0
-        for portal_id in list(occupied.keys()):
-            if portal_id not in occupied:
-                continue
-                
-            streams = occupied[portal_id]
-            # Keep only streams younger than max_age
-            active_streams = [
-                s for s in streams 
-                if current_time - s.get("start time", 0) < max_age
-            ]
-            
-            cleaned_count += len(streams) - len(active_streams)
-            
-            if active_streams:
-                occupied[portal_id] = active_streams
+    __slots__ = ("registry", "portal_id", "mac", "info", "released")
+    
+    def __init__(self, registry, portal_id, mac, info):
+        self.registry = registry
+        self.portal_id = portal_id
+        self.mac = mac
+        self.info = info
+        self.released = False
+    
+    def release(self):
+        return self.registry.release(self)
+
+
+class OccupancyRegistry:
+    """Lock-protected registry of upstream streams per portal MAC.
+    
+    /play, XC, HLS and VOD acquire one handle per upstream connection and
+    release it when that stream ends (broadcast exit, response close, HLS
+    stop), so nothing has to be swept up later. Per-MAC counters make the
+    "streams per mac" check O(1); the dashboard reads snapshot().
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}   # (portal_id, mac) -> active streams
+        self.handles = {}  # portal_id -> set of OccupancyHandle
+        self.listeners = []  # Called with portal_id after every release
+    
+    def acquire(self, portal_id, mac, info, limit=0):
+        """Occupy a slot on mac. With limit > 0 only if one is free, else None."""
+        key = (portal_id, mac)
+        with self.lock:
+            count = self.counts.get(key, 0)
+            if limit and count >= limit:
+                return None
+            self.counts[key] = count + 1
+            handle = OccupancyHandle(self, portal_id, mac, info)
+            self.handles.setdefault(portal_id, set()).add(handle)
+        logger.info("Occupied Portal({}):MAC({}):User({})".format(portal_id, mac, info.get("xc_user") or "Direct"))
+        return handle
+    
+    def release(self, handle):
+        key = (handle.portal_id, handle.mac)
+        with self.lock:
+            if handle.released:
+                return False
+            handle.released = True
+            count = self.counts.get(key, 0) - 1
+            if count > 0:
+                self.counts[key] = count
             else:
-                # Remove empty portal entries
-                del occupied[portal_id]
-        
-        if cleaned_count > 0:
-            logger.info(f"Cleaned up {cleaned_count} expired stream(s) from occupied dictionary (older than 2 hours)")
-        
-    except Exception as e:
-        logger.error(f"Error during occupied streams cleanup: {e}")
+                self.counts.pop(key, None)
+            handles = self.handles.get(handle.portal_id)
+            if handles is not None:
+                handles.discard(handle)
+                if not handles:
+                    del self.handles[handle.portal_id]
+        logger.info("Unoccupied Portal({}):MAC({}):User({})".format(handle.portal_id, handle.mac, handle.info.get("xc_user") or "Direct"))
+        for listener in self.listeners:
+            listener(handle.portal_id)
+        return True
+    
+    def release_on_close(self, response, handle):
+        """Free the slot when the server closes the response body (iterated or not)."""
+        response.call_on_close(handle.release)
+        return response
+    
+    def count(self, portal_id, mac):
+        return self.counts.get((portal_id, mac), 0)
+    
+    def is_free(self, portal_id, mac, limit):
+        return not limit or self.count(portal_id, mac) < limit
+    
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
+    
+    def snapshot(self):
+        """{portal_id: [stream info, ...]} for the dashboard."""
+        with self.lock:
+            return {
+                portal_id: [
+                    dict(handle.info, mac=handle.mac)
+                    for handle in sorted(handles, key=lambda handle: handle.info.get("start time", 0))
+                ]
+                for portal_id, handles in self.handles.items()
+            }
+
+
+occupancy = OccupancyRegistry()
+
+
+class MacSlotScheduler:
+    """Wait queue for requests that find every MAC of a portal at its limit.
+    
+    Waiters are ordered by XC user priority, then arrival. Only the head of a
+    portal's queue may take a freed slot, and it occupies the slot in the
+    registry before leaving the queue, so a newcomer never sees it free.
+    Releases in the occupancy registry wake the queue.
+    """
+    
+    WAIT_BUCKETS = (0.5, 1, 2, 5, 10, 30)
     
-    # Schedule next cleanup in 5 minutes
-    threading.Timer(300, cleanup_occupied_streams).start()
+    def __init__(self, registry):
+        self.registry = registry
+        self.cond = threading.Condition()
+        self.queues = {}   # portal_id -> heap of (-priority, seq)
+        self.seq = 0
+        self.stats = {"queued": 0, "served": 0, "timeouts": 0, "max_depth": 0, "wait_seconds": 0.0}
+        self.histogram = {f"<={bucket}s": 0 for bucket in self.WAIT_BUCKETS}
+        self.histogram[f">{self.WAIT_BUCKETS[-1]}s"] = 0
+        registry.listeners.append(self._released)
+    
+    def _released(self, portal_id):
+        with self.cond:
+            self.cond.notify_all()
+    
+    def _acquire(self, portal_id, macs, limit, info):
+        for mac in macs:
+            handle = self.registry.acquire(portal_id, mac, dict(info, mac=mac), limit)
+            if handle:
+                return handle
+        return None
+    
+    def depth(self, portal_id):
+        return len(self.queues.get(portal_id, ()))
+    
+    def wait(self, portal_id, macs, limit, timeout, priority=0, info=None):
+        """Block up to timeout for a free slot on one of macs.
+        
+        Returns the OccupancyHandle of the slot taken for the caller (who must
+        release it), or None on timeout.
+        """
+        start = time.time()
+        with self.cond:
+            self.seq += 1
+            entry = (-priority, self.seq)
+            queue = self.queues.setdefault(portal_id, [])
+            heapq.heappush(queue, entry)
+            self.stats["queued"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(queue))
+            handle = None
+            try:
+                while True:
+                    if queue[0] == entry:
+                        handle = self._acquire(portal_id, macs, limit, info or {})
+                        if handle:
+                            break
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            finally:
+                queue.remove(entry)
+                heapq.heapify(queue)
+                if not queue and self.queues.get(portal_id) is queue:
+                    del self.queues[portal_id]
+                self.cond.notify_all()  # Next in line re-checks
+            
+            waited = time.time() - start
+            self.stats["served" if handle else "timeouts"] += 1
+            self.stats["wait_seconds"] += waited
+            bucket = next((f"<={bucket}s" for bucket in self.WAIT_BUCKETS if waited <= bucket), f">{self.WAIT_BUCKETS[-1]}s")
+            self.histogram[bucket] += 1
+        
+        logger.info(f"Slot queue Portal({portal_id}): {'served' if handle else 'timed out'} after {waited:.1f}s")
+        return handle
+    
+    def get_stats(self):
+        with self.cond:
+            finished = self.stats["served"] + self.stats["timeouts"]
+            return dict(
+                self.stats,
+                wait_seconds=round(self.stats["wait_seconds"], 2),
+                avg_wait_seconds=round(self.stats["wait_seconds"] / finished, 2) if finished else 0,
+                depth={portal_id: len(queue) for portal_id, queue in self.queues.items()},
+                wait_histogram=dict(self.histogram),
+            )
+
+
+slot_scheduler = MacSlotScheduler(occupancy)
+mac_race_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="mac-race")  # stream_channel MAC races
 
 
 # Channel Cache für Performance-Optimierung
@@ -419,7 +578,7 @@ class ChannelCache_OLD:
             # Cache miss - lade neu
             logger.info(f"Cache MISS für {cache_key} - loading from portal...")
             try:
-                channels = stb.getAllChannels(url, mac, token, proxy)
+                channels = stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
                 if channels:
                     self.cache[cache_key] = (channels, time.time())
                     cache_type = "unlimited" if self.cache_duration is None else f"{self.cache_duration}s"
@@ -478,6 +637,226 @@ class ChannelCache_OLD:
             }
 
 
+# ============================================
+# Compact Channel Catalog (shared across MACs)
+# ============================================
+
+CATALOG_FIELDS = ("id", "name", "number", "tv_genre_id", "logo", "cmd")
+
+
+class CatalogChannel:
+    """Compact channel record holding only the fields the app uses.
+    
+    Supports channel["cmd"] / channel.get("logo") like the raw portal dicts.
+    """
+    __slots__ = CATALOG_FIELDS
+    
+    def __init__(self, channel_id, raw):
+        self.id = channel_id
+        self.name = raw.get("name", "")
+        self.number = raw.get("number", "")
+        self.tv_genre_id = raw.get("tv_genre_id", "")
+        self.logo = raw.get("logo", "")
+        self.cmd = raw.get("cmd", "")
+    
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+    
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in CATALOG_FIELDS else default
+    
+    def copy_with_cmd(self, cmd):
+        record = CatalogChannel.__new__(CatalogChannel)
+        for field in CATALOG_FIELDS:
+            setattr(record, field, getattr(self, field))
+        record.cmd = cmd
+        return record
+    
+    def to_dict(self):
+        return {field: getattr(self, field) for field in CATALOG_FIELDS}
+
+
+class PortalCatalog:
+    """Per-portal channel catalog: each channel stored once, per-MAC availability as bitsets.
+    
+    records[pos] holds the channel, mac_bits[mac] has bit pos set if the MAC
+    offers it. A MAC whose cmd differs from the shared record (e.g. tokenized
+    direct links) keeps only that cmd in mac_cmds.
+    """
+    
+    COMPACT_MIN_RECORDS = 1000
+    
+    def __init__(self):
+        self.records = []
+        self.positions = {}  # channel_id -> pos
+        self.mac_bits = {}  # mac -> int bitset over positions
+        self.mac_cmds = {}  # mac -> {channel_id: cmd}
+        self.lock = threading.Lock()
+    
+    def set_mac(self, mac, channels):
+        """Merge a MAC's channel list into the catalog and return its view."""
+        with self.lock:
+            mac_positions = []
+            overrides = {}
+            for raw in channels:
+                channel_id = str(raw["id"])
+                pos = self.positions.get(channel_id)
+                if pos is None:
+                    pos = len(self.records)
+                    self.positions[channel_id] = pos
+                    self.records.append(CatalogChannel(channel_id, raw))
+                else:
+                    # Metadata: latest wins; cmd may be MAC-specific
+                    record = self.records[pos]
+                    record.name = raw.get("name", record.name)
+                    record.number = raw.get("number", record.number)
+                    record.tv_genre_id = raw.get("tv_genre_id", record.tv_genre_id)
+                    record.logo = raw.get("logo", record.logo)
+                    cmd = raw.get("cmd", record.cmd)
+                    if cmd != record.cmd:
+                        overrides[channel_id] = cmd
+                mac_positions.append(pos)
+            
+            self.mac_bits[mac] = self._to_bits(mac_positions, len(self.records))
+            if overrides:
+                self.mac_cmds[mac] = overrides
+            else:
+                self.mac_cmds.pop(mac, None)
+            self._maybe_compact()
+        return CatalogView(self, mac)
+    
+    def remove_mac(self, mac):
+        with self.lock:
+            self.mac_bits.pop(mac, None)
+            self.mac_cmds.pop(mac, None)
+            if not self.mac_bits:
+                self.records = []
+                self.positions = {}
+            else:
+                self._maybe_compact()
+    
+    @staticmethod
+    def _to_bits(positions, size):
+        bits = bytearray((size + 7) // 8)
+        for pos in positions:
+            bits[pos >> 3] |= 1 << (pos & 7)
+        return int.from_bytes(bits, "little")
+    
+    @staticmethod
+    def _iter_positions(bits):
+        # bin() is O(n); testing bit by bit with shifts would be O(n^2)
+        for pos, bit in enumerate(bin(bits)[:1:-1]):
+            if bit == "1":
+                yield pos
+    
+    def _maybe_compact(self):
+        """Drop records no MAC offers anymore once they make up half the catalog."""
+        live = 0
+        for bits in self.mac_bits.values():
+            live |= bits
+        live_count = live.bit_count()
+        if len(self.records) < self.COMPACT_MIN_RECORDS or live_count * 2 > len(self.records):
+            return
+        
+        remap = {}
+        records = []
+        for pos in self._iter_positions(live):
+            remap[pos] = len(records)
+            records.append(self.records[pos])
+        self.records = records
+        self.positions = {record.id: pos for pos, record in enumerate(records)}
+        self.mac_bits = {
+            mac: self._to_bits([remap[pos] for pos in self._iter_positions(bits)], len(records))
+            for mac, bits in self.mac_bits.items()
+        }
+    
+    def lookup(self, mac, channel_id):
+        with self.lock:
+            pos = self.positions.get(channel_id)
+            if pos is None or not (self.mac_bits.get(mac, 0) >> pos) & 1:
+                return None
+            record = self.records[pos]
+            cmd = self.mac_cmds.get(mac, {}).get(channel_id)
+        return record.copy_with_cmd(cmd) if cmd is not None else record
+    
+    def mac_channels(self, mac):
+        with self.lock:
+            bits = self.mac_bits.get(mac, 0)
+            records = self.records
+            overrides = self.mac_cmds.get(mac, {})
+        channels = [records[pos] for pos in self._iter_positions(bits)]
+        if overrides:
+            channels = [
+                record.copy_with_cmd(overrides[record.id]) if record.id in overrides else record
+                for record in channels
+            ]
+        return channels
+    
+    def mac_count(self, mac):
+        return self.mac_bits.get(mac, 0).bit_count()
+    
+    def memory_bytes(self):
+        """Approximate RAM used by the catalog (records, strings, index, bitsets)."""
+        import sys
+        with self.lock:
+            size = sys.getsizeof(self.records) + sys.getsizeof(self.positions)
+            seen = set()
+            for record in self.records:
+                size += sys.getsizeof(record)
+                for field in CATALOG_FIELDS:
+                    value = getattr(record, field)
+                    if id(value) not in seen:
+                        seen.add(id(value))
+                        size += sys.getsizeof(value)
+            size += sum(sys.getsizeof(bits) for bits in self.mac_bits.values())
+            size += sum(sys.getsizeof(cmds) for cmds in self.mac_cmds.values())
+        return size
+    
+    def stats(self):
+        return {
+            "channels": len(self.records),
+            "macs": len(self.mac_bits),
+            "bytes": self.memory_bytes(),
+        }
+
+
+class CatalogView:
+    """One MAC's view of a PortalCatalog: id -> channel lookups and iteration."""
+    __slots__ = ("catalog", "mac")
+    
+    def __init__(self, catalog, mac):
+        self.catalog = catalog
+        self.mac = mac
+    
+    def get(self, channel_id, default=None):
+        channel = self.catalog.lookup(self.mac, str(channel_id))
+        return default if channel is None else channel
+    
+    def __contains__(self, channel_id):
+        return self.catalog.lookup(self.mac, str(channel_id)) is not None
+    
+    def __getitem__(self, channel_id):
+        channel = self.catalog.lookup(self.mac, str(channel_id))
+        if channel is None:
+            raise KeyError(channel_id)
+        return channel
+    
+    def __iter__(self):
+        return iter(self.catalog.mac_channels(self.mac))
+    
+    def __len__(self):
+        return self.catalog.mac_count(self.mac)
+    
+    def __bool__(self):
+        return len(self) > 0
+    
+    def release(self):
+        self.catalog.remove_mac(self.mac)
+
+
 # ============================================
 # NEW: Advanced Channel Cache with 4 Modes
 # ============================================
@@ -489,19 +868,51 @@ class ChannelCache:
     - ram: Pre-cache all MACs at portal setup, RAM only
     - disk: Pre-cache all MACs at portal setup, Disk only (persistent)
     - hybrid: Pre-cache all MACs at portal setup, RAM + Disk (fast + persistent)
+    
+    Channels live once per portal in a PortalCatalog; ram_cache and
+    channel_index hold per-MAC CatalogViews onto it.
+    
+    Policies:
+    - strict: expired entries are reloaded inline on the next request
+    - swr: stale-while-revalidate - expired entries keep being served while a
+      background worker refreshes them (limited per portal by refresh_budget)
     """
     
-    def __init__(self, mode="lazy-ram", cache_duration=None):
+    SWR_DEFAULT_AGE = 86400  # Soft TTL for swr when cache duration is unlimited
+    SWR_BUDGET_WINDOW = 3600
+    
+    def __init__(self, mode="lazy-ram", cache_duration=None, policy="strict", refresh_budget=10):
         self.mode = mode
         self.cache_duration = cache_duration
+        self.policy = policy
+        self.refresh_budget = refresh_budget  # Background refreshes per portal per hour
         self.lock = threading.RLock()
         
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "background_refreshes": 0,
+            "refreshes_over_budget": 0,
+        }
+        self.refresh_log = {}  # portal_id -> [refresh timestamps within budget window]
+        self.refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="swr")
+        
         # RAM Cache (for lazy-ram, ram, hybrid)
         if mode in ["lazy-ram", "ram", "hybrid"]:
             self.ram_cache = {}
         else:
             self.ram_cache = None
         
+        # Shared per-portal catalogs: {portal_id: PortalCatalog}
+        self.catalogs = {}
+        
+        # id -> channel index per cache_key: {cache_key: (CatalogView, timestamp)}
+        self.channel_index = {}
+        
+        # In-flight API fetches per cache_key (single-flight)
+        self.inflight = {}
+        
         # DB Init (for disk, hybrid)
         if mode in ["disk", "hybrid"]:
             self._init_db()
@@ -529,170 +940,248 @@ class ChannelCache:
             logger.error(f"Error initializing cache database: {e}")
     
     def get_channels(self, portal_id, mac, url, token, proxy=None):
-        """Get channels from cache or API - mode-dependent."""
+        """Get channels from cache or API - mode-dependent.
+        
+        Cache reads never wait on network I/O: the lock is only held for dict
+        access. Concurrent misses for the same (portal, MAC) are coalesced into
+        one API fetch (single-flight); different keys load in parallel.
+        """
         cache_key = f"{portal_id}_{mac}"
         
+        try:
+            entry = self._lookup(portal_id, mac)
+            if entry is not None:
+                channels, timestamp = entry
+                if self._is_fresh(timestamp):
+                    self.stats["hits"] += 1
+                    logger.debug(f"[{self.mode.upper()}] Cache HIT: {cache_key}")
+                    return channels
+                if self.policy == "swr":
+                    # Serve stale, refresh in background
+                    self.stats["stale_hits"] += 1
+                    logger.debug(f"[{self.mode.upper()}] Cache STALE HIT: {cache_key}")
+                    self._schedule_refresh(portal_id, cache_key, url, mac, token, proxy)
+                    return channels
+        except Exception as e:
+            logger.error(f"Cache error ({self.mode} mode): {e}")
+        
+        # Single-flight: first miss fetches, the others wait for its result
         with self.lock:
+            flight = self.inflight.get(cache_key)
+            is_leader = flight is None
+            if is_leader:
+                flight = {"event": threading.Event(), "channels": None}
+                self.inflight[cache_key] = flight
+        
+        if not is_leader:
+            logger.debug(f"[{self.mode.upper()}] Waiting for in-flight fetch: {cache_key}")
+            if flight["event"].wait(timeout=60):
+                return flight["channels"]
+            logger.warning(f"[{self.mode.upper()}] In-flight fetch timed out: {cache_key}")
+            return self._load_from_api(url, mac, token, proxy)
+        
+        try:
+            channels = None
             try:
-                # Route based on mode
-                if self.mode == "lazy-ram":
-                    return self._get_lazy_ram(cache_key, url, mac, token, proxy)
-                elif self.mode == "ram":
-                    return self._get_ram_only(cache_key, url, mac, token, proxy)
-                elif self.mode == "disk":
-                    return self._get_disk_only(cache_key, url, mac, token, proxy)
-                elif self.mode == "hybrid":
-                    return self._get_hybrid(cache_key, url, mac, token, proxy)
+                # Re-check: a previous fetch may have finished right before we became leader
+                entry = self._lookup(portal_id, mac)
+                if entry is not None and self._is_fresh(entry[1]):
+                    channels = entry[0]
+                else:
+                    self.stats["misses"] += 1
+                    logger.info(f"[{self.mode.upper()}] Cache MISS: {cache_key}")
+                    channels = self._load_from_api(url, mac, token, proxy)
+                    if channels:
+                        channels = self._store(portal_id, mac, channels, time.time())
+                        logger.info(f"[{self.mode.upper()}] Cached {len(channels)} channels for {cache_key}")
             except Exception as e:
                 logger.error(f"Cache error ({self.mode} mode): {e}")
                 # Fallback: Load directly from API
-                return self._load_from_api(url, mac, token, proxy)
-    
-    def _get_lazy_ram(self, cache_key, url, mac, token, proxy):
-        """Lazy RAM mode: Cache on-demand (current system)."""
-        if cache_key in self.ram_cache:
-            channels, timestamp = self.ram_cache[cache_key]
-            if self._is_valid(timestamp):
-                logger.debug(f"[LAZY-RAM] Cache HIT: {cache_key}")
-                return channels
-        
-        logger.info(f"[LAZY-RAM] Cache MISS: {cache_key}")
-        channels = self._load_from_api(url, mac, token, proxy)
-        if channels:
-            self.ram_cache[cache_key] = (channels, time.time())
-            logger.info(f"[LAZY-RAM] Cached {len(channels)} channels for {cache_key}")
-        return channels
-    
-    def _get_ram_only(self, cache_key, url, mac, token, proxy):
-        """RAM only mode: Pre-cached at portal setup."""
-        if cache_key in self.ram_cache:
-            channels, timestamp = self.ram_cache[cache_key]
-            if self._is_valid(timestamp):
-                logger.debug(f"[RAM] Cache HIT: {cache_key}")
-                return channels
-        
-        logger.info(f"[RAM] Cache MISS: {cache_key}")
-        channels = self._load_from_api(url, mac, token, proxy)
-        if channels:
-            self.ram_cache[cache_key] = (channels, time.time())
-            logger.info(f"[RAM] Cached {len(channels)} channels for {cache_key}")
-        return channels
+                if channels is None:
+                    channels = self._load_from_api(url, mac, token, proxy)
+            flight["channels"] = channels
+            return channels
+        finally:
+            with self.lock:
+                self.inflight.pop(cache_key, None)
+            flight["event"].set()
     
-    def _get_disk_only(self, cache_key, url, mac, token, proxy):
-        """Disk only mode: Pre-cached at portal setup, persistent."""
-        try:
-            conn = sqlite3.connect('/app/data/channel_cache.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT channels_json, cached_at FROM channel_cache WHERE cache_key = ?', (cache_key,))
-            row = cursor.fetchone()
+    def _schedule_refresh(self, portal_id, cache_key, url, mac, token, proxy):
+        """Queue a background refresh for a stale entry (single-flight, budgeted)."""
+        now = time.time()
+        with self.lock:
+            if cache_key in self.inflight:
+                return
             
-            if row:
-                channels_json, timestamp = row
-                if self._is_valid(timestamp):
-                    logger.debug(f"[DISK] Cache HIT: {cache_key}")
-                    conn.close()
-                    return json.loads(channels_json)
+            recent = [ts for ts in self.refresh_log.get(portal_id, []) if now - ts < self.SWR_BUDGET_WINDOW]
+            if len(recent) >= self.refresh_budget:
+                self.refresh_log[portal_id] = recent
+                self.stats["refreshes_over_budget"] += 1
+                logger.debug(f"[SWR] Refresh budget exhausted for portal {portal_id}, serving stale {cache_key}")
+                return
+            recent.append(now)
+            self.refresh_log[portal_id] = recent
             
-            logger.info(f"[DISK] Cache MISS: {cache_key}")
-            channels = self._load_from_api(url, mac, token, proxy)
-            if channels:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO channel_cache (cache_key, channels_json, cached_at)
-                    VALUES (?, ?, ?)
-                ''', (cache_key, json.dumps(channels), time.time()))
-                conn.commit()
-                logger.info(f"[DISK] Cached {len(channels)} channels for {cache_key}")
-            conn.close()
-            return channels
-        except Exception as e:
-            logger.error(f"Disk cache error: {e}")
-            return self._load_from_api(url, mac, token, proxy)
+            flight = {"event": threading.Event(), "channels": None}
+            self.inflight[cache_key] = flight
+        
+        def refresh():
+            try:
+                channels = self._load_from_api(url, mac, token, proxy)
+                if channels:
+                    channels = self._store(portal_id, mac, channels, time.time())
+                    self.stats["background_refreshes"] += 1
+                    logger.info(f"[SWR] Refreshed {len(channels)} channels for {cache_key}")
+                flight["channels"] = channels
+            except Exception as e:
+                logger.error(f"[SWR] Background refresh failed for {cache_key}: {e}")
+            finally:
+                with self.lock:
+                    self.inflight.pop(cache_key, None)
+                flight["event"].set()
+        
+        self.refresh_executor.submit(refresh)
     
-    def _get_hybrid(self, cache_key, url, mac, token, proxy):
-        """Hybrid mode: RAM + Disk (fast + persistent)."""
+    def _lookup(self, portal_id, mac):
+        """Look up a cache entry without any network I/O.
+        
+        Returns:
+            tuple: (channels, timestamp) or None on miss/hard expiry
+        """
+        cache_key = f"{portal_id}_{mac}"
+        
         # 1. Check RAM cache (fastest)
-        if cache_key in self.ram_cache:
-            channels, timestamp = self.ram_cache[cache_key]
-            if self._is_valid(timestamp):
-                logger.debug(f"[HYBRID-RAM] Cache HIT: {cache_key}")
-                return channels
+        if self.ram_cache is not None:
+            with self.lock:
+                entry = self.ram_cache.get(cache_key)
+            if entry and self._is_valid(entry[1]):
+                return entry
+        
+        if self.mode not in ["disk", "hybrid"]:
+            return None
         
-        # 2. Check Disk cache (persistent)
+        # 2. Check Disk cache (persistent) - no global lock, SQLite handles concurrency
+        conn = sqlite3.connect('/app/data/channel_cache.db')
         try:
-            conn = sqlite3.connect('/app/data/channel_cache.db')
             cursor = conn.cursor()
-            cursor.execute('SELECT channels_json, cached_at FROM channel_cache WHERE cache_key = ?', (cache_key,))
+            cursor.execute('SELECT cached_at FROM channel_cache WHERE cache_key = ?', (cache_key,))
             row = cursor.fetchone()
+            if not row or not self._is_valid(row[0]):
+                return None
+            timestamp = row[0]
             
-            if row:
-                channels_json, timestamp = row
-                if self._is_valid(timestamp):
-                    logger.info(f"[HYBRID-DISK] Cache HIT: {cache_key} (loading to RAM)")
-                    channels = json.loads(channels_json)
-                    # Load into RAM for next time
-                    self.ram_cache[cache_key] = (channels, timestamp)
-                    conn.close()
-                    return channels
+            # Disk mode: catalog already holds this exact entry - skip the JSON decode
+            with self.lock:
+                indexed = self.channel_index.get(cache_key)
+            if self.mode == "disk" and indexed and indexed[1] == timestamp:
+                return indexed
+            
+            cursor.execute('SELECT channels_json FROM channel_cache WHERE cache_key = ?', (cache_key,))
+            row = cursor.fetchone()
+        finally:
             conn.close()
-        except Exception as e:
-            logger.error(f"Hybrid disk cache error: {e}")
-        
-        # 3. Load from API
-        logger.info(f"[HYBRID] Cache MISS: {cache_key}")
-        channels = self._load_from_api(url, mac, token, proxy)
-        if channels:
-            timestamp = time.time()
-            # Save to both caches
-            self.ram_cache[cache_key] = (channels, timestamp)
+        
+        if not row:
+            return None
+        
+        channels = json.loads(row[0])
+        with self.lock:
+            view = self._build_index(portal_id, mac, channels, timestamp)
+            if self.mode == "hybrid":
+                logger.info(f"[HYBRID-DISK] Cache HIT: {cache_key} (loading to RAM)")
+                # Load into RAM for next time
+                self.ram_cache[cache_key] = (view, timestamp)
+        return (view, timestamp)
+    
+    def _store(self, portal_id, mac, channels, timestamp):
+        """Save a cache entry to RAM (+ index) and, for disk/hybrid, to disk.
+        
+        Returns:
+            CatalogView: the compact view that replaces the raw channel list
+        """
+        cache_key = f"{portal_id}_{mac}"
+        with self.lock:
+            view = self._build_index(portal_id, mac, channels, timestamp)
+            # Save to RAM cache
+            if self.ram_cache is not None:
+                self.ram_cache[cache_key] = (view, timestamp)
+        
+        # Save to Disk cache (outside the lock) - compact fields only
+        if self.mode in ["disk", "hybrid"]:
             try:
                 conn = sqlite3.connect('/app/data/channel_cache.db')
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT OR REPLACE INTO channel_cache (cache_key, channels_json, cached_at)
                     VALUES (?, ?, ?)
-                ''', (cache_key, json.dumps(channels), timestamp))
+                ''', (cache_key, json.dumps([channel.to_dict() for channel in view]), timestamp))
                 conn.commit()
                 conn.close()
             except Exception as e:
                 logger.error(f"Error saving to disk cache: {e}")
-            logger.info(f"[HYBRID] Cached {len(channels)} channels for {cache_key}")
-        return channels
+        return view
     
     def set_channels(self, portal_id, mac, channels):
         """Explicitly cache channels (for portal setup pre-caching)."""
         cache_key = f"{portal_id}_{mac}"
-        timestamp = time.time()
+        self._store(portal_id, mac, channels, time.time())
+        logger.info(f"[{self.mode.upper()}] Pre-cached {len(channels)} channels for {cache_key}")
+    
+    def _build_index(self, portal_id, mac, channels, timestamp):
+        """Merge a MAC's channels into the portal catalog and index its view (once per load)."""
+        catalog = self.catalogs.get(portal_id)
+        if catalog is None:
+            catalog = self.catalogs[portal_id] = PortalCatalog()
+        view = catalog.set_mac(mac, channels)
+        self.channel_index[f"{portal_id}_{mac}"] = (view, timestamp)
+        return view
+    
+    def _get_index(self, cache_key, fresh_only=False):
+        """Get the id -> channel index for a cache entry, or None if not cached/expired.
         
+        With fresh_only, stale (swr) entries return None so the caller goes
+        through get_channels() and triggers their background refresh.
+        """
         with self.lock:
-            # Save to RAM cache
-            if self.ram_cache is not None:
-                self.ram_cache[cache_key] = (channels, timestamp)
-            
-            # Save to Disk cache
-            if self.mode in ["disk", "hybrid"]:
-                try:
-                    conn = sqlite3.connect('/app/data/channel_cache.db')
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO channel_cache (cache_key, channels_json, cached_at)
-                        VALUES (?, ?, ?)
-                    ''', (cache_key, json.dumps(channels), timestamp))
-                    conn.commit()
-                    conn.close()
-                except Exception as e:
-                    logger.error(f"Error saving to disk cache: {e}")
-        
-        logger.info(f"[{self.mode.upper()}] Pre-cached {len(channels)} channels for {cache_key}")
+            entry = self.channel_index.get(cache_key)
+            if entry is None:
+                return None
+            index, timestamp = entry
+            if not self._is_valid(timestamp):
+                del self.channel_index[cache_key]
+                if self.ram_cache is None or cache_key not in self.ram_cache:
+                    index.release()
+                return None
+            if fresh_only and not self._is_fresh(timestamp):
+                return None
+            return index
     
     def find_channel(self, portal_id, mac, channel_id, url, token, proxy=None):
-        """Find specific channel (with caching)."""
-        channels = self.get_channels(portal_id, mac, url, token, proxy)
-        if not channels:
-            return None
-        for channel in channels:
-            if str(channel["id"]) == str(channel_id):
-                return channel
-        return None
+        """Find specific channel (with caching) - O(1) via the channel index."""
+        cache_key = f"{portal_id}_{mac}"
+        index = self._get_index(cache_key, fresh_only=True)
+        if index is not None:
+            self.stats["hits"] += 1
+        else:
+            channels = self.get_channels(portal_id, mac, url, token, proxy)
+            if not channels:
+                return None
+            # API fallback (cache error) leaves no index behind - build a throwaway one
+            index = self._get_index(cache_key) or {str(channel["id"]): channel for channel in channels}
+        return index.get(str(channel_id))
+    
+    def find_cached_channel(self, portal_id, macs, channel_id):
+        """Find a channel in already indexed MACs only (no token, no API call).
+        
+        Returns:
+            tuple: (channel_data, mac_used) or (None, None) if no indexed MAC has it
+        """
+        channel_id = str(channel_id)
+        for mac in macs:
+            index = self._get_index(f"{portal_id}_{mac}", fresh_only=True)
+            if index and channel_id in index:
+                return (index[channel_id], mac)
+        return (None, None)
     
     def find_channel_any_mac(self, portal_id, macs, channel_id, url, proxy=None):
         """
@@ -711,17 +1200,20 @@ class ChannelCache:
         Returns:
             tuple: (channel_data, mac_used) or (None, None) if not found
         """
+        # Fast path: channel already in an indexed MAC - no handshake needed
+        channel, mac = self.find_cached_channel(portal_id, macs, channel_id)
+        if channel:
+            logger.debug(f"[find_channel_any_mac] Channel {channel_id} found in index of MAC {mac}")
+            return (channel, mac)
+        
         for mac in macs:
             try:
                 # Get token for this MAC
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if not token:
                     logger.debug(f"[find_channel_any_mac] No token for MAC {mac}")
                     continue
                 
-                # Get profile
-                stb.getProfile(url, mac, token, proxy)
-                
                 # Try to find channel (will cache if lazy-ram)
                 channel = self.find_channel(portal_id, mac, channel_id, url, token, proxy)
                 
@@ -751,6 +1243,10 @@ class ChannelCache:
                     del self.ram_cache[key]
                 count_ram = len(keys_to_remove)
             
+            for key in [key for key in self.channel_index if key.startswith(f"{portal_id}_")]:
+                del self.channel_index[key]
+            self.catalogs.pop(portal_id, None)
+            
             # Clear Disk cache
             if self.mode in ["disk", "hybrid"]:
                 try:
@@ -775,6 +1271,8 @@ class ChannelCache:
             if self.ram_cache is not None:
                 count_ram = len(self.ram_cache)
                 self.ram_cache.clear()
+            self.channel_index.clear()
+            self.catalogs.clear()
             
             # Clear Disk cache
             if self.mode in ["disk", "hybrid"]:
@@ -793,8 +1291,8 @@ class ChannelCache:
     
     def cleanup_expired(self):
         """Remove expired cache entries."""
-        if self.cache_duration is None:
-            return  # Unlimited cache
+        if self.cache_duration is None or self.policy == "swr":
+            return  # Unlimited cache / stale entries are refreshed, not dropped
         
         with self.lock:
             cutoff = time.time() - self.cache_duration
@@ -808,6 +1306,10 @@ class ChannelCache:
                     del self.ram_cache[key]
                 count_ram = len(expired_keys)
             
+            for key in [k for k, (_, ts) in self.channel_index.items() if ts < cutoff]:
+                view, _ = self.channel_index.pop(key)
+                view.release()
+            
             # Cleanup Disk cache
             if self.mode in ["disk", "hybrid"]:
                 try:
@@ -828,10 +1330,16 @@ class ChannelCache:
         with self.lock:
             stats = {
                 "mode": self.mode,
+                "policy": self.policy,
                 "cache_duration": self.cache_duration,
                 "ram_entries": 0,
                 "disk_entries": 0,
-                "total_channels": 0
+                "total_channels": 0,
+                "indexed_entries": len(self.channel_index),
+                "unique_channels": sum(len(catalog.records) for catalog in self.catalogs.values()),
+                "catalogs": {portal_id: catalog.stats() for portal_id, catalog in self.catalogs.items()},
+                "refreshes_in_flight": len(self.inflight),
+                **self.stats
             }
             
             # RAM stats
@@ -853,15 +1361,22 @@ class ChannelCache:
             return stats
     
     def _is_valid(self, timestamp):
-        """Check if cache entry is still valid."""
-        if self.cache_duration is None:
+        """Check if cache entry may still be served (swr entries never hard-expire)."""
+        if self.cache_duration is None or self.policy == "swr":
             return True  # Unlimited
         return (time.time() - timestamp) < self.cache_duration
     
+    def _is_fresh(self, timestamp):
+        """Check if cache entry is fresh (no refresh needed)."""
+        if self.policy != "swr":
+            return self._is_valid(timestamp)
+        max_age = self.cache_duration or self.SWR_DEFAULT_AGE
+        return (time.time() - timestamp) < max_age
+    
     def _load_from_api(self, url, mac, token, proxy):
-        """Load channels from portal API."""
+        """Load channels from portal API (re-handshakes if the cached token was rejected)."""
         try:
-            return stb.getAllChannels(url, mac, token, proxy)
+            return stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
         except Exception as e:
             logger.error(f"Error loading channels from API: {e}")
             return None
@@ -882,7 +1397,14 @@ def init_channel_cache():
         except:
             cache_duration = None
     
-    return ChannelCache(mode=cache_mode, cache_duration=cache_duration)
+    cache_policy = settings.get("channel cache policy", "strict")
+    try:
+        refresh_budget = int(settings.get("channel cache refresh budget", "10"))
+    except ValueError:
+        refresh_budget = 10
+    
+    return ChannelCache(mode=cache_mode, cache_duration=cache_duration,
+                        policy=cache_policy, refresh_budget=refresh_budget)
 
 # Globaler Channel-Cache (wird später initialisiert nach getSettings() Definition)
 channel_cache = None
@@ -898,12 +1420,16 @@ epg_refresh_progress = {
 }
 
 # Editor refresh progress tracking
+editor_refresh_lock = threading.Lock()
 editor_refresh_progress = {
     "running": False,
     "current_portal": "",
     "current_step": "",
     "portals_done": 0,
     "portals_total": 0,
+    "macs_done": 0,
+    "macs_total": 0,
+    "workers": {},
     "started_at": None
 }
 
@@ -935,6 +1461,9 @@ defaultSettings = {
     "hls playlist size": "6",
     "hls max streams": "10",
     "hls inactive timeout": "30",
+    "hls storage": "memory",
+    "hls stall restart": "20",
+    "hls profile": "standard",
     "ffmpeg timeout": "5",
     "test streams": "true",
     "try all macs": "true",
@@ -960,6 +1489,17 @@ defaultSettings = {
     "use portal names as groups": "false",
     "channel cache mode": "lazy-ram",
     "channel cache duration": "unlimited",
+    "refresh workers": "8",
+    "refresh workers per portal": "3",
+    "channel cache policy": "strict",
+    "channel cache refresh budget": "10",
+    "stream chunk size": "64",
+    "async streaming": "true",
+    "stream probe ttl": "30",
+    "mac slot wait": "10",
+    "audio copy": "true",
+    "ffmpeg warm pool": "2",
+    "link cache ttl": "300",
 }
 
 defaultXCUser = {
@@ -967,6 +1507,8 @@ defaultXCUser = {
     "password": "",
     "enabled": "true",
     "max_connections": "1",
+    "priority": "0",  # Higher = served first when waiting for a free MAC
+    "hls profile": "",  # "standard"/"low-latency", empty = global setting
     "allowed_portals": [],  # Empty = all portals
     "created_at": "",
     "expires_at": "",  # Empty = never expires
@@ -979,6 +1521,8 @@ defaultPortal = {
     "url": "",
     "macs": {},
     "streams per mac": "1",
+    "stream linger": "15",  # Seconds a shared stream outlives its last viewer
+    "race macs": "1",  # MACs tried in parallel when starting a stream (1 = one at a time)
     "epg offset": "0",
     "proxy": "",
     "portal prefix": "",
@@ -988,42 +1532,1670 @@ defaultPortal = {
     "custom genres": {},
     "custom epg ids": {},
     "fallback channels": {},
+    "handshake hints": {},  # Learned by stb: handshake endpoint, STB model, GET/POST per action
 }
 
 
-class HLSStreamManager:
-    """Manages HLS streams with shared access and automatic cleanup."""
+class StreamBroadcaster:
+    """One upstream ffmpeg process fanned out to any number of HTTP clients.
     
-    def __init__(self, max_streams=10, inactive_timeout=30):
-        self.streams = {}  # Key: "portalId_channelId", Value: stream info dict
-        self.max_streams = max_streams
-        self.inactive_timeout = inactive_timeout
-        self.lock = threading.Lock()
-        self.monitor_thread = None
-        self.running = False
-        logger.info(f"HLS Stream Manager initialized with max_streams={max_streams}, inactive_timeout={inactive_timeout}s")
-        
-    def start_monitoring(self):
-        """Start the background monitoring thread."""
-        if not self.running:
-            self.running = True
-            self.monitor_thread = threading.Thread(target=self._monitor_loop, daemon=True)
-            self.monitor_thread.start()
-            logger.info("HLS Stream Manager monitoring started")
+    Output is framed into a bounded ring buffer of chunks that start on a
+    sync point (188-byte TS packets, or ISO-BMFF boxes for fragmented MP4).
+    Every client reads at its own position; a client that falls out of the
+    buffer skips ahead to the newest sync point and is dropped after
+    MAX_SKIPS, so one slow reader never stalls the others.
     
-    def _monitor_loop(self):
-        """Background thread that monitors and cleans up inactive streams."""
-        while self.running:
-            try:
-                time.sleep(10)  # Check every 10 seconds
-                self._cleanup_inactive_streams()
-            except Exception as e:
-                logger.error(f"Error in HLS monitor loop: {e}")
+    TS output is relayed with readinto() into one preallocated buffer of
+    chunk_size bytes; each published chunk is a single bytes copy that all
+    clients share (WSGI servers only accept bytes, so this is the floor).
+    
+    With relay={"url", "proxy"} no ffmpeg is spawned: the upstream body is
+    passed through from a pooled HTTP connection and reconnected on EOF.
+    ffmpeg is only started if the upstream turns out not to be MPEG-TS.
+    With feed={"url", "proxy"} ffmpeg may come from ffmpeg_pool; the upstream
+    is then piped into its stdin by _feed. An optional "refresh" callable
+    (stale url -> new url) supplies a fresh play link for every reconnect.
+    
+    MPEG-TS chunks are cut at video keyframes (random_access_indicator), so
+    a joining viewer starts at the newest keyframe with the latest PAT/PMT
+    prepended instead of waiting at the live edge. After the last viewer
+    leaves the upstream lingers for linger seconds unless its MAC slot is
+    needed (StreamBroadcastManager.evict_lingering).
+    """
+    
+    CHUNK_SIZE = 64 * 1024
+    BUFFER_BYTES = 8 * 1024 * 1024
+    MAX_SKIPS = 3
+    IDLE_TIMEOUT = 10  # Stop if no client attaches / all clients gone
+    RELAY_RECONNECTS = 5  # Consecutive failed reconnects before giving up
+    
+    def __init__(self, key, ffmpegcmd, container="mpegts", on_exit=None, chunk_size=None, relay=None, feed=None, linger=0):
+        self.key = key
+        self.linger = linger
+        self.occupancy = None  # MAC slot handle, set by stream_channel
+        self.ffmpegcmd = ffmpegcmd
+        self.relay = relay
+        self.feed = feed
+        self.mode = "relay" if relay else "ffmpeg"
+        self.upstream = None
+        self.created = time.time()
+        self.first_chunk_at = None
+        self.container = container
+        # Whole TS packets only, so chunks stay sync points
+        self.chunk_size = max(188, (chunk_size or self.CHUNK_SIZE) // 188 * 188)
+        self.on_exit = on_exit
+        self.cond = threading.Condition()
+        self.chunks = deque()  # (seq, data, is_sync)
+        self.buffered_bytes = 0
+        self.next_seq = 0
+        self.header = None if container == "mp4" else b""  # MP4 init segment (ftyp + moov)
+        self.init_segment = b""
+        self.pat = b""  # Latest PAT / PMT packets, prepended when a TS viewer joins
+        self.pmts = {}  # PMT PID -> packet
+        self.video_pids = set()
+        self.clients = 0
+        self.last_client_change = time.time()
+        self.finished = False
+        self.stopping = False
+        self.process = None
+        self.wakers = set()  # Async readers (see read_async)
+        self.token = secrets.token_hex(8)  # Hand-off id for the async front end
+        self.stats = {"bytes_in": 0, "chunks": 0, "cpu_seconds": 0.0, "clients_served": 0, "skips": 0, "drops": 0, "reconnects": 0}
+    
+    def start(self):
+        if not self.relay:
+            self._spawn()
+        threading.Thread(target=self._pump, daemon=True, name=f"broadcast-{self.key[0]}-{self.key[1]}").start()
+    
+    def _spawn(self):
+        recipe = ffmpeg_pool.recipe(self.ffmpegcmd) if self.feed and ffmpeg_pool.max_size else None
+        self.process = ffmpeg_pool.take(recipe) if recipe else None
+        if self.process:
+            self.mode = "ffmpeg-warm"
+            threading.Thread(target=self._feed, args=(self.process,), daemon=True,
+                             name=f"broadcast-feed-{self.key[0]}-{self.key[1]}").start()
+            return
+        self.process = subprocess.Popen(
+            self.ffmpegcmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,  # Raw pipe: readinto() straight into our buffer
+        )
+    
+    def stop(self):
+        self.stopping = True
+        try:
+            if self.process:
+                self.process.kill()
+            if self.upstream:
+                self.upstream.close()  # Unblocks the relay read
+        except Exception:
+            pass
+    
+    def _idle(self):
+        limit = self.linger if self.linger and self.stats["clients_served"] else self.IDLE_TIMEOUT
+        if self.clients == 0 and time.time() - self.last_client_change > limit:
+            logger.info(f"Shared stream {self.key} has no viewers - stopping")
+            self.stop()
+            return True
+        return False
+    
+    def _pump(self):
+        """Read ffmpeg (or relayed) output, frame it and publish it to the ring buffer."""
+        self.cpu_start = time.thread_time()
+        returncode = 1
+        try:
+            if self.relay:
+                returncode = self._pump_relay()
+            elif self.container == "mpegts":
+                self._pump_ts(self.process.stdout.readinto)
+            else:
+                self._pump_mp4()
+        except Exception as e:
+            logger.debug(f"Shared stream {self.key} upstream error: {e}")
+        finally:
+            self.stats["cpu_seconds"] = round(time.thread_time() - self.cpu_start, 3)
+            self._close_upstream()
+            if self.process:
+                try:
+                    self.process.kill()
+                except Exception:
+                    pass
+                returncode = self.process.wait()
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+                self._wake()
+            if self.on_exit:
+                self.on_exit(self, returncode)
+    
+    def _pump_ts(self, readinto, initial=b""):
+        """Fill a preallocated buffer to chunk_size, publish whole TS packets.
+        
+        Returns True when stopped for lack of viewers, False at upstream EOF.
+        """
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        filled = len(initial)
+        view[:filled] = initial
+        self.stats["bytes_in"] += filled
+        while True:
+            n = readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+            self.stats["bytes_in"] += n
+            if filled < self.chunk_size:
+                continue
+            
+            self._publish_ts(bytes(view[:filled]))
+            filled = 0
+            self.stats["cpu_seconds"] = round(time.thread_time() - self.cpu_start, 3)
+            if self._idle():
+                return True
+        
+        # Flush remaining whole packets at EOF
+        cut = filled - filled % 188
+        if cut:
+            self._publish_ts(bytes(view[:cut]))
+        return False
+    
+    def _publish_ts(self, data):
+        """Publish whole TS packets; a chunk containing a video keyframe is split there."""
+        keyframe = self._scan_ts(data)
+        if keyframe:
+            self._publish(data[:keyframe], False)
+            self._publish(data[keyframe:], True)
+        else:
+            self._publish(data, keyframe == 0)
+    
+    def _scan_ts(self, data):
+        """Offset of the last video keyframe packet in data (None if none); tracks PAT/PMT."""
+        if not data or data[0] != 0x47:
+            return None
+        keyframe = None
+        for pos in range(0, len(data) - 187, 188):
+            flags = data[pos + 1]
+            if not flags & 0x40:
+                continue  # Keyframes and tables start with payload_unit_start
+            pid = ((flags & 0x1F) << 8) | data[pos + 2]
+            if pid in self.video_pids:
+                # Adaptation field present, non-empty, random_access_indicator set
+                if data[pos + 3] & 0x20 and data[pos + 4] and data[pos + 5] & 0x40:
+                    keyframe = pos
+            elif pid == 0 or pid in self.pmts:
+                self._track_psi(pid, data[pos:pos + 188])
+        return keyframe
+    
+    def _track_psi(self, pid, packet):
+        """Remember the PAT and PMT packets and learn the video PIDs."""
+        start = 4
+        if packet[3] & 0x20:
+            start += 1 + packet[4]
+        if start >= 188:
+            return
+        section = start + 1 + packet[start]  # Skip pointer field
+        if section + 12 > 188:
+            return
+        table_id = packet[section]
+        if pid == 0 and table_id == 0x00:
+            self.pat = packet
+            length = ((packet[section + 1] & 0x0F) << 8) | packet[section + 2]
+            pmt_pids = set()
+            for entry in range(section + 8, min(section + 3 + length - 4, 188) - 3, 4):
+                if (packet[entry] << 8) | packet[entry + 1]:
+                    pmt_pids.add(((packet[entry + 2] & 0x1F) << 8) | packet[entry + 3])
+            self.pmts = {pmt_pid: self.pmts.get(pmt_pid, b"") for pmt_pid in pmt_pids}
+        elif table_id == 0x02:
+            self.pmts[pid] = packet
+            self.video_pids = {
+                es_pid for stream_type, es_pid, _ in StreamProbe._pmt_streams(packet, section, 188)
+                if SourceCodecCache.TS_STREAM_TYPES.get(stream_type, (None,))[0] == "video"
+            } or self.video_pids
+    
+    def _fresh_url(self, source, url):
+        """New play link for a reconnect - create_link URLs are often one-shot or short-lived."""
+        refresh = source.get("refresh")
+        if not refresh:
+            return url
+        try:
+            return refresh(url) or url
+        except Exception as e:
+            logger.debug(f"Shared stream {self.key}: could not refresh play link: {e}")
+            return url
+    
+    def _pump_relay(self):
+        """Pass the upstream TS through as is; reconnect on EOF, ffmpeg if it is not TS."""
+        url = self.relay["url"]
+        proxy = self.relay.get("proxy")
+        connected = False
+        failures = 0
+        attempts = 0
+        while not self.stopping:
+            head = b""
+            if attempts:
+                url = self._fresh_url(self.relay, url)
+            attempts += 1
+            try:
+                self.upstream = stb.openStream(url, proxy, timeout=int(getSettings().get("ffmpeg timeout", "5")))
+                head = self.upstream.raw.read(376)
+            except Exception as e:
+                logger.debug(f"Shared stream {self.key} relay connect failed: {e}")
+            
+            if len(head) == 376 and head[0] == 0x47 and head[188] == 0x47:
+                if not connected:
+                    logger.info(f"Shared stream {self.key}: relaying upstream MPEG-TS directly (no ffmpeg)")
+                connected = True
+                failures = 0
+                if self._pump_ts(self.upstream.raw.readinto, head) or self.stopping:
+                    return 0
+                self.stats["reconnects"] += 1
+                logger.info(f"Shared stream {self.key}: upstream EOF - reconnecting")
+            elif head and not connected:
+                # HLS playlist, MP4, ... - needs remuxing
+                logger.info(f"Shared stream {self.key}: upstream is not MPEG-TS - falling back to ffmpeg")
+                self._close_upstream()
+                self.mode = "ffmpeg"
+                self._spawn()
+                self._pump_ts(self.process.stdout.readinto)
+                return 1  # Superseded by ffmpeg's return code
+            else:
+                failures += 1
+                if not connected or failures > self.RELAY_RECONNECTS:
+                    return 1
+                time.sleep(min(failures, 3))
+            self._close_upstream()
+        return 0
+    
+    def _feed(self, process):
+        """Copy the upstream into a warm ffmpeg's stdin, reconnecting like the relay."""
+        url = self.feed["url"]
+        proxy = self.feed.get("proxy")
+        failures = 0
+        attempts = 0
+        try:
+            while not self.stopping and process.poll() is None:
+                if attempts:
+                    url = self._fresh_url(self.feed, url)
+                attempts += 1
+                try:
+                    self.upstream = stb.openStream(url, proxy, timeout=int(getSettings().get("ffmpeg timeout", "5")))
+                    failures = 0
+                    while True:
+                        data = self.upstream.raw.read(self.CHUNK_SIZE)
+                        if not data:
+                            break
+                        process.stdin.write(data)
+                except (BrokenPipeError, ValueError):
+                    return  # ffmpeg exited
+                except Exception as e:
+                    failures += 1
+                    logger.debug(f"Shared stream {self.key} feed error: {e}")
+                    if failures > self.RELAY_RECONNECTS:
+                        return
+                    time.sleep(min(failures, 3))
+                finally:
+                    self._close_upstream()
+                if not self.stopping:
+                    self.stats["reconnects"] += 1
+                    logger.info(f"Shared stream {self.key}: upstream EOF - reconnecting feed")
+        finally:
+            try:
+                process.stdin.close()  # EOF lets ffmpeg flush and exit
+            except Exception:
+                pass
+    
+    def _close_upstream(self):
+        upstream, self.upstream = self.upstream, None
+        if upstream:
+            try:
+                upstream.close()
+            except Exception:
+                pass
+    
+    def _pump_mp4(self):
+        stdout = self.process.stdout
+        pending = b""
+        while True:
+            data = stdout.read(self.chunk_size)
+            if not data:
+                break
+            self.stats["bytes_in"] += len(data)
+            pending = self._frame_mp4(pending + data if pending else data)
+            if self._idle():
+                return
+    
+    def _frame_mp4(self, data):
+        pos = 0
+        while len(data) - pos >= 8:
+            size = int.from_bytes(data[pos:pos + 4], "big")
+            box_type = data[pos + 4:pos + 8]
+            if size == 1:
+                if len(data) - pos < 16:
+                    break
+                size = int.from_bytes(data[pos + 8:pos + 16], "big")
+            elif size < 8:
+                # Box runs to end of stream - cannot be framed, pass through as is
+                self._publish(data[pos:], False)
+                return b""
+            if len(data) - pos < size:
+                break
+            box = data[pos:pos + size]
+            pos += size
+            if box_type == b"moof":
+                self._publish(box, True)
+            elif self.header is None:
+                # Boxes before the first fragment form the init segment
+                self.init_segment += box
+            else:
+                self._publish(box, False)
+        return data[pos:]
+    
+    def _publish(self, data, is_sync):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.time()
+            self.stats["startup_seconds"] = round(self.first_chunk_at - self.created, 3)
+            if self.mode.startswith("ffmpeg"):
+                ffmpeg_pool.record_startup(self.mode == "ffmpeg-warm", self.first_chunk_at - self.created)
+        with self.cond:
+            if self.header is None:
+                # First fragment: init segment is complete
+                self.header = self.init_segment
+            self.chunks.append((self.next_seq, data, is_sync))
+            self.next_seq += 1
+            self.stats["chunks"] += 1
+            self.buffered_bytes += len(data)
+            while self.buffered_bytes > self.BUFFER_BYTES and len(self.chunks) > 1:
+                _, evicted, _ = self.chunks.popleft()
+                self.buffered_bytes -= len(evicted)
+            self.cond.notify_all()
+            self._wake()
+    
+    def _latest_sync_seq(self):
+        for seq, _, is_sync in reversed(self.chunks):
+            if is_sync:
+                return seq
+        return None
+    
+    def _join(self):
+        """Read cursor for a new client (cond held, header known)."""
+        # Both containers join at the newest keyframe / fragment still buffered,
+        # TS falls back to the live edge until a keyframe has been seen
+        seq = self._latest_sync_seq()
+        prefix = b""
+        if seq is None:
+            seq = self.next_seq
+        elif self.container == "mpegts":
+            prefix = self._psi()
+        return {"seq": seq, "need_sync": self.container != "mpegts", "skips": 0, "prefix": prefix}
+    
+    def _psi(self):
+        """Latest PAT + PMTs (cond held) - lets a decoder start mid-stream."""
+        return self.pat + b"".join(self.pmts.values())
+    
+    def _take(self, cursor):
+        """Chunks for cursor (cond held): [] if nothing new yet, None when done."""
+        seq = cursor["seq"]
+        if seq >= self.next_seq:
+            return None if self.finished else []  # None: upstream finished and buffer drained
+        
+        oldest = self.chunks[0][0]
+        if seq < oldest:
+            # Fell out of the ring buffer - skip ahead instead of stalling others
+            cursor["skips"] += 1
+            self.stats["skips"] += 1
+            if cursor["skips"] > self.MAX_SKIPS:
+                self.stats["drops"] += 1
+                logger.info(f"Dropping slow client from shared stream {self.key}")
+                return None
+            seq = self._latest_sync_seq()
+            cursor["seq"] = self.next_seq if seq is None else seq
+            cursor["need_sync"] = self.container != "mpegts"
+            if self.container == "mpegts":
+                # Resent with the first chunk after the gap (the relay has no resend_headers)
+                cursor["resync"] = True
+            return self._take(cursor)
+        
+        batch = []
+        if cursor.pop("resync", False):
+            batch.append(self._psi())
+        for index in range(seq - oldest, len(self.chunks)):
+            _, data, is_sync = self.chunks[index]
+            if cursor["need_sync"] and not is_sync:
+                continue
+            cursor["need_sync"] = False
+            batch.append(data)
+        cursor["seq"] = self.next_seq
+        return batch
+    
+    def _wake(self):
+        """Notify async readers (cond held)."""
+        for waker in list(self.wakers):
+            try:
+                waker()
+            except RuntimeError:
+                self.wakers.discard(waker)  # Event loop closed
+    
+    def read(self):
+        """Generator yielding this broadcast's bytes for one client."""
+        with self.cond:
+            # MP4: wait for the init segment before joining
+            while self.header is None and not self.finished:
+                self.cond.wait(timeout=5)
+            if self.finished:
+                return
+            cursor = self._join()
+            header = self.header + cursor["prefix"]
+        
+        if header:
+            yield header
+        
+        while True:
+            with self.cond:
+                batch = self._take(cursor)
+                while batch == []:
+                    self.cond.wait(timeout=5)
+                    batch = self._take(cursor)
+            if batch is None:
+                return
+            for data in batch:
+                yield data
+    
+    async def read_async(self):
+        """Async generator twin of read() for the event-loop front end.
+        
+        Waits on an asyncio.Event that _publish sets via call_soon_threadsafe,
+        so a viewer costs no thread while idle.
+        """
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        
+        def waker():
+            loop.call_soon_threadsafe(wake.set)
+        
+        with self.cond:
+            self.wakers.add(waker)
+        try:
+            header = None
+            cursor = None
+            while True:
+                with self.cond:
+                    wake.clear()
+                    if cursor is None:
+                        if self.finished:
+                            return
+                        batch = []
+                        if self.header is not None:
+                            cursor = self._join()
+                            header = self.header + cursor["prefix"]
+                    else:
+                        batch = self._take(cursor)
+                if batch is None:
+                    return
+                if header:
+                    yield header
+                    header = None
+                if batch:
+                    for data in batch:
+                        yield data
+                else:
+                    try:
+                        await asyncio.wait_for(wake.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            with self.cond:
+                self.wakers.discard(waker)
+
+
+class StreamBroadcastManager:
+    """Per-(portal, channel, kind) registry of shared upstream broadcasts."""
+    
+    def __init__(self):
+        self.broadcasts = {}
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            broadcast = self.broadcasts.get(key)
+            if broadcast and not broadcast.finished and not broadcast.stopping:
+                return broadcast
+            return None
+    
+    def start(self, key, ffmpegcmd, container="mpegts", on_exit=None, chunk_size=None, relay=None, feed=None, linger=0):
+        """Start a broadcast for key, or return the one that won the race."""
+        with self.lock:
+            existing = self.broadcasts.get(key)
+            if existing and not existing.finished and not existing.stopping:
+                return existing, False
+            
+            def exited(broadcast, returncode):
+                with self.lock:
+                    if self.broadcasts.get(key) is broadcast:
+                        del self.broadcasts[key]
+                if on_exit:
+                    on_exit(broadcast, returncode)
+            
+            broadcast = StreamBroadcaster(key, ffmpegcmd, container, on_exit=exited, chunk_size=chunk_size,
+                                          relay=relay, feed=feed, linger=linger)
+            broadcast.start()
+            self.broadcasts[key] = broadcast
+            return broadcast, True
+    
+    def find(self, token):
+        """Live broadcast by hand-off token (async front end)."""
+        with self.lock:
+            for broadcast in self.broadcasts.values():
+                if broadcast.token == token and not broadcast.finished and not broadcast.stopping:
+                    return broadcast
+            return None
+    
+    def _attach(self, broadcast):
+        with self.lock:
+            broadcast.clients += 1
+            broadcast.stats["clients_served"] += 1
+            broadcast.last_client_change = time.time()
+            if broadcast.occupancy:
+                broadcast.occupancy.info.pop("lingering", None)
+    
+    def _detach(self, broadcast):
+        with self.lock:
+            broadcast.clients -= 1
+            broadcast.last_client_change = time.time()
+            last_client = broadcast.clients == 0
+            if last_client and broadcast.linger and broadcast.occupancy:
+                broadcast.occupancy.info["lingering"] = True
+        if last_client:
+            if broadcast.linger:
+                # Kept for a quick zap back; _idle stops it, evict_lingering frees it early
+                logger.info(f"Last viewer left shared stream {broadcast.key} - lingering {broadcast.linger}s")
+            else:
+                logger.info(f"Last viewer left shared stream {broadcast.key} - stopping upstream")
+                broadcast.stop()
+    
+    def evict_lingering(self, portal_id, mac=None):
+        """Stop the longest-lingering viewerless broadcast of a portal (optionally on one MAC).
+        
+        Its MAC slot is released right away. Returns True if one was evicted.
+        """
+        with self.lock:
+            lingering = [
+                broadcast for key, broadcast in self.broadcasts.items()
+                if key[0] == portal_id and broadcast.clients == 0 and broadcast.stats["clients_served"]
+                and not broadcast.stopping and broadcast.occupancy and (mac is None or broadcast.occupancy.mac == mac)
+            ]
+            if not lingering:
+                return False
+            victim = min(lingering, key=lambda broadcast: broadcast.last_client_change)
+            victim.stopping = True  # No new joins while it shuts down
+        logger.info(f"Lingering shared stream {victim.key} gives up MAC({victim.occupancy.mac})")
+        victim.stop()
+        victim.occupancy.release()
+        return True
+    
+    def stream(self, broadcast):
+        """Client generator: attaches on first read, detaches on disconnect."""
+        self._attach(broadcast)
+        try:
+            yield from broadcast.read()
+        finally:
+            self._detach(broadcast)
+    
+    async def stream_async(self, broadcast):
+        """Async client generator used by AsyncStreamFrontend."""
+        self._attach(broadcast)
+        try:
+            async for data in broadcast.read_async():
+                yield data
+        finally:
+            self._detach(broadcast)
+    
+    def get_stats(self):
+        with self.lock:
+            return [
+                dict(broadcast.stats, portal=key[0], channel=key[1], kind=key[2], mode=broadcast.mode,
+                     clients=broadcast.clients, buffered_bytes=broadcast.buffered_bytes,
+                     lingering=broadcast.clients == 0 and bool(broadcast.stats["clients_served"]))
+                for key, broadcast in self.broadcasts.items()
+            ]
+
+
+stream_broadcasts = StreamBroadcastManager()
+
+
+class FfmpegWarmPool:
+    """Pre-spawned ffmpeg processes that read MPEG-TS from stdin.
+    
+    ffmpeg cannot be handed a URL once running, so a warm worker is the
+    configured command with its input replaced by "-i pipe:0"; the
+    broadcaster then pipes the upstream in (StreamBroadcaster._feed). Each
+    command keeps one idle worker per full STARTS_PER_WORKER starts in the
+    last DEMAND_WINDOW seconds (at most max_size), surplus workers are
+    reaped - a quiet server keeps no idle ffmpeg at all.
+    
+    Only used for MPEG-TS channels with stream method "ffmpeg" (not web/MP4,
+    HLS or relay). Warm workers drop the network input options (NET_OPTIONS:
+    proxy, timeout, reconnect, headers) - the feed applies the proxy and
+    reconnects itself - so commands that differ only in those share a pool.
+    """
+    
+    # Input options that only apply to network inputs (all take a value)
+    NET_OPTIONS = {"-http_proxy", "-timeout", "-rw_timeout", "-reconnect", "-reconnect_streamed",
+                   "-reconnect_at_eof", "-reconnect_delay_max", "-user_agent", "-headers"}
+    DEMAND_WINDOW = 300
+    STARTS_PER_WORKER = 5
+    IDLE_TTL = 120  # Seconds before a surplus worker is reaped
+    
+    def __init__(self, max_size=2):
+        self.max_size = max_size  # Per command, 0 = pool disabled
+        self.idle = {}  # recipe -> deque of (process, spawned_at)
+        self.starts = {}  # recipe -> deque of start timestamps
+        self.startup = {"warm": deque(maxlen=100), "cold": deque(maxlen=100)}  # Seconds to first chunk
+        self.stats = {"hits": 0, "misses": 0, "spawned": 0, "reaped": 0}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self._maintain_loop, daemon=True, name="ffmpeg-pool")
+            self.thread.start()
+    
+    @classmethod
+    def recipe(cls, ffmpegcmd):
+        """The command reading stdin instead of its URL, None without exactly one input."""
+        if ffmpegcmd.count("-i") != 1:
+            return None
+        index = ffmpegcmd.index("-i")
+        before = []
+        skip = False
+        for arg in ffmpegcmd[:index]:
+            if skip:
+                skip = False
+            elif arg in cls.NET_OPTIONS:
+                skip = True
+            else:
+                before.append(arg)
+        return tuple(before + ["-i", "pipe:0"] + ffmpegcmd[index + 2:])
+    
+    def take(self, recipe):
+        """A warm worker for recipe, or None (the caller spawns cold)."""
+        process = None
+        with self.lock:
+            self.starts.setdefault(recipe, deque()).append(time.time())
+            workers = self.idle.get(recipe)
+            while workers:
+                candidate, _ = workers.popleft()
+                if candidate.poll() is None:
+                    process = candidate
+                    break
+            self.stats["hits" if process else "misses"] += 1
+        self.wake.set()  # Top up right away
+        return process
+    
+    def record_startup(self, warm, seconds):
+        with self.lock:
+            self.startup["warm" if warm else "cold"].append(seconds)
+    
+    def _spawn(self, recipe):
+        return subprocess.Popen(
+            list(recipe),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+        )
+    
+    def _maintain_loop(self):
+        while True:
+            self.wake.wait(timeout=10)
+            self.wake.clear()
+            try:
+                self._maintain()
+            except Exception as e:
+                logger.error(f"Error in ffmpeg pool maintenance: {e}")
+    
+    def _maintain(self):
+        now = time.time()
+        spawn = []
+        reap = []
+        with self.lock:
+            for recipe in set(self.idle) | set(self.starts):
+                starts = self.starts.get(recipe, deque())
+                while starts and now - starts[0] > self.DEMAND_WINDOW:
+                    starts.popleft()
+                workers = deque(worker for worker in self.idle.get(recipe, ()) if worker[0].poll() is None)
+                target = min(self.max_size, len(starts) // self.STARTS_PER_WORKER)
+                while len(workers) > target and (target == 0 or now - workers[0][1] > self.IDLE_TTL):
+                    reap.append(workers.popleft()[0])
+                spawn.extend([recipe] * (target - len(workers)))
+                if workers or starts:
+                    self.idle[recipe] = workers
+                    self.starts[recipe] = starts
+                else:
+                    self.idle.pop(recipe, None)
+                    self.starts.pop(recipe, None)
+            self.stats["reaped"] += len(reap)
+        
+        for process in reap:
+            try:
+                process.kill()
+                process.wait(timeout=5)
+            except Exception:
+                pass
+        for recipe in spawn:
+            try:
+                process = self._spawn(recipe)
+            except Exception as e:
+                logger.error(f"Could not pre-spawn ffmpeg: {e}")
+                return
+            with self.lock:
+                self.idle.setdefault(recipe, deque()).append((process, time.time()))
+                self.stats["spawned"] += 1
+        if spawn or reap:
+            logger.debug(f"ffmpeg pool: spawned {len(spawn)}, reaped {len(reap)}")
+    
+    @staticmethod
+    def _median(samples):
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        middle = len(ordered) // 2
+        median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+        return round(median, 3)
+    
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                max_size=self.max_size,
+                idle_workers=sum(len(workers) for workers in self.idle.values()),
+                median_startup_warm=self._median(self.startup["warm"]),
+                median_startup_cold=self._median(self.startup["cold"]),
+                startup_samples={mode: len(samples) for mode, samples in self.startup.items()},
+            )
+
+
+ffmpeg_pool = FfmpegWarmPool()
+
+
+class AsyncStreamFrontend:
+    """asyncio HTTP front end so live viewers do not hold waitress threads.
+    
+    Owns the public port. GET/HEAD requests for the long-lived streaming
+    routes (/play, /live, /movie, /series, /hls, /xc and the XC short form
+    /<user>/<pass>/<id>[.ext]) run through the Flask app in a dedicated
+    executor; a shared broadcast is then relayed from the event loop itself,
+    so a live viewer costs no thread while it waits for data. Other streaming
+    bodies (VOD proxy, HLS files) are pulled chunk by chunk through the same
+    executor. Everything else is tunnelled to waitress on a loopback port, so
+    the admin UI, playlist, XMLTV and player_api.php keep their own thread
+    pool; client connections stay keep-alive across tunnelled requests.
+    """
+    
+    STREAM_PATH = re.compile(r"^/(?:play|live|movie|series|hls|xc)/")
+    XC_SHORT_PATH = re.compile(r"^/([^/]+)/[^/]+/\d+(?:\.\w+)?$")
+    NO_BODY_STATUS = ("1", "204", "304")
+    HANDOFF_HEADER = "X-MacReplay-Broadcast"
+    ENVIRON_KEY = "macreplay.async_frontend"
+    MAX_HEADER_BYTES = 65536
+    READ_SIZE = 65536
+    WRITE_BUFFER = 1024 * 1024  # Same as waitress send_bytes
+    
+    def __init__(self, wsgi_app, host, port, backend_port, workers=256):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.backend_port = backend_port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stream")
+        self.loop = None
+        self.stats = {"connections": 0, "proxied": 0, "streams": 0, "active_streams": 0, "shared_streams": 0}
+        self.stats_lock = threading.Lock()
+        # First path segments of the app's own routes (/vods/..., /portal/...) - never the XC short form
+        url_map = getattr(wsgi_app, "url_map", None)
+        self.route_prefixes = {
+            rule.rule.split("/")[1] for rule in (url_map.iter_rules() if url_map else [])
+            if rule.rule.count("/") > 1 and not rule.rule.startswith("/<")
+        }
+    
+    def _is_stream_path(self, path):
+        if self.STREAM_PATH.match(path):
+            return True
+        match = self.XC_SHORT_PATH.match(path)
+        return bool(match) and match.group(1) not in self.route_prefixes
+    
+    def _count(self, key, delta=1):
+        with self.stats_lock:
+            self.stats[key] += delta
+    
+    def start(self):
+        """Bind the public port and run the event loop in a daemon thread."""
+        ready = threading.Event()
+        result = {}
+        
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(asyncio.start_server(
+                    self._handle, self.host, self.port, limit=self.MAX_HEADER_BYTES, backlog=1024
+                ))
+            except OSError as e:
+                result["error"] = e
+                loop.close()
+                ready.set()
+                return
+            self.loop = loop
+            ready.set()
+            loop.run_forever()
+        
+        threading.Thread(target=run, daemon=True, name="stream-frontend").start()
+        ready.wait()
+        if "error" in result:
+            logger.error(f"Async stream front end could not bind {self.host}:{self.port}: {result['error']}")
+            return False
+        logger.info(f"Async stream front end listening on {self.host}:{self.port} (backend 127.0.0.1:{self.backend_port})")
+        return True
+    
+    @staticmethod
+    def _parse_head(head):
+        """Split a request/status head into (first line parts, [(name, value)])."""
+        first_line, _, header_block = head.decode("latin-1").partition("\r\n")
+        headers = []
+        for line in header_block.split("\r\n"):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers.append((name.strip(), value.strip()))
+        return first_line.split(" ", 2), headers
+    
+    @staticmethod
+    def _header(headers, name):
+        return next((value for key, value in headers if key.lower() == name), "")
+    
+    async def _handle(self, reader, writer):
+        self._count("connections")
+        writer.transport.set_write_buffer_limits(high=self.WRITE_BUFFER)
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            # Keep-alive: tunnelled requests loop, a stream request ends the connection
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.LimitOverrunError:
+                    writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+                except asyncio.IncompleteReadError:
+                    return
+                
+                parts, headers = self._parse_head(head)
+                if len(parts) != 3:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+                method, target, protocol = parts
+                
+                if method in ("GET", "HEAD") and self._is_stream_path(target.split("?", 1)[0]):
+                    await self._serve_stream(writer, method, target, protocol, headers, peer)
+                    return
+                if not await self._tunnel(reader, writer, method, target, protocol, headers, peer):
+                    return
+        except ConnectionError:
+            pass  # Client went away
+        except Exception as e:
+            logger.debug(f"Async stream front end error: {e}")
+        finally:
+            writer.close()
+    
+    async def _tunnel(self, reader, writer, method, target, protocol, headers, peer):
+        """Pass one request through to waitress; True if the client connection stays open.
+        
+        The backend leg is one request per connection (its EOF ends the body);
+        the client leg is kept alive when the response is framed, so each
+        follow-up request goes through the dispatcher again.
+        """
+        try:
+            backend_reader, backend_writer = await asyncio.open_connection("127.0.0.1", self.backend_port)
+        except OSError as e:
+            logger.error(f"Async stream front end: waitress backend unreachable: {e}")
+            writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            return False
+        self._count("proxied")
+        
+        connection = self._header(headers, "connection").lower()
+        keep_alive = (protocol == "HTTP/1.1" and "close" not in connection) or \
+                     (protocol == "HTTP/1.0" and "keep-alive" in connection)
+        content_length = self._header(headers, "content-length")
+        chunked_upload = "chunked" in self._header(headers, "transfer-encoding").lower()
+        
+        lines = [f"{method} {target} {protocol}"]
+        forwarded = False
+        for name, value in headers:
+            lower = name.lower()
+            if lower in ("connection", "keep-alive") or (lower == "expect" and not chunked_upload):
+                continue
+            if lower == "x-forwarded-for":
+                forwarded = True
+            lines.append(f"{name}: {value}")
+        if not forwarded:
+            # ProxyFix (x_for=1) then still sees the real client instead of 127.0.0.1
+            lines.append(f"X-Forwarded-For: {peer[0]}")
+        lines.append("Connection: close")
+        backend_writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        
+        upload = None
+        try:
+            if chunked_upload:
+                # Unframed upload: pass it through and close afterwards
+                keep_alive = False
+                upload = asyncio.ensure_future(self._pipe(reader, backend_writer))
+            elif content_length.isdigit() and int(content_length):
+                if "100-continue" in self._header(headers, "expect").lower():
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                backend_writer.write(await reader.readexactly(int(content_length)))
+            
+            try:
+                response_head = await backend_reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return False
+            status_parts, response_headers = self._parse_head(response_head)
+            status = status_parts[1] if len(status_parts) > 1 else ""
+            framed = (
+                method == "HEAD" or status.startswith(self.NO_BODY_STATUS)
+                or self._header(response_headers, "content-length").isdigit()
+                or "chunked" in self._header(response_headers, "transfer-encoding").lower()
+            )
+            keep_alive = keep_alive and framed
+            
+            head = [" ".join(status_parts)]
+            head.extend(f"{name}: {value}" for name, value in response_headers
+                        if name.lower() not in ("connection", "keep-alive"))
+            head.append("Connection: keep-alive" if keep_alive else "Connection: close")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            await self._pipe(backend_reader, writer)
+            return keep_alive
+        finally:
+            if upload:
+                upload.cancel()
+            backend_writer.close()
+    
+    async def _pipe(self, reader, writer):
+        while True:
+            data = await reader.read(self.READ_SIZE)
+            if not data:
+                return
+            writer.write(data)
+            await writer.drain()
+    
+    def _environ(self, method, target, protocol, headers, peer):
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, encoding="latin-1"),  # PEP 3333: raw bytes as latin-1
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": lambda file, block_size=8192: FileWrapper(file, max(block_size, self.READ_SIZE)),
+            self.ENVIRON_KEY: True,
+        }
+        for name, value in headers:
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+    
+    def _call_app(self, environ):
+        """Run the Flask request in the executor; returns (status, headers, body)."""
+        response = {}
+        
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return lambda data: None
+        
+        body = self.wsgi_app(environ, start_response)
+        return response["status"], response["headers"], body
+    
+    async def _serve_stream(self, writer, method, target, protocol, headers, peer):
+        loop = asyncio.get_running_loop()
+        self._count("streams")
+        self._count("active_streams")
+        body = None
+        try:
+            environ = self._environ(method, target, protocol, headers, peer)
+            status, response_headers, body = await loop.run_in_executor(self.executor, self._call_app, environ)
+            
+            token = None
+            head = [f"HTTP/1.1 {status}"]
+            for name, value in response_headers:
+                if name == self.HANDOFF_HEADER:
+                    token = value
+                elif name.lower() not in ("connection", "keep-alive", "transfer-encoding"):
+                    head.append(f"{name}: {value}")
+            head.append("Connection: close")  # Body ends when the socket closes
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            if method == "HEAD":
+                await writer.drain()
+                return
+            
+            if token:
+                broadcast = stream_broadcasts.find(token)
+                if broadcast:
+                    self._count("shared_streams")
+                    stream = stream_broadcasts.stream_async(broadcast)
+                    try:
+                        async for data in stream:
+                            writer.write(data)
+                            await writer.drain()
+                    finally:
+                        await stream.aclose()
+            else:
+                iterator = iter(body)
+                while True:
+                    data = await loop.run_in_executor(self.executor, next, iterator, None)
+                    if data is None:
+                        break
+                    if data:
+                        writer.write(data)
+                        await writer.drain()
+            await writer.drain()
+        finally:
+            self._count("active_streams", -1)
+            close = getattr(body, "close", None)
+            if close:
+                # Runs generator cleanup / call_on_close handlers (e.g. XC connection slots)
+                await loop.run_in_executor(self.executor, close)
+    
+    def get_stats(self):
+        with self.stats_lock:
+            return dict(self.stats, port=self.port, backend_port=self.backend_port)
+
+
+stream_frontend = None
+
+
+class StreamProbe:
+    """Lightweight play-link test that replaces the per-play ffprobe run.
+    
+    Reads the first TS packets over HTTP and checks sync bytes, PAT and PMT.
+    Passing results are cached per channel for ttl seconds so quick re-tunes
+    skip probing; every probe feeds per-channel health stats.
+    """
+    
+    PROBE_BYTES = 188 * 1000  # Give up on PAT/PMT after ~188KB
+    READ_SIZE = 188 * 64
+    
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.passed = {}  # (portal_id, channel_id) -> timestamp of last passing probe
+        self.health = {}  # (portal_id, channel_id) -> stats dict
+        self.lock = threading.Lock()
+    
+    def check(self, portal_id, channel_id, link, proxy=None, timeout=5, use_cache=True):
+        """True if the link looks playable (cached per channel).
+        
+        use_cache=False always probes this link - the cache is per channel,
+        not per link or MAC.
+        """
+        key = (portal_id, channel_id)
+        now = time.time()
+        with self.lock:
+            health = self.health.setdefault(key, {
+                "probes": 0, "failures": 0, "cache_hits": 0,
+                "last_ms": None, "last_error": None, "last_probe": None,
+            })
+            passed_at = self.passed.get(key)
+            if use_cache and passed_at and now - passed_at < self.ttl:
+                health["cache_hits"] += 1
+                return True
+        
+        ok, error, streams = self._probe(link, proxy, timeout)
+        elapsed_ms = int((time.time() - now) * 1000)
+        if streams is not None:
+            source_codecs.put_pmt(("live", portal_id, channel_id), streams)
+        with self.lock:
+            health["probes"] += 1
+            health["last_ms"] = elapsed_ms
+            health["last_probe"] = int(now)
+            health["last_error"] = error
+            if ok:
+                self.passed[key] = now
+            else:
+                health["failures"] += 1
+                self.passed.pop(key, None)
+        if ok:
+            logger.debug(f"Stream probe Portal({portal_id}):Channel({channel_id}) passed in {elapsed_ms}ms")
+        else:
+            logger.info(f"Stream probe Portal({portal_id}):Channel({channel_id}) failed: {error}")
+        return ok
+    
+    def _probe(self, link, proxy, timeout):
+        """Returns (ok, error, PMT streams or None)."""
+        try:
+            response = stb.openStream(link, proxy, timeout=timeout)
+        except Exception as e:
+            return False, f"connect: {e}", None
+        try:
+            data = b""
+            while len(data) < self.PROBE_BYTES:
+                chunk = response.raw.read(self.READ_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+                if len(data) >= 376 and data[0] != 0x47 and data.find(b"\x47") < 0:
+                    break
+                result = self._parse_ts(data)
+                if isinstance(result, list):
+                    return True, None, result
+                if result is False:
+                    break
+            if not data:
+                return False, "empty response", None
+            if data.lstrip().startswith(b"#EXTM3U"):
+                return True, None, None  # HLS upstream - ffmpeg handles it
+            if self._find_sync(data) is None:
+                if data[4:8] in (b"ftyp", b"moov") or data[:4] == b"\x1a\x45\xdf\xa3":
+                    return True, None, None  # MP4 / Matroska upstream
+                return False, "no MPEG-TS sync", None
+            return False, "no PAT/PMT", None
+        except Exception as e:
+            return False, f"read: {e}", None
+        finally:
+            response.close()
+    
+    @staticmethod
+    def _find_sync(data):
+        """Offset of the first of three consecutive 0x47 packet starts."""
+        for offset in range(min(188, len(data) - 376)):
+            if data[offset] == 0x47 and data[offset + 188] == 0x47 and data[offset + 376] == 0x47:
+                return offset
+        return None
+    
+    def _parse_ts(self, data):
+        """PMT streams once PAT and a PMT were seen, False on lost sync, None if more data is needed."""
+        offset = self._find_sync(data)
+        if offset is None:
+            return None if len(data) < 188 * 4 else False
+        pmt_pids = set()
+        for pos in range(offset, len(data) - 187, 188):
+            if data[pos] != 0x47:
+                return False
+            pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+            if not data[pos + 1] & 0x40:
+                continue  # Tables only need their first packet
+            adaptation = (data[pos + 3] >> 4) & 0x3
+            start = pos + 4
+            if adaptation in (2, 3):
+                start += 1 + data[start]
+            if adaptation == 2 or start >= pos + 188:
+                continue
+            section = start + 1 + data[start]  # Skip pointer field
+            if section + 8 > pos + 188:
+                continue
+            table_id = data[section]
+            if pid == 0 and table_id == 0x00:
+                length = ((data[section + 1] & 0x0F) << 8) | data[section + 2]
+                end = min(section + 3 + length - 4, pos + 188)
+                for entry in range(section + 8, end - 3, 4):
+                    program = (data[entry] << 8) | data[entry + 1]
+                    if program:
+                        pmt_pids.add(((data[entry + 2] & 0x1F) << 8) | data[entry + 3])
+            elif pid in pmt_pids and table_id == 0x02:
+                return self._pmt_streams(data, section, pos + 188)
+        return None
+    
+    @staticmethod
+    def _pmt_streams(data, section, limit):
+        """[(stream_type, pid, descriptor tags)] from the part of a PMT section in this packet."""
+        if section + 12 > limit:
+            return []
+        length = ((data[section + 1] & 0x0F) << 8) | data[section + 2]
+        end = min(section + 3 + length - 4, limit)  # Without CRC
+        entry = section + 12 + (((data[section + 10] & 0x0F) << 8) | data[section + 11])
+        streams = []
+        while entry + 5 <= end:
+            info_end = min(entry + 5 + (((data[entry + 3] & 0x0F) << 8) | data[entry + 4]), end)
+            tags = []
+            descriptor = entry + 5
+            while descriptor + 2 <= info_end:
+                tags.append(data[descriptor])
+                descriptor += 2 + data[descriptor + 1]
+            streams.append((data[entry], ((data[entry + 1] & 0x1F) << 8) | data[entry + 2], tags))
+            entry = info_end
+        return streams
+    
+    def get_stats(self):
+        with self.lock:
+            unhealthy = [
+                dict(stats, portal=key[0], channel=key[1])
+                for key, stats in self.health.items()
+                if stats["failures"]
+            ]
+            return {
+                "ttl": self.ttl,
+                "channels": len(self.health),
+                "cached": sum(1 for passed_at in self.passed.values() if time.time() - passed_at < self.ttl),
+                "probes": sum(stats["probes"] for stats in self.health.values()),
+                "cache_hits": sum(stats["cache_hits"] for stats in self.health.values()),
+                "failures": sum(stats["failures"] for stats in self.health.values()),
+                "unhealthy": sorted(unhealthy, key=lambda stats: -stats["failures"])[:50],
+            }
+
+
+stream_probes = StreamProbe()
+
+
+class SourceCodecCache:
+    """Source codecs per channel / VOD item, so ffmpeg can copy audio instead of encoding AAC.
+    
+    Filled for free from the PMT StreamProbe already parses and from ffmpeg's
+    own input dump; a source nobody has seen yet is encoded once. Tracks the
+    CPU time of copy vs encode processes to report what copying saves.
+    """
+    
+    TTL = 6 * 3600
+    # MPEG-TS PMT stream_type -> (kind, codec)
+    TS_STREAM_TYPES = {
+        0x01: ("video", "mpeg1video"), 0x02: ("video", "mpeg2video"),
+        0x1B: ("video", "h264"), 0x24: ("video", "hevc"),
+        0x03: ("audio", "mp2"), 0x04: ("audio", "mp2"),
+        0x0F: ("audio", "aac"), 0x11: ("audio", "aac_latm"),
+        0x81: ("audio", "ac3"), 0x87: ("audio", "eac3"),
+        0x82: ("audio", "dts"), 0x85: ("audio", "dts"), 0x8A: ("audio", "dts"),
+    }
+    # DVB descriptors marking audio in private PES (stream_type 0x06)
+    TS_AUDIO_DESCRIPTORS = {0x6A: "ac3", 0x7A: "eac3", 0x7B: "dts"}
+    # Audio each output may carry unchanged - browsers (hls.js/MSE) can't decode AC-3
+    COPY_AUDIO = {
+        "hls": {"aac", "mp3"},
+        "mpegts": {"aac", "mp3", "mp2", "ac3", "eac3"},
+    }
+    INPUT_STREAM = re.compile(r"^\s*Stream #0:\d+\S*: (Audio|Video): (\w+)")
+    
+    def __init__(self):
+        self.entries = {}  # key -> {"audio": [...], "video": [...], "source": str, "time": ts}
+        self.usage = {}  # "copy"/"encode" -> CPU and wall seconds of finished processes
+        self.enabled = True
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry["time"] < self.TTL:
+                return entry
+            return None
+    
+    def put(self, key, audio, video, source):
+        with self.lock:
+            self.entries[key] = {"audio": audio, "video": video, "source": source, "time": time.time()}
+        logger.debug(f"Source codecs {key}: audio={audio} video={video} ({source})")
+    
+    def put_pmt(self, key, streams):
+        """Record codecs from PMT entries [(stream_type, pid, descriptor tags)]."""
+        audio, video = [], []
+        for stream_type, _, tags in streams:
+            kind, codec = self.TS_STREAM_TYPES.get(stream_type, (None, None))
+            if stream_type == 0x06:
+                codec = next((self.TS_AUDIO_DESCRIPTORS[tag] for tag in tags if tag in self.TS_AUDIO_DESCRIPTORS), None)
+                kind = "audio" if codec else None  # Otherwise teletext/subtitles
+            if kind == "audio":
+                audio.append(codec)
+            elif kind == "video":
+                video.append(codec)
+        self.put(key, audio, video, "pmt")
+    
+    def watch_stderr(self, key, state, line):
+        """Feed one ffmpeg stderr line; records the codecs once the "Input #0" dump ends."""
+        if line.startswith("Input #0"):
+            state["streams"] = []
+        elif "streams" in state and not state.get("done"):
+            match = self.INPUT_STREAM.match(line)
+            if match:
+                state["streams"].append((match.group(1), match.group(2)))
+            elif line.startswith(("Output #", "Stream mapping")):
+                state["done"] = True
+                self.put(key,
+                         [codec for kind, codec in state["streams"] if kind == "Audio"],
+                         [codec for kind, codec in state["streams"] if kind == "Video"],
+                         "ffmpeg")
+    
+    def audio_plan(self, key, output):
+        """("copy"|"encode", reason) for the source's audio in an "hls"/"mpegts" output."""
+        if not self.enabled:
+            return "encode", "audio copy disabled"
+        entry = self.get(key)
+        if not entry:
+            return "encode", "codecs unknown"
+        incompatible = sorted(set(codec for codec in entry["audio"] if codec not in self.COPY_AUDIO[output]))
+        if incompatible:
+            return "encode", f"{','.join(incompatible)} not allowed in {output}"
+        return "copy", ",".join(entry["audio"]) or "no audio"
+    
+    @staticmethod
+    def process_cpu_seconds(pid):
+        """User+system CPU seconds of a running child process (Linux /proc), None elsewhere."""
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None
+    
+    def record_usage(self, path, cpu_seconds, wall_seconds):
+        if cpu_seconds is None or wall_seconds <= 0:
+            return
+        with self.lock:
+            usage = self.usage.setdefault(path, {"streams": 0, "cpu_seconds": 0.0, "wall_seconds": 0.0})
+            usage["streams"] += 1
+            usage["cpu_seconds"] += cpu_seconds
+            usage["wall_seconds"] += wall_seconds
+    
+    def cpu_percent(self, path):
+        """Average CPU share of one finished process on this path, None without data."""
+        usage = self.usage.get(path)
+        if not usage or not usage["wall_seconds"]:
+            return None
+        return round(usage["cpu_seconds"] / usage["wall_seconds"] * 100, 1)
+    
+    def get_stats(self):
+        with self.lock:
+            usage = {path: dict(stats, cpu_percent=self.cpu_percent(path)) for path, stats in self.usage.items()}
+            copy, encode = usage.get("copy"), usage.get("encode")
+            saved = None
+            if copy and encode and copy["cpu_percent"] is not None and encode["cpu_percent"] is not None:
+                saved = round(copy["wall_seconds"] * max(0, encode["cpu_percent"] - copy["cpu_percent"]) / 100, 1)
+            return {
+                "enabled": self.enabled,
+                "sources": len(self.entries),
+                "usage": usage,
+                "estimated_cpu_seconds_saved": saved,
+            }
+
+
+source_codecs = SourceCodecCache()
+
+
+class HLSSegmentStore:
+    """Bounded in-memory playlists and segments of one HLS stream.
+    
+    ffmpeg PUTs its output to /hls-ingest/<token>/ and readers block on the
+    store's own condition until a file arrives, so serving a stream never
+    touches the disk and never takes the manager's global lock.
+    """
+    
+    def __init__(self, max_segments=10):
+        self.max_segments = max_segments
+        self.cond = threading.Condition()
+        self.files = {}  # name -> bytes
+        self.segments = deque()  # Segment names, oldest first
+        self.bytes = 0
+        self.closed = False
+    
+    def put(self, name, data):
+        with self.cond:
+            old = self.files.get(name)
+            if old is not None:
+                self.bytes -= len(old)
+            elif not name.endswith((".m3u8", ".mp4")):
+                self.segments.append(name)
+            self.files[name] = data
+            self.bytes += len(data)
+            while len(self.segments) > self.max_segments:
+                self._delete(self.segments.popleft())
+            self.cond.notify_all()
+    
+    def delete(self, name):
+        with self.cond:
+            if name in self.segments:
+                self.segments.remove(name)
+            self._delete(name)
+    
+    def _delete(self, name):
+        data = self.files.pop(name, None)
+        if data is not None:
+            self.bytes -= len(data)
+    
+    def get(self, name, timeout=0):
+        """File contents, waiting up to timeout seconds for it to arrive."""
+        with self.cond:
+            if timeout:
+                self.cond.wait_for(lambda: name in self.files or self.closed, timeout)
+            return self.files.get(name)
+    
+    def get_when(self, name, ready, timeout):
+        """File contents once ready(contents) holds, or the latest version after timeout."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or (name in self.files and ready(self.files[name])), timeout)
+            return self.files.get(name)
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.files.clear()
+            self.segments.clear()
+            self.bytes = 0
+            self.cond.notify_all()
+
+
+class HLSStreamManager:
+    """Manages HLS streams with shared access and automatic cleanup."""
+    
+    # Keys of ffmpeg's -progress blocks (stream_N_M_q is matched by prefix)
+    PROGRESS_KEYS = {"frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms",
+                     "out_time", "dup_frames", "drop_frames", "speed", "progress"}
+    MAX_RESTARTS = 3  # Stall restarts per stream before it is stopped
+    STALL_SPEED = 0.95  # Measured realtime factor below which the encoder counts as stalled
+    SPEED_WINDOW = 5  # Seconds of media/wall time compared per speed sample
+    PROFILES = ("standard", "low-latency")
+    LL_SEGMENT_DURATION = "1"  # Low-latency target duration (cut at the next keyframe)
+    LL_INIT_TIME = "0.5"  # Shorter first segment so the first playlist appears sooner
+    LL_PROBE = "500000"  # probesize (bytes) / analyzeduration (us) for faster startup
+    
+    def __init__(self, max_streams=10, inactive_timeout=30):
+        self.streams = {}  # Key: "portalId_channelId", Value: stream info dict
+        self.ingest = {}  # Ingest token -> HLSSegmentStore (memory storage)
+        self.ttff_samples = {}  # Profile -> deque of time-to-first-segment seconds
+        self.max_streams = max_streams
+        self.inactive_timeout = inactive_timeout
+        self.lock = threading.Lock()
+        self.monitor_thread = None
+        self.running = False
+        logger.info(f"HLS Stream Manager initialized with max_streams={max_streams}, inactive_timeout={inactive_timeout}s")
+        
+    def start_monitoring(self):
+        """Start the background monitoring thread."""
+        if not self.running:
+            self.running = True
+            self.monitor_thread = threading.Thread(target=self._monitor_loop, daemon=True)
+            self.monitor_thread.start()
+            logger.info("HLS Stream Manager monitoring started")
+    
+    def _monitor_loop(self):
+        """Background thread that monitors and cleans up inactive streams."""
+        while self.running:
+            try:
+                time.sleep(10)  # Check every 10 seconds
+                self._cleanup_inactive_streams()
+            except Exception as e:
+                logger.error(f"Error in HLS monitor loop: {e}")
+    
+    def _spawn_ffmpeg(self, ffmpeg_cmd):
+        return subprocess.Popen(
+            ffmpeg_cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+    
+    def _start_stderr_reader(self, stream_key, stream_info):
+        threading.Thread(
+            target=self._read_stderr,
+            args=(stream_key, stream_info, stream_info['process']),
+            daemon=True,
+            name=f"hls-stderr-{stream_key}",
+        ).start()
+    
+    def _read_stderr(self, stream_key, stream_info, process):
+        """Drain ffmpeg's stderr so it never blocks on a full pipe; parse -progress blocks."""
+        block = {}
+        input_dump = {}
+        try:
+            for line in process.stderr:
+                source_codecs.watch_stderr(stream_info['codec_key'], input_dump, line)
+                stb.invalidateLinkFromLog(stream_info['stream_url'], line)
+                line = line.strip()
+                key, sep, value = line.partition("=")
+                if sep and (key in self.PROGRESS_KEYS or key.startswith("stream_")):
+                    block[key] = value.strip()
+                    if key == "progress":
+                        if stream_info.get('process') is process:
+                            self._record_progress(stream_info, block)
+                        block = {}
+                elif line:
+                    stream_info['log'].append(line)
+        except Exception as e:
+            logger.debug(f"FFmpeg stderr reader for {stream_key} stopped: {e}")
+    
+    @staticmethod
+    def _to_float(value):
+        try:
+            return float(str(value).replace("kbits/s", "").rstrip("x"))
+        except ValueError:
+            return None  # "N/A" while ffmpeg is still probing
+    
+    def _record_progress(self, stream_info, block):
+        now = time.time()
+        speed = self._to_float(block.get("speed", "N/A"))
+        out_time_us = self._to_float(block.get("out_time_us", "N/A"))
+        rate = stream_info.get('progress', {}).get("rate")
+        
+        # ffmpeg's speed is cumulative since start (startup delay keeps it below 1.0
+        # forever on live input), so compare media time against wall time per window
+        sample = stream_info.get('speed_sample')
+        if out_time_us is not None:
+            if not sample:
+                stream_info['speed_sample'] = (now, out_time_us)
+            elif now - sample[0] >= self.SPEED_WINDOW:
+                rate = round((out_time_us - sample[1]) / 1000000 / (now - sample[0]), 3)
+                stream_info['speed_sample'] = (now, out_time_us)
+                if rate < self.STALL_SPEED:
+                    if stream_info.get('stalled_since') is None:
+                        stream_info['stalled_since'] = sample[0]
+                else:
+                    stream_info['stalled_since'] = None
+        
+        stream_info['progress'] = {
+            "frame": int(self._to_float(block.get("frame", "0")) or 0),
+            "fps": self._to_float(block.get("fps", "N/A")),
+            "bitrate_kbps": self._to_float(block.get("bitrate", "N/A")),
+            "speed": speed,
+            "rate": rate,
+            "drop_frames": int(self._to_float(block.get("drop_frames", "0")) or 0),
+            "dup_frames": int(self._to_float(block.get("dup_frames", "0")) or 0),
+            "out_time": block.get("out_time"),
+        }
+        stream_info['last_progress'] = now
+    
+    def _stalled_for(self, stream_info, now):
+        """Seconds the encoder has run below realtime or reported no progress at all."""
+        stalled_since = stream_info.get('stalled_since')
+        slow = now - stalled_since if stalled_since else 0
+        silent = now - stream_info.get('last_progress', now)
+        return max(slow, silent)
+    
+    def _restart_stream(self, stream_key):
+        """Replace a stalled ffmpeg process, keeping the stream's storage and MAC slot."""
+        stream_info = self.streams.get(stream_key)
+        if not stream_info:
+            return
+        if stream_info.get('restarts', 0) >= self.MAX_RESTARTS:
+            logger.error(f"HLS stream {stream_key} still stalled after {self.MAX_RESTARTS} restarts - stopping")
+            self._stop_stream(stream_key)
+            return
+        
+        with self.lock:
+            # Only signal here - reaping happens below, outside the manager-wide lock
+            old_process = stream_info['process']
+            try:
+                old_process.kill()
+            except Exception as e:
+                logger.debug(f"Error killing stalled FFmpeg for {stream_key}: {e}")
+            
+            # Continue the media sequence above the old one so players keep going
+            ffmpeg_cmd = list(stream_info['ffmpeg_cmd'])
+            ffmpeg_cmd[ffmpeg_cmd.index("-start_number") + 1] = str(int(time.time()))
+            stream_info['process'] = self._spawn_ffmpeg(ffmpeg_cmd)
+            stream_info['process_started'] = time.time()
+            stream_info['restarts'] = stream_info.get('restarts', 0) + 1
+            stream_info['stalled_since'] = None
+            stream_info['speed_sample'] = None
+            stream_info['last_progress'] = time.time()
+            stream_info['progress'] = {}
+            self._start_stderr_reader(stream_key, stream_info)
+        try:
+            old_process.wait(timeout=5)
+        except Exception as e:
+            logger.debug(f"Stalled FFmpeg for {stream_key} did not exit: {e}")
+        logger.warning(f"Restarted stalled FFmpeg for HLS stream {stream_key} (restart {stream_info['restarts']}/{self.MAX_RESTARTS})")
+    
+    def get_stream_metrics(self):
+        """Live per-stream encoder metrics for the dashboard."""
+        now = time.time()
+        metrics = []
+        encode_percent = source_codecs.cpu_percent("encode")
+        for stream_key, stream_info in list(self.streams.items()):
+            if stream_info.get('is_passthrough'):
+                metrics.append({"stream": stream_key, "passthrough": True, "profile": stream_info.get('profile')})
+                continue
+            log = stream_info.get('log') or ()
+            cpu_seconds = source_codecs.process_cpu_seconds(stream_info['process'].pid)
+            cpu_percent = None
+            if cpu_seconds is not None and now > stream_info['process_started']:
+                cpu_percent = round(cpu_seconds / (now - stream_info['process_started']) * 100, 1)
+            cpu_saved = None
+            if stream_info['audio'] == "copy" and cpu_percent is not None and encode_percent is not None:
+                cpu_saved = round(max(0, encode_percent - cpu_percent), 1)
+            metrics.append(dict(
+                stream_info.get('progress') or {},
+                stream=stream_key,
+                passthrough=False,
+                profile=stream_info.get('profile'),
+                ttff=stream_info.get('ttff'),
+                audio=stream_info['audio'],
+                audio_reason=stream_info['audio_reason'],
+                cpu_percent=cpu_percent,
+                cpu_saved_percent=cpu_saved,
+                restarts=stream_info.get('restarts', 0),
+                stalled_seconds=round(self._stalled_for(stream_info, now), 1),
+                last_message=log[-1] if log else None,
+            ))
+        return metrics
     
     def _cleanup_inactive_streams(self):
-        """Clean up streams that have been inactive or crashed."""
+        """Clean up streams that have been inactive or crashed, restart stalled encoders."""
         current_time = time.time()
         streams_to_remove = []
+        streams_to_restart = []
+        try:
+            stall_limit = int(getSettings().get("hls stall restart", "20"))
+        except ValueError:
+            stall_limit = 20
         
         with self.lock:
             for stream_key, stream_info in self.streams.items():
@@ -1045,6 +3217,10 @@ class HLSStreamManager:
                         logger.error(f"Error checking process status for {stream_key}: {e}")
                         streams_to_remove.append(stream_key)
                         continue
+                    
+                    # Encoder running below realtime (or silent) for too long
+                    if stall_limit and self._stalled_for(stream_info, current_time) > stall_limit:
+                        streams_to_restart.append(stream_key)
                 
                 # Check if stream is inactive
                 inactive_time = current_time - stream_info['last_accessed']
@@ -1059,6 +3235,14 @@ class HLSStreamManager:
                 self._stop_stream(stream_key)
             except Exception as e:
                 logger.error(f"Error stopping stream {stream_key}: {e}")
+        
+        for stream_key in streams_to_restart:
+            if stream_key in streams_to_remove:
+                continue
+            try:
+                self._restart_stream(stream_key)
+            except Exception as e:
+                logger.error(f"Error restarting stream {stream_key}: {e}")
     
     def _stop_stream(self, stream_key):
         """Stop a stream and clean up its resources."""
@@ -1072,6 +3256,11 @@ class HLSStreamManager:
             
             # Terminate FFmpeg process (skip for passthrough streams)
             if not is_passthrough and stream_info.get('process'):
+                source_codecs.record_usage(
+                    stream_info['audio'],
+                    source_codecs.process_cpu_seconds(stream_info['process'].pid),
+                    time.time() - stream_info['process_started'],
+                )
                 try:
                     if stream_info['process'].poll() is None:
                         logger.debug(f"Terminating FFmpeg process for {stream_key}")
@@ -1090,6 +3279,11 @@ class HLSStreamManager:
                     except Exception as kill_error:
                         logger.error(f"Error killing FFmpeg process for {stream_key}: {kill_error}")
             
+            store = stream_info.get('store')
+            if store:
+                self.ingest.pop(stream_info.get('ingest_token'), None)
+                store.close()
+            
             # Clean up temp directory
             try:
                 temp_dir = stream_info.get('temp_dir')
@@ -1099,12 +3293,20 @@ class HLSStreamManager:
             except Exception as e:
                 logger.error(f"Error cleaning up temp dir for {stream_key}: {e}")
             
+            if stream_info.get('occupancy'):
+                stream_info['occupancy'].release()
+            
             # Remove from active streams
             del self.streams[stream_key]
             logger.info(f"Stream {stream_key} stopped and cleaned up")
     
-    def start_stream(self, portal_id, channel_id, stream_url, proxy=None):
-        """Start or reuse an HLS stream for a channel."""
+    def start_stream(self, portal_id, channel_id, stream_url, proxy=None, mac=None, occupancy_info=None, profile="standard", limit=0):
+        """Start or reuse an HLS stream for a channel.
+        
+        A new stream occupies one slot on mac until it is stopped, or is not
+        started (None) when mac already has limit streams. The profile only
+        applies when the stream is started; later viewers share it.
+        """
         import tempfile
         
         stream_key = f"{portal_id}_{channel_id}"
@@ -1121,20 +3323,40 @@ class HLSStreamManager:
                 logger.error(f"Max concurrent streams ({self.max_streams}) reached")
                 raise Exception(f"Maximum concurrent streams ({self.max_streams}) reached")
             
+            # Occupy the MAC before spawning anything (atomic against its limit)
+            handle = occupancy.acquire(portal_id, mac, occupancy_info or {}, limit) if mac else None
+            if mac and not handle:
+                logger.info(f"No free slot on MAC {mac} for HLS stream {stream_key}")
+                return None
+            
             # Get HLS settings
             settings = getSettings()
             segment_type = settings.get("hls segment type", "mpegts")
             segment_duration = settings.get("hls segment duration", "4")
             playlist_size = settings.get("hls playlist size", "6")
+            low_latency = profile == "low-latency"
+            if low_latency:
+                segment_duration = self.LL_SEGMENT_DURATION
             timeout = int(settings.get("ffmpeg timeout", "5")) * 1000000
             
             # Detect if source is already HLS
             is_source_hls = is_hls_url(stream_url)
             
-            # Create temp directory for HLS segments
-            temp_dir = tempfile.mkdtemp(prefix=f"MacReplayXC_hls_{stream_key}_")
-            playlist_path = os.path.join(temp_dir, "stream.m3u8")
-            master_playlist_path = os.path.join(temp_dir, "master.m3u8")
+            if settings.get("hls storage", "memory") == "memory":
+                # ffmpeg PUTs playlists/segments to the loopback ingest route
+                store = HLSSegmentStore(max_segments=int(playlist_size) + 4)
+                ingest_token = secrets.token_urlsafe(16)
+                temp_dir = None
+                ingest_base = f"http://127.0.0.1:{hls_ingest_port}/hls-ingest/{ingest_token}"
+                playlist_path = f"{ingest_base}/stream.m3u8"
+                master_playlist_path = None
+            else:
+                store = None
+                ingest_token = None
+                # Create temp directory for HLS segments
+                temp_dir = tempfile.mkdtemp(prefix=f"MacReplayXC_hls_{stream_key}_")
+                playlist_path = os.path.join(temp_dir, "stream.m3u8")
+                master_playlist_path = os.path.join(temp_dir, "master.m3u8")
             
             # If source is already HLS, create a passthrough
             if is_source_hls:
@@ -1149,31 +3371,46 @@ class HLSStreamManager:
                     'portal_id': portal_id,
                     'channel_id': channel_id,
                     'stream_url': stream_url,
-                    'is_passthrough': True
+                    'is_passthrough': True,
+                    'profile': profile,
+                    'started': time.time(),
+                    'ttff': None,
+                    'occupancy': handle,
+                    'store': store,
+                    'ingest_token': None,
                 }
                 
                 # Create master playlist that points to the source
-                with open(master_playlist_path, 'w') as f:
-                    f.write("#EXTM3U\n")
-                    f.write("#EXT-X-VERSION:7\n")
-                    f.write(f'#EXT-X-STREAM-INF:BANDWIDTH=15000000,CODECS="avc1.640028,mp4a.40.2"\n')
-                    f.write(stream_url + "\n")
+                master_playlist = (
+                    "#EXTM3U\n"
+                    "#EXT-X-VERSION:7\n"
+                    '#EXT-X-STREAM-INF:BANDWIDTH=15000000,CODECS="avc1.640028,mp4a.40.2"\n'
+                    f"{stream_url}\n"
+                )
+                if store:
+                    store.put("master.m3u8", master_playlist.encode())
+                else:
+                    with open(master_playlist_path, 'w') as f:
+                        f.write(master_playlist)
                 
                 self.streams[stream_key] = stream_info
                 logger.info(f"HLS passthrough ready for {stream_key}")
                 return stream_info
             
             # Set segment pattern based on segment type
+            segment_dir = ingest_base if store else temp_dir
             if segment_type == "fmp4":
-                segment_pattern = os.path.join(temp_dir, "seg_%03d.m4s")
+                segment_pattern = f"{segment_dir}/seg_%03d.m4s"
                 init_filename = "init.mp4"
             else:
-                segment_pattern = os.path.join(temp_dir, "seg_%03d.ts")
+                segment_pattern = f"{segment_dir}/seg_%03d.ts"
                 init_filename = None
             
             # Build FFmpeg command for HLS
             ffmpeg_cmd = [
                 "ffmpeg",
+                "-nostats",
+                "-progress", "pipe:2",  # key=value progress blocks, parsed by _read_stderr
                 "-fflags", "+genpts+igndts+nobuffer",
                 "-err_detect", "aggressive",
                 "-flags", "low_delay",
@@ -1188,16 +3425,23 @@ class HLSStreamManager:
             
             ffmpeg_cmd.extend(["-timeout", str(timeout)])
             
+            if low_latency:
+                ffmpeg_cmd.extend(["-probesize", self.LL_PROBE, "-analyzeduration", self.LL_PROBE])
+            
+            # Copy audio when the cached source codecs fit HLS, encode AAC otherwise
+            codec_key = ("live", portal_id, channel_id)
+            audio_path, audio_reason = source_codecs.audio_plan(codec_key, "hls")
             ffmpeg_cmd.extend([
                 "-i", stream_url,
                 "-map", "0",
                 "-c:v", "copy",
                 "-copyts",
                 "-start_at_zero",
-                "-c:a", "aac",
-                "-b:a", "256k",
-                "-af", "aresample=async=1"
             ])
+            if audio_path == "copy":
+                ffmpeg_cmd.extend(["-c:a", "copy"])
+            else:
+                ffmpeg_cmd.extend(["-c:a", "aac", "-b:a", "256k", "-af", "aresample=async=1"])
             
             hls_flags = "independent_segments+omit_endlist"
             
@@ -1211,31 +3455,31 @@ class HLSStreamManager:
             ffmpeg_cmd.extend([
                 "-f", "hls",
                 "-hls_time", segment_duration,
+            ])
+            if low_latency:
+                ffmpeg_cmd.extend(["-hls_init_time", self.LL_INIT_TIME])
+            ffmpeg_cmd.extend([
                 "-hls_list_size", playlist_size,
                 "-hls_flags", hls_flags,
                 "-hls_segment_type", segment_type,
                 "-hls_segment_filename", segment_pattern,
                 "-start_number", "0",
-                "-flush_packets", "0"
+                "-flush_packets", "1" if low_latency else "0"
             ])
             
             if segment_type == "fmp4":
                 ffmpeg_cmd.extend(["-hls_fmp4_init_filename", init_filename])
             
+            if store:
+                ffmpeg_cmd.extend(["-method", "PUT", "-http_persistent", "1"])
+            
             ffmpeg_cmd.append(playlist_path)
             
             # Start FFmpeg process
             try:
                 logger.info(f"Starting FFmpeg process for {stream_key}")
                 
-                process = subprocess.Popen(
-                    ffmpeg_cmd,
-                    stdin=subprocess.DEVNULL,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1
-                )
+                process = self._spawn_ffmpeg(ffmpeg_cmd)
                 
                 # Store stream info
                 stream_info = {
@@ -1247,51 +3491,180 @@ class HLSStreamManager:
                     'portal_id': portal_id,
                     'channel_id': channel_id,
                     'stream_url': stream_url,
-                    'is_passthrough': False
+                    'is_passthrough': False,
+                    'profile': profile,
+                    'segment_duration': float(segment_duration),
+                    'started': time.time(),
+                    'ttff': None,
+                    'occupancy': handle,
+                    'store': store,
+                    'ingest_token': ingest_token,
+                    'ffmpeg_cmd': ffmpeg_cmd,
+                    'codec_key': codec_key,
+                    'audio': audio_path,
+                    'audio_reason': audio_reason,
+                    'process_started': time.time(),
+                    'progress': {},
+                    'last_progress': time.time(),
+                    'stalled_since': None,
+                    'restarts': 0,
+                    'log': deque(maxlen=20),  # Last non-progress stderr lines
                 }
                 
                 self.streams[stream_key] = stream_info
-                logger.info(f"HLS stream started for {stream_key}")
+                if store:
+                    self.ingest[ingest_token] = store
+                self._start_stderr_reader(stream_key, stream_info)
+                logger.info(f"HLS stream started for {stream_key} ({profile} profile, audio {audio_path}: {audio_reason})")
                 return stream_info
                 
             except Exception as e:
                 logger.error(f"Error starting FFmpeg for {stream_key}: {e}")
+                if handle:
+                    handle.release()
                 # Clean up temp directory
                 try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    if temp_dir:
+                        shutil.rmtree(temp_dir, ignore_errors=True)
                 except:
                     pass
                 raise
     
     def get_file(self, portal_id, channel_id, filename):
-        """Get a file path for a stream."""
+        """Get a file path for a disk-backed stream."""
         stream_key = f"{portal_id}_{channel_id}"
         
-        with self.lock:
-            if stream_key not in self.streams:
-                return None
-            
-            stream_info = self.streams[stream_key]
+        # Plain dict read - no global lock on the per-request path
+        stream_info = self.streams.get(stream_key)
+        if not stream_info:
+            return None
+        stream_info['last_accessed'] = time.time()
+        
+        # Handle master playlist
+        if filename == "master.m3u8":
+            if os.path.exists(stream_info['master_playlist_path']):
+                return stream_info['master_playlist_path']
+            return None
+        
+        # Handle stream playlist
+        if filename == "stream.m3u8":
+            if os.path.exists(stream_info['playlist_path']):
+                return stream_info['playlist_path']
+            return None
+        
+        # Handle segments
+        file_path = os.path.join(stream_info['temp_dir'], filename)
+        if os.path.exists(file_path):
+            return file_path
+        
+        return None
+    
+    def fetch(self, portal_id, channel_id, filename, timeout=0, msn=None):
+        """Return (data, file_path) for a stream file, waiting up to timeout seconds.
+        
+        Memory streams return the bytes and wake as soon as ffmpeg delivers the
+        file; disk streams return a path and fall back to polling. With msn set
+        a playlist request blocks until it lists that media sequence number
+        (LL-HLS blocking playlist reload).
+        """
+        stream_info = self.streams.get(f"{portal_id}_{channel_id}")
+        if not stream_info:
+            return None, None
+        store = stream_info.get('store')
+        if store:
             stream_info['last_accessed'] = time.time()
-            
-            # Handle master playlist
-            if filename == "master.m3u8":
-                if os.path.exists(stream_info['master_playlist_path']):
-                    return stream_info['master_playlist_path']
-                return None
-            
-            # Handle stream playlist
-            if filename == "stream.m3u8":
-                if os.path.exists(stream_info['playlist_path']):
-                    return stream_info['playlist_path']
-                return None
-            
-            # Handle segments
-            file_path = os.path.join(stream_info['temp_dir'], filename)
-            if os.path.exists(file_path):
-                return file_path
-            
+            if msn is not None:
+                return store.get_when(filename, lambda data: self._last_msn(data) >= msn, timeout), None
+            return store.get(filename, timeout), None
+        
+        deadline = time.time() + timeout
+        while True:
+            file_path = self.get_file(portal_id, channel_id, filename)
+            if file_path and msn is not None and time.time() < deadline:
+                try:
+                    with open(file_path, 'rb') as f:
+                        if self._last_msn(f.read()) < msn:
+                            file_path = None
+                except OSError:
+                    file_path = None
+            if file_path or time.time() >= deadline:
+                return None, file_path
+            time.sleep(0.1)
+    
+    def published_msn(self, portal_id, channel_id, filename):
+        """Newest media sequence number in a stream's current playlist, None if not written yet."""
+        stream_info = self.streams.get(f"{portal_id}_{channel_id}")
+        if not stream_info:
             return None
+        store = stream_info.get('store')
+        if store:
+            playlist = store.get(filename)
+        else:
+            file_path = self.get_file(portal_id, channel_id, filename)
+            try:
+                with open(file_path, 'rb') as f:
+                    playlist = f.read()
+            except (OSError, TypeError):
+                playlist = None
+        return self._last_msn(playlist) if playlist is not None else None
+    
+    @staticmethod
+    def _last_msn(playlist):
+        """Media sequence number of the newest segment in a playlist, -1 if none."""
+        sequence = 0
+        count = 0
+        for line in playlist.decode(errors="ignore").splitlines():
+            if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                try:
+                    sequence = int(line.split(":", 1)[1])
+                except ValueError:
+                    pass
+            elif line.startswith("#EXTINF"):
+                count += 1
+        return sequence + count - 1
+    
+    @staticmethod
+    def low_latency_playlist(playlist):
+        """Advertise blocking playlist reload (_HLS_msn) in an ffmpeg playlist.
+        
+        ffmpeg's hls muxer writes no partial segments, so there are no
+        EXT-X-PART / PART-INF tags and no preload hint - a PRELOAD-HINT of
+        TYPE=PART without them is invalid and strict players reject it.
+        """
+        lines = playlist.decode(errors="ignore").rstrip("\n").split("\n")
+        for i, line in enumerate(lines):
+            if line.startswith("#EXT-X-TARGETDURATION:"):
+                try:
+                    target = int(line.split(":", 1)[1])
+                except ValueError:
+                    target = 1
+                lines.insert(i + 1, f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,HOLD-BACK={target * 3:.1f}")
+                break
+        return ("\n".join(lines) + "\n").encode()
+    
+    def record_first_segment(self, stream_info):
+        """Record time-to-first-segment (start request to first segment served)."""
+        if stream_info.get('ttff') is not None or not stream_info.get('started'):
+            return
+        ttff = round(time.time() - stream_info['started'], 2)
+        stream_info['ttff'] = ttff
+        profile = stream_info.get('profile', 'standard')
+        self.ttff_samples.setdefault(profile, deque(maxlen=50)).append(ttff)
+        logger.info(f"HLS stream {stream_info['portal_id']}_{stream_info['channel_id']} first segment after {ttff}s ({profile})")
+    
+    def get_ttff_stats(self):
+        """Average/last time-to-first-segment per profile."""
+        return {
+            profile: {
+                "samples": len(samples),
+                "avg_seconds": round(sum(samples) / len(samples), 2),
+                "last_seconds": samples[-1],
+            }
+            for profile, samples in list(self.ttff_samples.items()) if samples
+        }
+    
+    def memory_bytes(self):
+        return sum(store.bytes for store in list(self.ingest.values()))
 
 
 def loadConfig():
@@ -1336,11 +3709,18 @@ def loadConfig():
 
     data["portals"] = portalsOut
 
+    # Seed stb with the handshake hints learned in previous runs
+    for portal in portalsOut.values():
+        stb.loadPortalHints(portal["url"], portal["handshake hints"])
+
     with open(configFile, "w") as f:
         json.dump(data, f, indent=4)
 
     return data
 
+# Serialises config.json writes (refresh workers, stream threads and requests save concurrently)
+config_save_lock = threading.RLock()
+
 def getPortals():
     global config
     if not config:
@@ -1349,7 +3729,7 @@ def getPortals():
 
 def savePortals(portals):
     try:
-        with open(configFile, "w") as f:
+        with config_save_lock, open(configFile, "w") as f:
             config["portals"] = portals
             json.dump(config, f, indent=4)
         logger.debug(f"Portals saved to {configFile}")
@@ -1361,6 +3741,22 @@ def savePortals(portals):
         logger.error(f"Error saving portals: {e}")
         raise
 
+def persist_portal_hints(url, hints):
+    """Store handshake hints learned by stb with every portal using this URL."""
+    with config_save_lock:
+        portals = getPortals()
+        changed = False
+        for portal in portals.values():
+            if portal.get("url") == url and portal.get("handshake hints") != hints:
+                portal["handshake hints"] = hints
+                changed = True
+        if changed:
+            savePortals(portals)
+    if changed:
+        logger.debug(f"Saved handshake hints for {url}: {hints}")
+
+stb.setPortalHintsListener(persist_portal_hints)
+
 def getSettings():
     global config
     if not config:
@@ -1369,7 +3765,7 @@ def getSettings():
 
 def saveSettings(settings):
     try:
-        with open(configFile, "w") as f:
+        with config_save_lock, open(configFile, "w") as f:
             config["settings"] = settings
             json.dump(config, f, indent=4)
         logger.debug(f"Settings saved to {configFile}")
@@ -1578,32 +3974,121 @@ def refresh_channels_cache_with_progress():
         editor_refresh_progress["running"] = False
         editor_refresh_progress["current_step"] = "Completed"
 
+def _refresh_worker_status(status, mac_done=False):
+    """Record what the current refresh worker is doing (shown in editor progress)."""
+    with editor_refresh_lock:
+        workers = editor_refresh_progress.setdefault("workers", {})
+        if status:
+            workers[threading.current_thread().name] = status
+        else:
+            workers.pop(threading.current_thread().name, None)
+        if mac_done:
+            editor_refresh_progress["macs_done"] = editor_refresh_progress.get("macs_done", 0) + 1
+
+
+def _fetch_mac_channels(portal_name, url, mac, proxy, mac_label, portal_slots):
+    """Fetch channels, genres and EPG from one MAC (runs in a refresh worker)."""
+    result = {"channels": None, "genres": None, "epg": None}
+    
+    # Per-portal cap: never hit a single portal with more than N MACs at once
+    with portal_slots:
+        try:
+            logger.info(f"Trying MAC: {mac}")
+            _refresh_worker_status(f"{portal_name}: MAC {mac_label} - token")
+            token = stb.getSessionToken(url, mac, proxy)
+            if not token:
+                return result
+            
+            _refresh_worker_status(f"{portal_name}: MAC {mac_label} - channels")
+            result["channels"] = stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
+            _refresh_worker_status(f"{portal_name}: MAC {mac_label} - genres")
+            result["genres"] = stb.callWithSession(stb.getGenreNames, url, mac, proxy=proxy)
+            
+            if result["channels"]:
+                logger.info(f"MAC {mac}: Got {len(result['channels'])} channels")
+                # EPG im selben Durchlauf holen (nur für has_portal_epg)
+                _refresh_worker_status(f"{portal_name}: MAC {mac_label} - EPG")
+                try:
+                    result["epg"] = stb.callWithSession(stb.getEpg, url, mac, 24, proxy=proxy)
+                except Exception as e:
+                    logger.error(f"Error fetching EPG from MAC {mac}: {e}")
+        except Exception as e:
+            logger.error(f"Error fetching from MAC {mac}: {e}")
+        finally:
+            _refresh_worker_status(None, mac_done=True)
+    
+    return result
+
+
 def refresh_channels_cache():
-    """Refresh the channels cache from STB portals - fetches from ALL MACs."""
+    """Refresh the channels cache from STB portals - fetches from ALL MACs.
+    
+    Portals and MACs are fetched on a bounded worker pool ("refresh workers"),
+    with at most "refresh workers per portal" MACs of one portal in flight.
+    Results are merged in config order, so the outcome is deterministic.
+    """
     global editor_refresh_progress
     
     logger.info("Starting channel cache refresh...")
     editor_refresh_progress["current_step"] = "Loading portals..."
     
     portals = getPortals()
+    settings = getSettings()
+    try:
+        max_workers = max(1, int(settings.get("refresh workers", "8")))
+    except ValueError:
+        max_workers = 8
+    try:
+        per_portal = max(1, int(settings.get("refresh workers per portal", "3")))
+    except ValueError:
+        per_portal = 3
+    
+    enabled_portals = [
+        (portal_id, portals[portal_id]) for portal_id in portals
+        if portals[portal_id]["enabled"] == "true"
+    ]
+    
+    editor_refresh_progress["workers"] = {}
+    editor_refresh_progress["macs_done"] = 0
+    editor_refresh_progress["macs_total"] = sum(len(portal["macs"]) for _, portal in enabled_portals)
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
     total_channels = 0
     portal_index = 0
     
-    for portal_id in portals:
-        portal = portals[portal_id]
-        if portal["enabled"] == "true":
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="refresh") as executor:
+        portal_jobs = []
+        for portal_id, portal in enabled_portals:
+            macs = list(portal["macs"].keys())
+            logger.info(f"Fetching channels for portal: {portal['name']} from {len(macs)} MACs")
+            portal_jobs.append((portal_id, portal, macs, []))
+        
+        # Submit MACs round-robin across portals so workers don't pile up
+        # behind one portal's concurrency cap
+        portal_slots = [threading.BoundedSemaphore(per_portal) for _ in portal_jobs]
+        max_macs = max((len(macs) for _, _, macs, _ in portal_jobs), default=0)
+        for mac_index in range(max_macs):
+            for (portal_id, portal, macs, futures), slots in zip(portal_jobs, portal_slots):
+                if mac_index < len(macs):
+                    futures.append(executor.submit(
+                        _fetch_mac_channels, portal["name"], portal["url"], macs[mac_index],
+                        portal["proxy"], f"{mac_index + 1}/{len(macs)}", slots
+                    ))
+        
+        editor_refresh_progress["current_step"] = (
+            f"Fetching {editor_refresh_progress['macs_total']} MAC(s) from {len(enabled_portals)} portal(s) "
+            f"with {max_workers} worker(s)"
+        )
+        
+        # Merge + save portal by portal in config order (DB writes stay on this thread)
+        for portal_id, portal, macs, futures in portal_jobs:
             portal_index += 1
             portal_name = portal["name"]
-            url = portal["url"]
-            macs = list(portal["macs"].keys())
-            proxy = portal["proxy"]
             
             # Update progress
             editor_refresh_progress["current_portal"] = portal_name
-            editor_refresh_progress["current_step"] = f"Starting {portal_name}..."
             editor_refresh_progress["portals_done"] = portal_index - 1
             
             # Get existing settings from JSON config for migration
@@ -1614,93 +4099,78 @@ def refresh_channels_cache():
             custom_epg_ids = portal.get("custom epg ids", {})
             fallback_channels = portal.get("fallback channels", {})
             
-            logger.info(f"Fetching channels for portal: {portal_name} from {len(macs)} MACs")
-            editor_refresh_progress["current_step"] = f"{portal_name}: Found {len(macs)} MAC(s)"
-            
-            # Fetch from ALL MACs and merge
+            # Merge results from ALL MACs in MAC order (first MAC wins per channel)
             all_channels_map = {}  # channel_id -> channel data
             all_genres_dict = {}  # genre_id -> genre_name
-            
-            mac_index = 0
-            for mac in macs:
-                mac_index += 1
-                logger.info(f"Trying MAC: {mac}")
-                editor_refresh_progress["current_step"] = f"{portal_name}: Fetching from MAC {mac_index}/{len(macs)}"
-                try:
-                    token = stb.getToken(url, mac, proxy)
-                    if token:
-                        stb.getProfile(url, mac, token, proxy)
-                        editor_refresh_progress["current_step"] = f"{portal_name}: Getting channels from MAC {mac_index}/{len(macs)}"
-                        mac_channels = stb.getAllChannels(url, mac, token, proxy)
-                        editor_refresh_progress["current_step"] = f"{portal_name}: Getting genres from MAC {mac_index}/{len(macs)}"
-                        mac_genres = stb.getGenreNames(url, mac, token, proxy)
-                        
-                        if mac_channels:
-                            # Merge channels - add new ones
-                            for channel in mac_channels:
-                                channel_id = str(channel["id"])
-                                if channel_id not in all_channels_map:
-                                    all_channels_map[channel_id] = channel
-                            logger.info(f"MAC {mac}: Added {len(mac_channels)} channels (total: {len(all_channels_map)})")
-                            editor_refresh_progress["current_step"] = f"{portal_name}: MAC {mac_index}/{len(macs)} - {len(all_channels_map)} channels"
-                        
-                        if mac_genres:
-                            all_genres_dict.update(mac_genres)
-                            logger.info(f"MAC {mac}: Added genres (total: {len(all_genres_dict)})")
-                            editor_refresh_progress["current_step"] = f"{portal_name}: MAC {mac_index}/{len(macs)} - {len(all_genres_dict)} genres"
-                            
-                except Exception as e:
-                    logger.error(f"Error fetching from MAC {mac}: {e}")
-                    continue
+            merged_epg = {}
+            failed_macs = 0  # MACs without a channel list - their channels can't be told apart from removed ones
+            
+            for mac, future in zip(macs, futures):
+                mac_result = future.result()
+                mac_channels = mac_result["channels"]
+                mac_genres = mac_result["genres"]
+                mac_epg = mac_result["epg"]
+                
+                if not mac_channels:
+                    failed_macs += 1
+                else:
+                    # Merge channels - add new ones
+                    for channel in mac_channels:
+                        channel_id = str(channel["id"])
+                        if channel_id not in all_channels_map:
+                            all_channels_map[channel_id] = channel
+                    logger.info(f"MAC {mac}: Added {len(mac_channels)} channels (total: {len(all_channels_map)})")
+                
+                if mac_genres:
+                    all_genres_dict.update(mac_genres)
+                
+                if mac_epg:
+                    for ch_id, programmes in mac_epg.items():
+                        if ch_id not in merged_epg or len(programmes) > len(merged_epg.get(ch_id, [])):
+                            merged_epg[ch_id] = programmes
             
             if all_channels_map and all_genres_dict:
                 logger.info(f"Processing {len(all_channels_map)} total channels for {portal_name}")
-                editor_refresh_progress["current_step"] = f"{portal_name}: Checking EPG availability..."
-                
-                # Fetch EPG data from ALL MACs to check which channels have portal EPG
-                merged_epg = {}
-                epg_mac_index = 0
-                for mac in macs:
-                    epg_mac_index += 1
-                    try:
-                        editor_refresh_progress["current_step"] = f"{portal_name}: Checking EPG from MAC {epg_mac_index}/{len(macs)}"
-                        token = stb.getToken(url, mac, proxy)
-                        if token:
-                            stb.getProfile(url, mac, token, proxy)
-                            mac_epg = stb.getEpg(url, mac, token, 24, proxy)
-                            if mac_epg:
-                                for ch_id, programmes in mac_epg.items():
-                                    if ch_id not in merged_epg or len(programmes) > len(merged_epg.get(ch_id, [])):
-                                        merged_epg[ch_id] = programmes
-                    except Exception as e:
-                        logger.error(f"Error fetching EPG from MAC {mac}: {e}")
-                        continue
-                
                 logger.info(f"Portal {portal_name}: Got EPG for {len(merged_epg)} channels")
                 editor_refresh_progress["current_step"] = f"{portal_name}: Saving {len(all_channels_map)} channels to database..."
                 
+                # Set statt Liste: O(1) Lookup auch bei 50k Kanälen
+                enabled_set = set(enabled_channels)
+                
+                rows = []
                 for channel_id, channel in all_channels_map.items():
-                    channel_name = str(channel["name"])
-                    channel_number = str(channel["number"])
                     genre_id = str(channel.get("tv_genre_id", ""))
-                    genre = str(all_genres_dict.get(genre_id, ""))
-                    logo = str(channel.get("logo", ""))
-                    
-                    # Check if enabled (from JSON config)
-                    enabled = 1 if channel_id in enabled_channels else 0
-                    
-                    # Check if channel has portal EPG
-                    has_portal_epg = 1 if (channel_id in merged_epg and merged_epg[channel_id]) else 0
-                    
-                    # Get custom values (from JSON config)
-                    custom_name = custom_channel_names.get(channel_id, "")
-                    custom_number = custom_channel_numbers.get(channel_id, "")
-                    custom_genre = custom_genres.get(channel_id, "")
-                    custom_epg_id = custom_epg_ids.get(channel_id, "")
-                    fallback_channel = fallback_channels.get(channel_id, "")
-                    
-                    # Upsert into database
-                    cursor.execute('''
+                    rows.append((
+                        portal_id, channel_id, portal_name,
+                        str(channel["name"]),
+                        str(channel["number"]),
+                        str(all_genres_dict.get(genre_id, "")),
+                        str(channel.get("logo", "")),
+                        # Check if enabled (from JSON config)
+                        1 if channel_id in enabled_set else 0,
+                        # Get custom values (from JSON config)
+                        custom_channel_names.get(channel_id, ""),
+                        custom_channel_numbers.get(channel_id, ""),
+                        custom_genres.get(channel_id, ""),
+                        custom_epg_ids.get(channel_id, ""),
+                        fallback_channels.get(channel_id, ""),
+                        # Check if channel has portal EPG
+                        1 if merged_epg.get(channel_id) else 0,
+                    ))
+                
+                # Upsert + delete in one write transaction per portal
+                stale_ids = []
+                try:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    # Channels that disappeared from the portal - only when every MAC answered,
+                    # otherwise a failed fetch would delete the editor settings of its channels
+                    if failed_macs == 0:
+                        cursor.execute('SELECT channel_id FROM channels WHERE portal = ?', (portal_id,))
+                        stale_ids = [
+                            (portal_id, row[0]) for row in cursor.fetchall()
+                            if row[0] not in all_channels_map
+                        ]
+                    cursor.executemany('''
                         INSERT INTO channels (
                             portal, channel_id, portal_name, name, number, genre, logo,
                             enabled, custom_name, custom_number, custom_genre, 
@@ -1713,15 +4183,21 @@ def refresh_channels_cache():
                             genre = excluded.genre,
                             logo = excluded.logo,
                             has_portal_epg = excluded.has_portal_epg
-                    ''', (
-                        portal_id, channel_id, portal_name, channel_name, channel_number,
-                        genre, logo, enabled, custom_name, custom_number, custom_genre,
-                        custom_epg_id, fallback_channel, has_portal_epg
-                    ))
-                    
-                    total_channels += 1
+                    ''', rows)
+                    if stale_ids:
+                        cursor.executemany(
+                            'DELETE FROM channels WHERE portal = ? AND channel_id = ?', stale_ids
+                        )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
                 
-                conn.commit()
+                total_channels += len(rows)
+                if stale_ids:
+                    logger.info(f"Removed {len(stale_ids)} channels no longer offered by {portal_name}")
+                elif failed_macs:
+                    logger.info(f"{portal_name}: {failed_macs}/{len(macs)} MAC(s) returned no channels - keeping channels not seen this time")
                 logger.info(f"Successfully cached {len(all_channels_map)} channels for {portal_name}")
                 editor_refresh_progress["current_step"] = f"{portal_name}: Completed - {len(all_channels_map)} channels saved"
                 editor_refresh_progress["portals_done"] = portal_index
@@ -1732,6 +4208,7 @@ def refresh_channels_cache():
     
     conn.close()
     logger.info(f"Channel cache refresh complete. Total channels: {total_channels}")
+    editor_refresh_progress["workers"] = {}
     editor_refresh_progress["current_step"] = f"Completed! {total_channels} channels from {portal_index} portals"
     return total_channels
 
@@ -1748,7 +4225,7 @@ def getXCUsers():
 def saveXCUsers(users):
     """Save XC API users."""
     try:
-        with open(configFile, "w") as f:
+        with config_save_lock, open(configFile, "w") as f:
             config["xc_users"] = users
             json.dump(config, f, indent=4)
         logger.debug(f"XC users saved to {configFile}")
@@ -1965,13 +4442,17 @@ def xc_auth_optional(f):
     return decorated
 
 def moveMac(portalId, mac):
-    portals = getPortals()
-    macs = portals[portalId]["macs"]
-    x = macs[mac]
-    del macs[mac]
-    macs[mac] = x
-    portals[portalId]["macs"] = macs
-    savePortals(portals)
+    # Called from stream threads and MAC race workers at the same time
+    with config_save_lock:
+        portals = getPortals()
+        macs = portals[portalId]["macs"]
+        if mac not in macs:
+            return
+        x = macs[mac]
+        del macs[mac]
+        macs[mac] = x
+        portals[portalId]["macs"] = macs
+        savePortals(portals)
 
 @app.route("/data/<path:filename>", methods=["GET"])
 def block_data_access(filename):
@@ -2051,14 +4532,14 @@ def try_get_vod_link_with_fallback(url, macs, cmd, content_type, proxy, series_i
     
     for mac in macs:
         try:
-            token = stb.getToken(url, mac, proxy)
+            token = stb.getSessionToken(url, mac, proxy)
             if not token:
                 continue
             
             if content_type == 'series' and series_id:
-                link = stb.getSeriesLink(url, mac, token, cmd, series_id, season_id, episode_id, proxy)
+                link, _ = stb.getCachedLink(stb.getSeriesLink, url, mac, cmd, series_id, season_id, episode_id, proxy=proxy)
             else:
-                link = stb.getVodLink(url, mac, token, cmd, proxy)
+                link, _ = stb.getCachedLink(stb.getVodLink, url, mac, cmd, proxy=proxy)
             
             if link:
                 working_mac = mac
@@ -2359,7 +4840,7 @@ def vods_selection_save():
                             # Get or create token for this MAC
                             if mac not in mac_tokens:
                                 try:
-                                    token = stb.getToken(url, mac, proxy)
+                                    token = stb.getSessionToken(url, mac, proxy)
                                     if token:
                                         mac_tokens[mac] = token
                                         logger.info(f"Got token for MAC {mac[:15]}...")
@@ -2383,9 +4864,9 @@ def vods_selection_save():
                                 try:
                                     logger.debug(f"Fetching {content_type} items for category {category_id}, page {page}, MAC {mac[:15]}...")
                                     if content_type == 'series':
-                                        result = stb.getSeriesItems(url, mac, token, category_id, page, proxy)
+                                        result = stb.callWithSession(stb.getSeriesItems, url, mac, category_id, page, proxy=proxy)
                                     else:
-                                        result = stb.getVodItems(url, mac, token, category_id, page, proxy)
+                                        result = stb.callWithSession(stb.getVodItems, url, mac, category_id, page, proxy=proxy)
                                     
                                     if not result:
                                         logger.debug(f"No result returned for category {category_id}")
@@ -2581,7 +5062,7 @@ def vods_refresh():
                 for mac_idx, mac in enumerate(macs):
                     vod_refresh_state["current_step"] = f"Testing MAC {mac_idx + 1}/{len(macs)}..."
                     try:
-                        token = stb.getToken(url, mac, proxy)
+                        token = stb.getSessionToken(url, mac, proxy)
                         if not token:
                             continue
                         
@@ -2589,7 +5070,7 @@ def vods_refresh():
                         
                         # Get VOD categories from this MAC
                         vod_refresh_state["current_step"] = f"MAC {mac_idx + 1}: Loading VOD categories..."
-                        vod_cats = stb.getVodCategories(url, mac, token, proxy)
+                        vod_cats = stb.callWithSession(stb.getVodCategories, url, mac, proxy=proxy)
                         if vod_cats:
                             for cat in vod_cats:
                                 cat_id = str(cat.get('id', ''))
@@ -2614,7 +5095,7 @@ def vods_refresh():
                         
                         # Get Series categories from this MAC
                         vod_refresh_state["current_step"] = f"MAC {mac_idx + 1}: Loading Series categories..."
-                        series_cats = stb.getSeriesCategories(url, mac, token, proxy)
+                        series_cats = stb.callWithSession(stb.getSeriesCategories, url, mac, proxy=proxy)
                         if series_cats:
                             for cat in series_cats:
                                 cat_id = str(cat.get('id', ''))
@@ -2736,7 +5217,7 @@ def vods_load_categories():
         # Test ALL MACs and merge their categories
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if not token:
                     continue
                     
@@ -2744,7 +5225,7 @@ def vods_load_categories():
                 logger.info(f"Loading categories from MAC {mac} for portal {portal_id}")
                 
                 # Get VOD categories from this MAC
-                vod_cats = stb.getVodCategories(url, mac, token, proxy)
+                vod_cats = stb.callWithSession(stb.getVodCategories, url, mac, proxy=proxy)
                 if vod_cats:
                     for cat in vod_cats:
                         cat_id = str(cat.get('id', ''))
@@ -2775,7 +5256,7 @@ def vods_load_categories():
                                 all_vod_categories[cat_id]["item_count"] = item_count
                 
                 # Get Series categories from this MAC
-                series_cats = stb.getSeriesCategories(url, mac, token, proxy)
+                series_cats = stb.callWithSession(stb.getSeriesCategories, url, mac, proxy=proxy)
                 if series_cats:
                     for cat in series_cats:
                         cat_id = str(cat.get('id', ''))
@@ -2968,7 +5449,7 @@ def vods_load_items():
         token = None
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if token:
                     working_mac = mac
                     break
@@ -2986,9 +5467,9 @@ def vods_load_items():
         
         while True:
             if content_type == 'series':
-                result = stb.getSeriesItems(url, working_mac, token, category_id, page, proxy)
+                result = stb.callWithSession(stb.getSeriesItems, url, working_mac, category_id, page, proxy=proxy)
             else:
-                result = stb.getVodItems(url, working_mac, token, category_id, page, proxy)
+                result = stb.callWithSession(stb.getVodItems, url, working_mac, category_id, page, proxy=proxy)
             
             if not result or not result.get('items'):
                 break
@@ -3164,7 +5645,7 @@ def vods_play(portal_id, content_type):
         for mac in macs:
             try:
                 logger.info(f"Trying MAC {mac} for {content_type} content...")
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if not token:
                     logger.warning(f"MAC {mac}: Failed to get token")
                     failed_macs.append({"mac": mac, "reason": "No token"})
@@ -3173,9 +5654,10 @@ def vods_play(portal_id, content_type):
                 # Call create_link API
                 if content_type == 'series':
                     # For series, episode_num is passed as the 'series' parameter
-                    link = stb.getSeriesLink(url, mac, token, cmd, episode_num, season_num, episode_num, proxy)
+                    linkArgs = (stb.getSeriesLink, url, mac, cmd, episode_num, season_num, episode_num)
                 else:
-                    link = stb.getVodLink(url, mac, token, cmd, proxy)
+                    linkArgs = (stb.getVodLink, url, mac, cmd)
+                link, reused = stb.getCachedLink(*linkArgs, proxy=proxy)
                 
                 if not link:
                     logger.warning(f"MAC {mac}: No link returned from API")
@@ -3185,7 +5667,12 @@ def vods_play(portal_id, content_type):
                 # Test if the stream is accessible
                 if should_test:
                     logger.info(f"Testing stream link from MAC {mac}...")
-                    if stb.testStreamLink(link, proxy, timeout=5):
+                    passed = stb.testStreamLink(link, proxy, timeout=5)
+                    if not passed and reused:
+                        # The cached link may have expired - one try with a fresh one
+                        link, _ = stb.getCachedLink(*linkArgs, proxy=proxy, refresh=True)
+                        passed = bool(link) and stb.testStreamLink(link, proxy, timeout=5)
+                    if passed:
                         logger.info(f"MAC {mac}: Stream test PASSED - {link[:50]}...")
                         return jsonify({
                             "success": True,
@@ -3245,12 +5732,12 @@ def vods_series_episodes(portal_id, series_id):
         # Try each MAC until we get episodes
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if not token:
                     continue
                 
                 # Get series info with episodes
-                series_info = stb.getSeriesInfo(url, mac, token, series_id, proxy)
+                series_info = stb.callWithSession(stb.getSeriesInfo, url, mac, series_id, proxy=proxy)
                 
                 if series_info:
                     logger.info(f"Got series info for {series_id}")
@@ -3390,6 +5877,8 @@ def portalsAdd():
         return redirect("/portals", code=302)
     
     streamsPerMac = request.form.get("streams per mac", "1")
+    streamLinger = request.form.get("stream linger", "15")
+    raceMacs = request.form.get("race macs", "1")
     epgOffset = request.form.get("epg offset", "0")
     proxy = request.form.get("proxy", "").strip()
     portalPrefix = request.form.get("portal prefix", "").strip()
@@ -3435,9 +5924,12 @@ def portalsAdd():
             "url": url,
             "macs": macsd,
             "streams per mac": streamsPerMac,
+            "stream linger": streamLinger,
+            "race macs": raceMacs,
             "epg offset": epgOffset,
             "proxy": proxy,
             "portal prefix": portalPrefix,
+            "handshake hints": stb.getPortalHints(url),
         }
 
         for setting, default in defaultPortal.items():
@@ -3476,6 +5968,8 @@ def portalUpdate():
     newmacs = [m.strip() for m in macs_text.split('\n') if m.strip()]
     newmacs = list(set(newmacs))  # Remove duplicates
     streamsPerMac = request.form["streams per mac"]
+    streamLinger = request.form.get("stream linger", "15")
+    raceMacs = request.form.get("race macs", "1")
     epgOffset = request.form["epg offset"]
     proxy = request.form["proxy"].strip()
     portalPrefix = request.form.get("portal prefix", "").strip()
@@ -3526,11 +6020,16 @@ def portalUpdate():
             flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
 
     if len(macsout) > 0:
+        if portals[id]["url"] != url:
+            # Learned handshake hints belong to the old URL
+            portals[id]["handshake hints"] = {}
         portals[id]["enabled"] = enabled
         portals[id]["name"] = name
         portals[id]["url"] = url
         portals[id]["macs"] = macsout
         portals[id]["streams per mac"] = streamsPerMac
+        portals[id]["stream linger"] = streamLinger
+        portals[id]["race macs"] = raceMacs
         portals[id]["epg offset"] = epgOffset
         portals[id]["proxy"] = proxy
         portals[id]["portal prefix"] = portalPrefix
@@ -3649,11 +6148,10 @@ def portal_load_genres():
         
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if token:
-                    stb.getProfile(url, mac, token, proxy)
-                    mac_channels = stb.getAllChannels(url, mac, token, proxy)
-                    mac_genres = stb.getGenreNames(url, mac, token, proxy)
+                    mac_channels = stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
+                    mac_genres = stb.callWithSession(stb.getGenreNames, url, mac, proxy=proxy)
                     
                     if mac_channels:
                         for channel in mac_channels:
@@ -3776,13 +6274,12 @@ def portal_mac_regions():
         
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if not token:
                     mac_regions[mac] = []
                     continue
                 
-                stb.getProfile(url, mac, token, proxy)
-                mac_genres = stb.getGenreNames(url, mac, token, proxy)
+                mac_genres = stb.callWithSession(stb.getGenreNames, url, mac, proxy=proxy)
                 
                 if not mac_genres:
                     mac_regions[mac] = []
@@ -3854,11 +6351,10 @@ def portal_save_genre_selection():
         
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if token:
-                    stb.getProfile(url, mac, token, proxy)
-                    mac_channels = stb.getAllChannels(url, mac, token, proxy)
-                    mac_genres = stb.getGenreNames(url, mac, token, proxy)
+                    mac_channels = stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
+                    mac_genres = stb.callWithSession(stb.getGenreNames, url, mac, proxy=proxy)
                     
                     if mac_channels:
                         # Store for pre-caching
@@ -5400,6 +7896,9 @@ def editor_refresh():
             "current_step": "Starting...",
             "portals_done": 0,
             "portals_total": len(enabled_portals),
+            "macs_done": 0,
+            "macs_total": sum(len(p.get("macs", {})) for p in enabled_portals),
+            "workers": {},
             "started_at": time.time()
         }
         
@@ -5414,7 +7913,10 @@ def editor_refresh():
 @authorise
 def editor_refresh_progress_status():
     """Get channel refresh progress."""
-    return flask.jsonify(editor_refresh_progress)
+    with editor_refresh_lock:
+        progress = dict(editor_refresh_progress)
+        progress["workers"] = dict(progress.get("workers", {}))
+    return flask.jsonify(progress)
 
 @app.route("/editor/deactivate-duplicates", methods=["POST"])
 @authorise
@@ -5553,6 +8055,27 @@ def save():
         logger.info("Reinitializing channel cache...")
         channel_cache = init_channel_cache()
         logger.info(f"Channel cache reinitialized: mode={channel_cache.mode}, duration={channel_cache.cache_duration or 'unlimited'}")
+    elif channel_cache:
+        # Policy and budget can change without dropping cached entries
+        channel_cache.policy = settings.get("channel cache policy", "strict")
+        try:
+            channel_cache.refresh_budget = int(settings.get("channel cache refresh budget", "10"))
+        except ValueError:
+            pass
+    
+    try:
+        stream_probes.ttl = int(settings.get("stream probe ttl", "30"))
+    except ValueError:
+        pass
+    source_codecs.enabled = settings.get("audio copy", "true") == "true"
+    try:
+        ffmpeg_pool.max_size = int(settings.get("ffmpeg warm pool", "2"))
+    except ValueError:
+        pass
+    try:
+        stb.setLinkCacheTtl(settings.get("link cache ttl", "300"))
+    except ValueError:
+        pass
     
     # EPG refresh is controlled by EPG Auto Refresh setting
     # Use Dashboard "Refresh EPG" button for manual refresh
@@ -5588,6 +8111,8 @@ def xc_users_list():
             "password": user.get("password"),
             "enabled": user.get("enabled") == "true",
             "max_connections": user.get("max_connections"),
+            "priority": user.get("priority", "0"),
+            "hls_profile": user.get("hls profile", ""),
             "active_connections": active_cons,
             "allowed_portals": user.get("allowed_portals", []),
             "created_at": user.get("created_at"),
@@ -5620,6 +8145,8 @@ def xc_users_add():
             "password": password,
             "enabled": "true",
             "max_connections": str(data.get("max_connections", 1)),
+            "priority": str(data.get("priority", 0)),
+            "hls profile": data.get("hls_profile", ""),
             "allowed_portals": data.get("allowed_portals", []),
             "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "expires_at": data.get("expires_at", ""),
@@ -5651,6 +8178,8 @@ def xc_users_update():
         
         users[user_id]["enabled"] = "true" if data.get("enabled") else "false"
         users[user_id]["max_connections"] = str(data.get("max_connections", 1))
+        users[user_id]["priority"] = str(data.get("priority", 0))
+        users[user_id]["hls profile"] = data.get("hls_profile", "")
         users[user_id]["allowed_portals"] = data.get("allowed_portals", [])
         users[user_id]["expires_at"] = data.get("expires_at", "")
         
@@ -6331,15 +8860,13 @@ def refresh_xmltv():
                 try:
                     mac_index += 1
                     epg_refresh_progress["current_step"] = f"{portal_name}: Authenticating MAC {mac_index}/{len(macs)} ({mac})"
-                    token = stb.getToken(url, mac, proxy)
+                    token = stb.getSessionToken(url, mac, proxy)
                     if token:
-                        stb.getProfile(url, mac, token, proxy)
-                        
                         epg_refresh_progress["current_step"] = f"{portal_name}: Fetching channels from MAC {mac_index}/{len(macs)}"
-                        mac_channels = stb.getAllChannels(url, mac, token, proxy)
+                        mac_channels = stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
                         
                         epg_refresh_progress["current_step"] = f"{portal_name}: Fetching EPG from MAC {mac_index}/{len(macs)}"
-                        mac_epg = stb.getEpg(url, mac, token, 24, proxy)
+                        mac_epg = stb.callWithSession(stb.getEpg, url, mac, 24, proxy=proxy)
                         
                         if mac_channels:
                             for ch in mac_channels:
@@ -6377,9 +8904,9 @@ def refresh_xmltv():
                     genres_dict = {}
                     try:
                         for mac in macs:
-                            token = stb.getToken(url, mac, proxy)
+                            token = stb.getSessionToken(url, mac, proxy)
                             if token:
-                                genres = stb.getGenres(url, mac, token, proxy)
+                                genres = stb.callWithSession(stb.getGenres, url, mac, proxy=proxy)
                                 if genres:
                                     for genre in genres:
                                         genre_id = str(genre.get("id"))
@@ -8146,11 +10673,11 @@ def xc_get_series_info(user, series_id):
         
         for mac in macs:
             try:
-                token = stb.getToken(url, mac, proxy)
+                token = stb.getSessionToken(url, mac, proxy)
                 if not token:
                     continue
                 
-                series_info = stb.getSeriesInfo(url, mac, token, item_id, proxy)
+                series_info = stb.callWithSession(stb.getSeriesInfo, url, mac, item_id, proxy=proxy)
                 
                 if series_info and series_info.get("data"):
                     working_mac = mac
@@ -8407,19 +10934,16 @@ def xc_stream(username, password, stream_id, extension=None):
     registerXCConnection(user_id, device_id, portal_id, channel_id, get_client_ip(request))
     
     try:
-        response = stream_channel(portal_id, channel_id, xc_user=username)
+        try:
+            priority = int(user.get("priority", "0") or 0)
+        except ValueError:
+            priority = 0
+        response = stream_channel(portal_id, channel_id, xc_user=username, priority=priority)
         
-        if hasattr(response, 'response') and hasattr(response.response, '__iter__'):
-            original_iter = response.response
-            
-            def cleanup_wrapper():
-                try:
-                    for chunk in original_iter:
-                        yield chunk
-                finally:
-                    unregisterXCConnection(user_id, device_id)
-            
-            response.response = cleanup_wrapper()
+        if hasattr(response, 'call_on_close'):
+            # Runs when the server closes the body, even if it was never iterated
+            # (the async front end relays shared broadcasts without touching it)
+            response.call_on_close(lambda: unregisterXCConnection(user_id, device_id))
         
         return response
     except Exception as e:
@@ -8457,6 +10981,7 @@ def test_vod_stream_quick(stream_url, proxy=None):
             response.close()
             return chunk and len(chunk) > 0
         
+        stb.invalidateLink(stream_url, response.status_code)
         return False
         
     except Exception as e:
@@ -8477,14 +11002,43 @@ def get_vod_stream_settings():
         return {'stream_type': 'ffmpeg', 'mac_rotation': 'true'}
 
 
-def ffmpeg_vod_stream(stream_url, proxy=None):
-    """Stream VOD through FFmpeg for better compatibility."""
+def occupy_vod_slot(portal, portal_id, mac, title, xc_user=None, limit=0):
+    """Occupy a slot on mac for a proxied VOD response; None if the MAC is at limit.
     
-    # Build FFmpeg command
+    Acquired before the upstream is opened and freed with release_on_close.
+    """
+    vod_info = {
+        "mac": mac,
+        "channel id": title,
+        "channel name": f"{title} (VOD)",
+        "client": get_client_ip(request),
+        "portal name": portal.get("name"),
+        "start time": datetime.now(timezone.utc).timestamp(),
+    }
+    if xc_user:
+        vod_info["xc_user"] = xc_user
+    return occupancy.acquire(portal_id, mac, vod_info, limit)
+
+
+def ffmpeg_vod_stream(stream_url, proxy=None, codec_key=None):
+    """Stream VOD through FFmpeg for better compatibility.
+    
+    Audio is copied when the item's cached codecs fit MPEG-TS (codec_key
+    identifies the item); ffmpeg's input dump fills that cache.
+    """
+    audio_path, audio_reason = source_codecs.audio_plan(codec_key, "mpegts") if codec_key else ("encode", "codecs unknown")
+    if audio_path == "copy":
+        audio_args = ["-c:a", "copy"]
+    else:
+        audio_args = ["-c:a", "aac", "-b:a", "192k"]
+    logger.info(f"VOD FFmpeg: audio {audio_path} ({audio_reason})")
+    
+    # Build FFmpeg command (info level for the input dump, read by drain_stderr)
     ffmpeg_cmd = [
         "ffmpeg",
         "-hide_banner",
-        "-loglevel", "error",
+        "-nostats",
+        "-loglevel", "info",
         "-reconnect", "1",
         "-reconnect_streamed", "1",
         "-reconnect_delay_max", "5",
@@ -8496,15 +11050,26 @@ def ffmpeg_vod_stream(stream_url, proxy=None):
     ffmpeg_cmd.extend([
         "-i", stream_url,
         "-c:v", "copy",
-        "-c:a", "aac",
-        "-b:a", "192k",
+        *audio_args,
         "-f", "mpegts",
         "-mpegts_flags", "resend_headers",
         "pipe:1"
     ])
     
+    def drain_stderr(process):
+        """Keep the stderr pipe empty; learn codecs, log errors."""
+        input_dump = {}
+        for raw in process.stderr:
+            line = raw.decode(errors="replace")
+            if codec_key:
+                source_codecs.watch_stderr(codec_key, input_dump, line)
+            stb.invalidateLinkFromLog(stream_url, line)
+            if "error" in line.lower():
+                logger.debug(f"VOD FFmpeg: {line.strip()}")
+    
     def generate():
         process = None
+        started = time.time()
         try:
             process = subprocess.Popen(
                 ffmpeg_cmd,
@@ -8512,6 +11077,7 @@ def ffmpeg_vod_stream(stream_url, proxy=None):
                 stderr=subprocess.PIPE,
                 bufsize=65536
             )
+            threading.Thread(target=drain_stderr, args=(process,), daemon=True, name="vod-ffmpeg-stderr").start()
             
             while True:
                 chunk = process.stdout.read(65536)
@@ -8525,12 +11091,14 @@ def ffmpeg_vod_stream(stream_url, proxy=None):
             logger.error(f"VOD FFmpeg stream error: {e}")
         finally:
             if process:
+                cpu_seconds = source_codecs.process_cpu_seconds(process.pid)
+                source_codecs.record_usage(audio_path, cpu_seconds, time.time() - started)
                 try:
                     process.terminate()
                     process.wait(timeout=5)
                 except:
                     process.kill()
-                logger.debug("VOD FFmpeg: Process terminated")
+                logger.debug(f"VOD FFmpeg: Process terminated (audio {audio_path}, {cpu_seconds}s CPU)")
     
     return Response(
         generate(),
@@ -8579,6 +11147,8 @@ def proxy_vod_stream(stream_url, proxy=None):
         try:
             head_resp = requests.head(stream_url, headers=req_headers, proxies=proxies, 
                                       timeout=10, allow_redirects=True)
+            if head_resp.status_code in (403, 404):
+                stb.invalidateLink(stream_url, head_resp.status_code)
             if head_resp.headers.get('Content-Length'):
                 resp_headers["Content-Length"] = head_resp.headers.get('Content-Length')
             if head_resp.headers.get('Content-Type'):
@@ -8594,6 +11164,8 @@ def proxy_vod_stream(stream_url, proxy=None):
         try:
             with requests.get(stream_url, headers=req_headers, proxies=proxies, 
                             stream=True, timeout=60) as r:
+                if r.status_code in (403, 404):
+                    stb.invalidateLink(stream_url, r.status_code)
                 r.raise_for_status()
                 for chunk in r.iter_content(chunk_size=65536):
                     if chunk:
@@ -8716,7 +11288,7 @@ def xc_movie_stream(username, password, stream_id, extension=None):
         conn = get_vod_db_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT cmd, working_macs FROM vod_items 
+            SELECT cmd, working_macs, name FROM vod_items 
             WHERE portal_id = ? AND item_id = ? AND content_type = 'vod'
         ''', (portal_id, item_id))
         row = cursor.fetchone()
@@ -8727,6 +11299,7 @@ def xc_movie_stream(username, password, stream_id, extension=None):
             return flask.jsonify({"error": "VOD data not found"}), 404
         
         vod_cmd = row['cmd']
+        vod_name = row['name'] or item_id
         if row['working_macs']:
             cached_mac = row['working_macs'].split(',')[0]
     except Exception as e:
@@ -8737,24 +11310,32 @@ def xc_movie_stream(username, password, stream_id, extension=None):
     if cached_mac and cached_mac in macs:
         macs = [cached_mac] + [m for m in macs if m != cached_mac]
     
+    # Then prefer MACs with a free slot (occupancy is shared with live streams)
+    streamsPerMac = int(portal.get("streams per mac", "1") or 0)
+    macs.sort(key=lambda m: not occupancy.is_free(portal_id, m, streamsPerMac))
+    
     failed_macs = []
     
     for mac_index, mac in enumerate(macs, 1):
+        handle = None
         try:
-            token = stb.getToken(url, mac, proxy)
+            token = stb.getSessionToken(url, mac, proxy)
             if not token:
                 failed_macs.append({"mac": mac[:15] + "...", "reason": "No token"})
                 continue
             
-            link = stb.getVodLink(url, mac, token, vod_cmd, proxy)
+            link, reused = stb.getCachedLink(stb.getVodLink, url, mac, vod_cmd, proxy=proxy)
             if not link or not link.startswith(('http://', 'https://')):
                 failed_macs.append({"mac": mac[:15] + "...", "reason": "No link"})
                 continue
             
-            # Test stream accessibility
+            # Test stream accessibility (a cached link that fails gets one fresh retry)
             if not test_vod_stream_quick(link, proxy):
-                failed_macs.append({"mac": mac[:15] + "...", "reason": "458/403"})
-                continue
+                if reused:
+                    link, _ = stb.getCachedLink(stb.getVodLink, url, mac, vod_cmd, proxy=proxy, refresh=True)
+                if not reused or not link or not test_vod_stream_quick(link, proxy):
+                    failed_macs.append({"mac": mac[:15] + "...", "reason": "458/403"})
+                    continue
             
             logger.info(f"VOD: {item_id} → MAC {mac_index}/{len(macs)} OK")
             
@@ -8769,22 +11350,27 @@ def xc_movie_stream(username, password, stream_id, extension=None):
             except:
                 pass
             
-            # Get fresh link for playback
-            fresh_link = stb.getVodLink(url, mac, token, vod_cmd, proxy) or link
-            
             # Check VOD settings for stream type
             vod_settings = get_vod_stream_settings()
             stream_type = vod_settings.get('stream_type', 'ffmpeg')
             settings = getSettings()
             
+            if stream_type != 'ffmpeg' and settings.get("xc vod proxy", "false") != "true":
+                return redirect(link, code=302)
+            if request.method != "HEAD":
+                handle = occupy_vod_slot(portal, portal_id, mac, vod_name, username, streamsPerMac)
+                if not handle:
+                    failed_macs.append({"mac": mac[:15] + "...", "reason": "MAC busy"})
+                    continue
             if stream_type == 'ffmpeg':
-                return ffmpeg_vod_stream(fresh_link, proxy)
-            elif settings.get("xc vod proxy", "false") == "true":
-                return proxy_vod_stream(fresh_link, proxy)
+                response = ffmpeg_vod_stream(link, proxy, ("vod", portal_id, item_id))
             else:
-                return redirect(fresh_link, code=302)
+                response = proxy_vod_stream(link, proxy)
+            return occupancy.release_on_close(response, handle) if handle else response
                     
         except Exception as e:
+            if handle:
+                handle.release()
             failed_macs.append({"mac": mac[:15] + "...", "reason": str(e)[:30]})
             continue
     
@@ -8849,11 +11435,11 @@ def xc_series_stream(username, password, stream_id, extension=None):
                 
                 for mac in macs:
                     try:
-                        token = stb.getToken(url, mac, proxy)
+                        token = stb.getSessionToken(url, mac, proxy)
                         if not token:
                             continue
                         
-                        series_info = stb.getSeriesInfo(url, mac, token, i_id, proxy)
+                        series_info = stb.callWithSession(stb.getSeriesInfo, url, mac, i_id, proxy=proxy)
                         if series_info and series_info.get("data"):
                             for season_data in series_info.get("data", []):
                                 s_id = season_data.get("id", "")
@@ -8918,11 +11504,16 @@ def xc_series_stream(username, password, stream_id, extension=None):
     if cached_mac and cached_mac in macs:
         macs = [cached_mac] + [m for m in macs if m != cached_mac]
     
+    # Then prefer MACs with a free slot (occupancy is shared with live streams)
+    streamsPerMac = int(portal.get("streams per mac", "1") or 0)
+    macs.sort(key=lambda m: not occupancy.is_free(portal_id, m, streamsPerMac))
+    
     failed_macs = []
     
     for mac_index, mac in enumerate(macs, 1):
+        handle = None
         try:
-            token = stb.getToken(url, mac, proxy)
+            token = stb.getSessionToken(url, mac, proxy)
             if not token:
                 failed_macs.append({"mac": mac[:15] + "...", "reason": "No token"})
                 continue
@@ -8935,15 +11526,19 @@ def xc_series_stream(username, password, stream_id, extension=None):
             cmd_data = {"series_id": base_series_id, "season_num": int(season_num), "type": "series"}
             current_cmd = base64.b64encode(json_module.dumps(cmd_data).encode()).decode()
             
-            link = stb.getSeriesLink(url, mac, token, current_cmd, episode_num, season_num, episode_num, proxy)
+            linkArgs = (stb.getSeriesLink, url, mac, current_cmd, episode_num, season_num, episode_num)
+            link, reused = stb.getCachedLink(*linkArgs, proxy=proxy)
             if not link or not link.startswith(('http://', 'https://')):
                 failed_macs.append({"mac": mac[:15] + "...", "reason": "No link"})
                 continue
             
-            # Test stream accessibility
+            # Test stream accessibility (a cached link that fails gets one fresh retry)
             if not test_vod_stream_quick(link, proxy):
-                failed_macs.append({"mac": mac[:15] + "...", "reason": "458/403"})
-                continue
+                if reused:
+                    link, _ = stb.getCachedLink(*linkArgs, proxy=proxy, refresh=True)
+                if not reused or not link or not test_vod_stream_quick(link, proxy):
+                    failed_macs.append({"mac": mac[:15] + "...", "reason": "458/403"})
+                    continue
             
             logger.info(f"Series: S{season_num}E{episode_num} → MAC {mac_index}/{len(macs)} OK")
             
@@ -8958,21 +11553,26 @@ def xc_series_stream(username, password, stream_id, extension=None):
             except:
                 pass
             
-            # Get fresh link for playback
-            fresh_link = stb.getSeriesLink(url, mac, token, current_cmd, episode_num, season_num, episode_num, proxy) or link
-            
             # Check VOD settings for stream type
             vod_settings = get_vod_stream_settings()
             stream_type = vod_settings.get('stream_type', 'ffmpeg')
             
+            if stream_type != 'ffmpeg' and settings.get("xc vod proxy", "false") != "true":
+                return redirect(link, code=302)
+            if request.method != "HEAD":
+                handle = occupy_vod_slot(portal, portal_id, mac, f"Series {base_series_id} S{season_num}E{episode_num}", username, streamsPerMac)
+                if not handle:
+                    failed_macs.append({"mac": mac[:15] + "...", "reason": "MAC busy"})
+                    continue
             if stream_type == 'ffmpeg':
-                return ffmpeg_vod_stream(fresh_link, proxy)
-            elif settings.get("xc vod proxy", "false") == "true":
-                return proxy_vod_stream(fresh_link, proxy)
+                response = ffmpeg_vod_stream(link, proxy, ("series", portal_id, series_id, season_num, episode_num))
             else:
-                return redirect(fresh_link, code=302)
+                response = proxy_vod_stream(link, proxy)
+            return occupancy.release_on_close(response, handle) if handle else response
                     
         except Exception as e:
+            if handle:
+                handle.release()
             failed_macs.append({"mac": mac[:15] + "...", "reason": str(e)[:30]})
             continue
     
@@ -9042,93 +11642,200 @@ def xc_xmltv():
                 return Response("Error generating XMLTV", status=500, mimetype="text/plain")
 
 
-def stream_channel(portalId, channelId, xc_user=None):
-    """Internal function to stream a channel without authentication."""
-    def streamData():
-        def occupy():
-            occupied.setdefault(portalId, [])
-            stream_info = {
-                "mac": mac,
-                "channel id": channelId,
-                "channel name": channelName,
-                "client": ip,
-                "portal name": portalName,
-                "start time": startTime,
-            }
-            if xc_user:
-                stream_info["xc_user"] = xc_user
-            occupied.get(portalId, []).append(stream_info)
-            logger.info("Occupied Portal({}):MAC({}):User({})".format(portalId, mac, xc_user or "Direct"))
-
-        def unoccupy():
-            stream_info = {
-                "mac": mac,
-                "channel id": channelId,
-                "channel name": channelName,
-                "client": ip,
-                "portal name": portalName,
-                "start time": startTime,
-            }
-            if xc_user:
-                stream_info["xc_user"] = xc_user
-            try:
-                occupied.get(portalId, []).remove(stream_info)
-            except ValueError:
-                pass  # Already removed
-            logger.info("Unoccupied Portal({}):MAC({}):User({})".format(portalId, mac, xc_user or "Direct"))
+def stream_channel(portalId, channelId, xc_user=None, priority=0, slot=None):
+    """Internal function to stream a channel without authentication.
+    
+    priority orders this request in the MAC slot queue (XC user setting);
+    slot is the occupancy handle the queue granted to its single retry.
+    """
+    def broadcastResponse(broadcast):
+        if broadcast.container == "mp4":
+            # Use correct mimetype for MPEG-TS streams
+            response = Response(stream_broadcasts.stream(broadcast), mimetype="video/mp2t")
+            response.headers['Content-Type'] = 'video/mp2t'
+            response.headers['Accept-Ranges'] = 'none'
+        else:
+            response = Response(stream_broadcasts.stream(broadcast), mimetype="application/octet-stream")
+        if request.environ.get(AsyncStreamFrontend.ENVIRON_KEY):
+            # The event loop relays the broadcast itself; this thread is released
+            response.headers[AsyncStreamFrontend.HANDOFF_HEADER] = broadcast.token
+        return response
 
+    def startBroadcast(container, relay=None, feed=None):
+        """Start (or join) the shared upstream for this channel; it occupies one MAC slot."""
+        stream_info = {
+            "mac": mac,
+            "channel id": channelId,
+            "channel name": channelName,
+            "client": ip,
+            "portal name": portalName,
+            "start time": datetime.now(timezone.utc).timestamp(),
+        }
+        if xc_user:
+            stream_info["xc_user"] = xc_user
+
+        def on_exit(broadcast, returncode):
+            handle.release()
+            if returncode != 0 and not broadcast.stopping:
+                stb.invalidateLink(link)
+                logger.info("Ffmpeg closed with error({}). Moving MAC({}) for Portal({})".format(str(returncode), mac, portalName))
+                moveMac(portalId, mac)
+
+        if heldHandle:
+            # Slot already held (race winner or granted by the slot queue)
+            handle = heldHandle
+            handle.info.update(stream_info)
+        else:
+            handle = occupancy.acquire(portalId, mac, stream_info, streamsPerMac)
+            if not handle:
+                # The slot went to someone else since isMacFree
+                broadcast = stream_broadcasts.get(broadcastKey)
+                if broadcast:
+                    return broadcastResponse(broadcast)
+                return waitForSlot()
         try:
-            startTime = datetime.now(timezone.utc).timestamp()
-            occupy()
-            with subprocess.Popen(
-                ffmpegcmd,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
-            ) as ffmpeg_sp:
-                while True:
-                    chunk = ffmpeg_sp.stdout.read(1024)
-                    if len(chunk) == 0:
-                        if ffmpeg_sp.poll() != 0:
-                            logger.info("Ffmpeg closed with error({}). Moving MAC({}) for Portal({})".format(str(ffmpeg_sp.poll()), mac, portalName))
-                            moveMac(portalId, mac)
-                        break
-                    yield chunk
-        except:
-            pass
-        finally:
-            unoccupy()
-            ffmpeg_sp.kill()
+            chunk_size = int(getSettings().get("stream chunk size", "64")) * 1024
+        except ValueError:
+            chunk_size = None
+        try:
+            linger = int(portal.get("stream linger", "15") or 0)
+        except ValueError:
+            linger = 0
+        broadcast, created = stream_broadcasts.start(broadcastKey, ffmpegcmd, container, on_exit, chunk_size, relay, feed, linger)
+        if created:
+            broadcast.occupancy = handle
+        else:
+            # Another request started this channel in the meantime - share it
+            handle.release()
+        return broadcastResponse(broadcast)
+
+    def refreshLink(stale):
+        """Fresh create_link for a broadcast reconnect (the stale link is dropped from the cache)."""
+        stb.invalidateLink(stale)
+        fresh, _ = stb.getCachedLink(stb.getLink, url, mac, cmd, proxy=proxy, refresh=True)
+        return fresh
 
     def testStream():
-        timeout = int(getSettings()["ffmpeg timeout"]) * int(1000000)
-        ffprobecmd = [ffprobe_path, "-timeout", str(timeout), "-i", link]
+        return stream_probes.check(portalId, channelId, link, proxy, timeout=int(getSettings()["ffmpeg timeout"]))
 
-        if proxy:
-            ffprobecmd.insert(1, "-http_proxy")
-            ffprobecmd.insert(2, proxy)
+    def isMacFree(candidate):
+        if occupancy.is_free(portalId, candidate, streamsPerMac):
+            return True
+        # Every MAC busy: a lingering (viewerless) stream on this MAC yields its slot
+        if streamsPerMac and not any(occupancy.is_free(portalId, other, streamsPerMac) for other in macs):
+            return stream_broadcasts.evict_lingering(portalId, candidate) and occupancy.is_free(portalId, candidate, streamsPerMac)
+        return False
 
-        with subprocess.Popen(
-            ffprobecmd,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ) as ffprobe_sb:
-            ffprobe_sb.communicate()
-            if ffprobe_sb.returncode == 0:
-                return True
-            else:
-                return False
+    def raceMacs(width):
+        """Token + create_link (+ stream test) on up to width free MACs at once.
+        
+        The first MAC whose link validates wins and keeps the slot it reserved;
+        slower racers stop at their next step and release theirs. A racer that
+        fails is replaced by the next free MAC. Returns (winner, tried, missing):
+        winner = {"channel", "mac", "link", "handle"} or None, tried = some MAC
+        was free to race, missing = every raced MAC's channel list lacked it.
+        """
+        testing = getSettings().get("test streams", "true") != "false"
+        timeout = int(getSettings()["ffmpeg timeout"])
+        tried = set()
+        lock = threading.Lock()
+        winner = {}
+        done = threading.Event()
+        lacking = set()  # Racers whose channel list does not have the channel
+        
+        def racer(candidate):
+            handle = occupancy.acquire(portalId, candidate, {
+                "mac": candidate,
+                "channel id": channelId,
+                "channel name": "(starting)",
+                "client": ip,
+                "portal name": portalName,
+                "start time": datetime.now(timezone.utc).timestamp(),
+            }, streamsPerMac)
+            if not handle:
+                return  # Slot taken in the meantime
+            failure = None
+            try:
+                token = stb.getSessionToken(url, candidate, proxy)
+                if not token:
+                    failure = "no token"
+                    return
+                found = channel_cache.find_channel(portalId, candidate, channelId, url, token, proxy)
+                if not found:
+                    with lock:
+                        lacking.add(candidate)
+                    return
+                if done.is_set():
+                    return
+                cmd = found["cmd"]
+                reused = False
+                if "http://localhost/" in cmd:
+                    candidate_link, reused = stb.getCachedLink(stb.getLink, url, candidate, cmd, proxy=proxy)
+                else:
+                    candidate_link = cmd.split(" ")[1]
+                if not candidate_link:
+                    failure = "no link"
+                    return
+                if done.is_set():
+                    return
+                if testing and not stream_probes.check(portalId, channelId, candidate_link, proxy, timeout=timeout, use_cache=False):
+                    if reused:
+                        # The cached link may have expired - one try with a fresh one
+                        candidate_link, _ = stb.getCachedLink(stb.getLink, url, candidate, cmd, proxy=proxy, refresh=True)
+                    if not reused or not candidate_link or done.is_set() or not stream_probes.check(portalId, channelId, candidate_link, proxy, timeout=timeout, use_cache=False):
+                        failure = "stream test failed"
+                        return
+                with lock:
+                    if not winner:
+                        winner.update(channel=found, mac=candidate, link=candidate_link, handle=handle)
+                        done.set()
+                        handle = None  # Kept by the winner
+            except Exception as e:
+                failure = str(e)
+            finally:
+                if handle:
+                    handle.release()
+                if failure:
+                    logger.info(f"MAC race: MAC({candidate}) failed for Channel({channelId}): {failure} - moving MAC")
+                    moveMac(portalId, candidate)
+        
+        pending = set()
+        while not done.is_set():
+            for candidate in macs:
+                if len(pending) >= width:
+                    break
+                if candidate not in tried and (streamsPerMac == 0 or occupancy.is_free(portalId, candidate, streamsPerMac)):
+                    tried.add(candidate)
+                    logger.info(f"MAC race for Portal({portalId}):Channel({channelId}): starting MAC({candidate})")
+                    pending.add(mac_race_executor.submit(racer, candidate))
+            if not pending:
+                break
+            _, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+        return (dict(winner) if winner else None), bool(tried), bool(tried) and lacking == tried
 
-    def isMacFree():
-        count = 0
-        for i in occupied.get(portalId, []):
-            if i["mac"] == mac:
-                count = count + 1
-        if count < streamsPerMac:
-            return True
-        else:
-            return False
+    def waitForSlot():
+        """Every MAC is busy: queue for a freed slot and retry once, else 503 + Retry-After."""
+        try:
+            wait = int(getSettings().get("mac slot wait", "10"))
+        except ValueError:
+            wait = 10
+        # Lingering (viewerless) streams hand their slots to the queue
+        stream_broadcasts.evict_lingering(portalId)
+        granted = None
+        if not queued and wait > 0:
+            granted = slot_scheduler.wait(portalId, macs, streamsPerMac, wait, priority, {
+                "channel id": channelId,
+                "channel name": "(starting)",
+                "client": ip,
+                "portal name": portalName,
+                "start time": datetime.now(timezone.utc).timestamp(),
+            })
+        if granted:
+            return stream_channel(portalId, channelId, xc_user, priority, slot=granted)
+        logger.info("No free MAC for Portal({}):Channel({})".format(portalId, channelId))
+        response = make_response("No streams available", 503)
+        response.headers["Retry-After"] = str(max(wait, 5))
+        return response
 
     portal = getPortals().get(portalId)
     
@@ -9144,11 +11851,39 @@ def stream_channel(portalId, channelId, xc_user=None):
     proxy = portal.get("proxy")
     web = request.args.get("web")
     ip = get_client_ip(request)
+    queued = slot is not None
 
     logger.info(
         "IP({}) requested Portal({}):Channel({})".format(ip, portalId, channelId)
     )
 
+    if request.method == "HEAD":
+        # Players probe with HEAD first: headers only - no broadcast, no MAC slot
+        if slot:
+            slot.release()
+        # Unsized body, so no "Content-Length: 0" is announced for a live stream
+        if web:
+            response = Response(iter(()), mimetype="video/mp2t")
+            response.headers['Accept-Ranges'] = 'none'
+        else:
+            response = Response(iter(()), mimetype="application/octet-stream")
+        return response
+
+    # Shared upstream: join a running broadcast of this channel (no MAC slot, no probe)
+    broadcastKey = (portalId, channelId, "web" if web else "ts")
+    if web or getSettings().get("stream method", "ffmpeg") in ("ffmpeg", "relay"):
+        broadcast = stream_broadcasts.get(broadcastKey)
+        if broadcast:
+            if slot:
+                slot.release()  # Viewers of a shared stream hold no slot
+            logger.info("IP({}) joined shared stream Portal({}):Channel({}) ({} viewer(s))".format(
+                ip, portalId, channelId, broadcast.clients + 1))
+            return broadcastResponse(broadcast)
+
+    # Clients already queued for a slot on this portal go first
+    if not queued and streamsPerMac and slot_scheduler.depth(portalId):
+        return waitForSlot()
+
     freeMac = False
     
     # OPTIMIERT: Intelligentes MAC-Fallback mit Cache-Awareness
@@ -9159,21 +11894,56 @@ def stream_channel(portalId, channelId, xc_user=None):
     cmd = None
     link = None
     channelName = None
+    heldHandle = None  # Slot occupied before startBroadcast (race winner or queue grant)
+    tested = False
     
-    # Versuche zuerst, Channel über find_channel_any_mac zu finden
-    # Dies cached automatisch bei lazy-ram und probiert alle MACs
-    channel, mac_found = channel_cache.find_channel_any_mac(portalId, macs, channelId, url, proxy)
+    try:
+        raceWidth = int(portal.get("race macs", "1") or 1)
+    except ValueError:
+        raceWidth = 1
+    
+    if slot:
+        # Retry after the queue granted a slot on slot.mac - use that MAC if it has the channel
+        channel, mac_found = None, None
+        slotToken = stb.getSessionToken(url, slot.mac, proxy)
+        if slotToken:
+            channel = channel_cache.find_channel(portalId, slot.mac, channelId, url, slotToken, proxy)
+        if channel:
+            mac_found = slot.mac
+            heldHandle = slot
+        else:
+            slot.release()
+            channel, mac_found = channel_cache.find_channel_any_mac(portalId, macs, channelId, url, proxy)
+    elif raceWidth > 1 and len(macs) > 1:
+        # Race mode: several free MACs fetch a link at once, the first valid one wins
+        winner, tried, missing = raceMacs(raceWidth)
+        if winner:
+            channel, mac_found = winner["channel"], winner["mac"]
+            link = winner["link"]
+            heldHandle = winner["handle"]
+            tested = True
+        elif missing:
+            logger.info("No MAC of Portal({}) has Channel({})".format(portalName, channelId))
+            return make_response("Channel not found", 404)
+        elif tried:
+            logger.info("No MAC of Portal({}) produced a working link for Channel({})".format(portalName, channelId))
+            return make_response("Unable to connect to portal", 503)
+        else:
+            # Nothing free - the sequential path below evicts lingering streams or queues
+            channel, mac_found = channel_cache.find_channel_any_mac(portalId, macs, channelId, url, proxy)
+    else:
+        # Versuche zuerst, Channel über find_channel_any_mac zu finden
+        # Dies cached automatisch bei lazy-ram und probiert alle MACs
+        channel, mac_found = channel_cache.find_channel_any_mac(portalId, macs, channelId, url, proxy)
     
     if channel and mac_found:
         # Channel gefunden! Prüfe ob MAC frei ist
         mac = mac_found
-        if streamsPerMac == 0 or isMacFree():
-            logger.info(f"Channel {channelId} found on MAC {mac} (via cache)")
+        if heldHandle or streamsPerMac == 0 or isMacFree(mac):
+            logger.info(f"Channel {channelId} found on MAC {mac} ({'race winner' if tested else 'granted slot' if heldHandle else 'via cache'})")
             freeMac = True
-            # Token nochmal holen für diesen MAC
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                stb.getProfile(url, mac, token, proxy)
+            # Token aus dem Session-Store (kein erneuter Handshake)
+            token = stb.getSessionToken(url, mac, proxy)
         else:
             # MAC ist voll - probiere andere MACs
             logger.info(f"MAC {mac} is full, trying other MACs")
@@ -9185,18 +11955,21 @@ def stream_channel(portalId, channelId, xc_user=None):
                 if try_mac == mac_found:
                     continue  # Schon probiert
                     
-                if streamsPerMac == 0 or isMacFree():
+                if streamsPerMac == 0 or isMacFree(try_mac):
                     logger.info(f"Trying Portal({portalId}):MAC({try_mac}):Channel({channelId})")
                     freeMac = True
-                    token = stb.getToken(url, try_mac, proxy)
+                    token = stb.getSessionToken(url, try_mac, proxy)
                     if token:
-                        stb.getProfile(url, try_mac, token, proxy)
                         channel = channel_cache.find_channel(portalId, try_mac, channelId, url, token, proxy)
                         
                         if channel:
                             mac = try_mac
                             break
 
+            if not channel and not freeMac:
+                # Every MAC is at its limit - wait for a slot instead of failing right away
+                return waitForSlot()
+
         if channel:
             # Channel bereits gefunden - keine Schleife nötig!
             channelName = portal.get("custom channel names", {}).get(channelId)
@@ -9204,9 +11977,10 @@ def stream_channel(portalId, channelId, xc_user=None):
                 channelName = channel["name"]
             cmd = channel["cmd"]
 
-        if cmd:
+        reused = False
+        if cmd and not link:
             if "http://localhost/" in cmd:
-                link = stb.getLink(url, mac, token, cmd, proxy)
+                link, reused = stb.getCachedLink(stb.getLink, url, mac, cmd, proxy=proxy)
                 logger.debug(f"Generated stream link for MAC {mac}: {link[:100]}..." if link and len(link) > 100 else f"Generated stream link for MAC {mac}: {link}")
             else:
                 link = cmd.split(" ")[1]
@@ -9214,13 +11988,21 @@ def stream_channel(portalId, channelId, xc_user=None):
         
         if not link:
             logger.warning(f"No stream link generated for MAC {mac}, channel {channelId}")
+            if heldHandle:
+                heldHandle.release()
             # Markiere MAC als defekt
             logger.info("Moving MAC({}) for Portal({})".format(mac, portalName))
             moveMac(portalId, mac)
             return make_response("No stream link available", 404)
 
         if link:
-            if getSettings().get("test streams", "true") == "false" or testStream():
+            # Race winners were already tested
+            passed = tested or getSettings().get("test streams", "true") == "false" or testStream()
+            if not passed and reused:
+                # The cached link may have expired - one try with a fresh one
+                link, _ = stb.getCachedLink(stb.getLink, url, mac, cmd, proxy=proxy, refresh=True)
+                passed = bool(link) and testStream()
+            if passed:
                 if web:
                     ffmpegcmd = [
                         ffmpeg_path,
@@ -9240,14 +12022,12 @@ def stream_channel(portalId, channelId, xc_user=None):
                     if proxy:
                         ffmpegcmd.insert(1, "-http_proxy")
                         ffmpegcmd.insert(2, proxy)
-                    # Use correct mimetype for MPEG-TS streams
-                    response = Response(streamData(), mimetype="video/mp2t")
-                    response.headers['Content-Type'] = 'video/mp2t'
-                    response.headers['Accept-Ranges'] = 'none'
-                    return response
+                    return startBroadcast("mp4")
 
                 else:
-                    if getSettings().get("stream method", "ffmpeg") == "ffmpeg":
+                    streamMethod = getSettings().get("stream method", "ffmpeg")
+                    if streamMethod in ("ffmpeg", "relay"):
+                        # ffmpeg command is also the relay's fallback when the upstream needs remuxing
                         ffmpegcmd = f"{ffmpeg_path} {getSettings()['ffmpeg command']}"
                         ffmpegcmd = ffmpegcmd.replace("<url>", link)
                         ffmpegcmd = ffmpegcmd.replace(
@@ -9262,13 +12042,26 @@ def stream_channel(portalId, channelId, xc_user=None):
                         # Bereinige doppelte Leerzeichen und splitte in Array
                         ffmpegcmd = " ".join(ffmpegcmd.split())
                         ffmpegcmd = ffmpegcmd.split()
-                        return Response(
-                            streamData(), mimetype="application/octet-stream"
-                        )
+                        relay = None
+                        feed = None
+                        if not link.split("?")[0].lower().endswith((".m3u8", ".mp4", ".mkv")):
+                            # TS upstream: relay it, or let a warm ffmpeg read it from a pipe
+                            source = {"url": link, "proxy": proxy}
+                            if "http://localhost/" in cmd:
+                                source["refresh"] = refreshLink
+                            if streamMethod == "relay":
+                                relay = source
+                            else:
+                                feed = source
+                        return startBroadcast("mpegts", relay, feed)
                     else:
+                        if heldHandle:
+                            heldHandle.release()  # Redirected clients hold no slot
                         logger.info("Redirect sent")
                         return redirect(link)
 
+        if heldHandle:
+            heldHandle.release()
         logger.info(
             "Unable to connect to Portal({}) using MAC({})".format(portalId, mac)
         )
@@ -9353,45 +12146,63 @@ def hls_stream(portalId, channelId, filename):
     
     logger.info(f"HLS request from IP({ip}) for Portal({portalId}):Channel({channelId}):File({filename})")
     
+    # Profile: ?profile= > XC user's profile (?username=&password=) > global setting
+    profile = request.args.get("profile")
+    if not profile and request.args.get("username"):
+        xc_user_id, xc_user = validateXCUser(request.args.get("username"), request.args.get("password", ""))
+        if xc_user_id:
+            profile = xc_user.get("hls profile")
+    if profile not in HLSStreamManager.PROFILES:
+        profile = getSettings().get("hls profile", "standard")
+    
+    # LL-HLS blocking playlist reload (_HLS_part is ignored - no partial segments)
+    try:
+        msn = int(request.args["_HLS_msn"]) if filename.endswith('.m3u8') and "_HLS_msn" in request.args else None
+    except ValueError:
+        return make_response("Invalid _HLS_msn", 400)
+    
     # Check if we already have this stream
     stream_key = f"{portalId}_{channelId}"
     
     # First, check if stream is already active
-    stream_exists = stream_key in hls_manager.streams
+    active_stream = hls_manager.streams.get(stream_key)
     
-    if stream_exists:
+    if active_stream:
+        is_passthrough = active_stream.get('is_passthrough', False)
+        low_latency = active_stream.get('profile') == "low-latency" and not is_passthrough
         # For active streams, wait a bit for the file if it's a playlist
         if filename.endswith('.m3u8'):
-            is_passthrough = hls_manager.streams[stream_key].get('is_passthrough', False)
-            max_wait = 100 if not is_passthrough else 10
-            
-            for wait_count in range(max_wait):
-                file_path = hls_manager.get_file(portalId, channelId, filename)
-                if file_path:
-                    break
-                time.sleep(0.1)
+            max_wait = 10 if not is_passthrough else 1
+            if msn is not None and low_latency:
+                # LL-HLS: a request more than two segments ahead of the playlist is rejected
+                published = hls_manager.published_msn(portalId, channelId, filename)
+                if published is not None and msn > published + 2:
+                    return make_response("_HLS_msn is too far ahead of the playlist", 400)
+                max_wait = active_stream['segment_duration'] * 3
         else:
-            file_path = hls_manager.get_file(portalId, channelId, filename)
+            # Low latency: a segment requested just before ffmpeg writes it is held
+            max_wait = active_stream['segment_duration'] * 3 if low_latency else 0
+        data, file_path = hls_manager.fetch(portalId, channelId, filename, max_wait, msn if low_latency else None)
     else:
-        file_path = None
+        data, file_path = None, None
     
     # If file doesn't exist and this is a playlist/segment request, start the stream
-    if not file_path and (filename.endswith('.m3u8') or filename.endswith('.ts') or filename.endswith('.m4s')):
+    if data is None and not file_path and (filename.endswith('.m3u8') or filename.endswith('.ts') or filename.endswith('.m4s')):
         # OPTIMIERT: Nutze find_channel_any_mac für intelligentes MAC-Fallback
         # Besonders wichtig für lazy-ram Modus: Probiert alle MACs bis Channel gefunden
+        streamsPerMac = int(portal.get("streams per mac") or 0)
+        macs.sort(key=lambda m: not occupancy.is_free(portalId, m, streamsPerMac))  # Free MACs first
         channel, mac_used = channel_cache.find_channel_any_mac(portalId, macs, channelId, url, proxy)
         
         link = None
         if channel:
             try:
                 # Get token for the MAC that has the channel
-                token = stb.getToken(url, mac_used, proxy)
+                token = stb.getSessionToken(url, mac_used, proxy)
                 if token:
-                    stb.getProfile(url, mac_used, token, proxy)
-                    
                     cmd = channel["cmd"]
                     if "http://localhost/" in cmd:
-                        link = stb.getLink(url, mac_used, token, cmd, proxy)
+                        link, _ = stb.getCachedLink(stb.getLink, url, mac_used, cmd, proxy=proxy)
                     else:
                         link = cmd.split(" ")[1]
                     
@@ -9405,51 +12216,86 @@ def hls_stream(portalId, channelId, filename):
         
         # Start the HLS stream
         try:
-            stream_info = hls_manager.start_stream(portalId, channelId, link, proxy)
+            channelName = portal.get("custom channel names", {}).get(channelId) or channel.get("name")
+            occupancy_info = {
+                "mac": mac_used,
+                "channel id": channelId,
+                "channel name": f"{channelName} (HLS)",
+                "client": ip,
+                "portal name": portalName,
+                "start time": datetime.now(timezone.utc).timestamp(),
+            }
+            stream_info = hls_manager.start_stream(portalId, channelId, link, proxy, mac_used, occupancy_info, profile, streamsPerMac)
+            if stream_info is None:
+                response = make_response("No streams available", 503)
+                response.headers["Retry-After"] = "5"
+                return response
             
-            # Wait for file to be created
+            # Wait for file to be created (memory streams are woken by the ingest)
             is_passthrough = stream_info.get('is_passthrough', False)
             
             if filename.endswith('.m3u8'):
-                max_wait = 100 if not is_passthrough else 10
-                
-                for wait_count in range(max_wait):
-                    file_path = hls_manager.get_file(portalId, channelId, filename)
-                    if file_path:
-                        break
-                    time.sleep(0.1)
+                max_wait = 10 if not is_passthrough else 1
             else:
-                # For segments, wait a bit
-                for wait_count in range(30):
-                    file_path = hls_manager.get_file(portalId, channelId, filename)
-                    if file_path:
-                        break
-                    time.sleep(0.1)
+                max_wait = 3  # For segments, wait a bit
+            data, file_path = hls_manager.fetch(portalId, channelId, filename, max_wait)
         
         except Exception as e:
             logger.error(f"Error starting HLS stream: {e}")
             return make_response("Error starting stream", 500)
     
+    # Determine MIME type
+    if filename.endswith('.m3u8'):
+        mimetype = 'application/vnd.apple.mpegurl'
+    elif filename.endswith('.ts'):
+        mimetype = 'video/mp2t'
+    elif filename.endswith('.m4s'):
+        mimetype = 'video/iso.segment'
+    elif filename.endswith('.mp4'):
+        mimetype = 'video/mp4'
+    else:
+        mimetype = 'application/octet-stream'
+    
+    stream_info = hls_manager.streams.get(stream_key)
+    if stream_info and (data is not None or file_path):
+        if not filename.endswith(('.m3u8', '.mp4')):
+            hls_manager.record_first_segment(stream_info)
+        elif filename == "stream.m3u8" and stream_info.get('profile') == "low-latency" and not stream_info.get('is_passthrough'):
+            if data is None:
+                try:
+                    with open(file_path, 'rb') as f:
+                        data = f.read()
+                except OSError:
+                    pass
+            if data is not None:
+                data = HLSStreamManager.low_latency_playlist(data)
+    
     # Serve the file
-    if file_path and os.path.exists(file_path):
-        # Determine MIME type
+    if data is not None:
+        response = Response(data, mimetype=mimetype)
         if filename.endswith('.m3u8'):
-            mimetype = 'application/vnd.apple.mpegurl'
-        elif filename.endswith('.ts'):
-            mimetype = 'video/mp2t'
-        elif filename.endswith('.m4s'):
-            mimetype = 'video/iso.segment'
-        elif filename.endswith('.mp4'):
-            mimetype = 'video/mp4'
-        else:
-            mimetype = 'application/octet-stream'
-        
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    if file_path and os.path.exists(file_path):
         return send_file(file_path, mimetype=mimetype)
     else:
         logger.warning(f"File not found: {filename} for stream {stream_key}")
         return make_response("File not found", 404)
 
 
+@app.route("/hls-ingest/<token>/<path:filename>", methods=["PUT", "POST", "DELETE"])
+def hls_ingest(token, filename):
+    """Receive ffmpeg's HLS output for in-memory streams (per-stream secret token)."""
+    store = hls_manager.ingest.get(token) if hls_manager else None
+    if not store:
+        return make_response("Unknown stream", 404)
+    if request.method == "DELETE":
+        store.delete(filename)
+    else:
+        store.put(filename, request.get_data())
+    return make_response("", 201)
+
+
 @app.route("/dashboard")
 @authorise
 def dashboard():
@@ -9464,7 +12310,7 @@ def vavoo_page():
 @app.route("/streaming")
 @authorise
 def streaming():
-    return flask.jsonify(occupied)
+    return flask.jsonify(occupancy.snapshot())
 
 # Store server start time
 server_start_time = time.time()
@@ -9508,10 +12354,14 @@ def dashboard_stats():
     memory_info = {
         "xmltv_file_mb": xmltv_file_mb,  # File size, not RAM
         "xmltv_in_ram": False,  # XMLTV no longer cached in RAM
-        "occupied_streams": len(occupied),
-        "occupied_portals": len(occupied.keys()),
+        "occupied_streams": occupancy.total(),
+        "occupied_portals": len(occupancy.handles),
         "channel_cache_entries": len(channel_cache.ram_cache) if channel_cache and channel_cache.ram_cache else 0,
+        "channel_catalog_mb": round(sum(
+            catalog.memory_bytes() for catalog in list(channel_cache.catalogs.values())
+        ) / (1024*1024), 2) if channel_cache else 0,
         "hls_active_streams": len(hls_manager.streams) if hls_manager else 0,
+        "hls_memory_mb": round(hls_manager.memory_bytes() / (1024*1024), 2) if hls_manager else 0,
     }
     
     return flask.jsonify({
@@ -9519,6 +12369,8 @@ def dashboard_stats():
         "last_updated": last_update_time,
         "uptime_seconds": uptime_seconds,
         "memory_info": memory_info,
+        "hls_streams": hls_manager.get_stream_metrics() if hls_manager else [],
+        "hls_ttff": hls_manager.get_ttff_stats() if hls_manager else {},
         "cloudscraper": cloudscraper_status
     })
 
@@ -9606,9 +12458,7 @@ def refresh_lineup():
 
                 for mac in macs:
                     try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
+                        allChannels = stb.callWithSession(stb.getAllChannels, url, mac, proxy=proxy)
                         break
                     except:
                         allChannels = None
@@ -9698,6 +12548,20 @@ def cache_stats():
     """Get cache statistics."""
     try:
         stats = channel_cache.get_cache_stats()
+        portals = getPortals()
+        for portal_id, catalog_stats in stats.get("catalogs", {}).items():
+            catalog_stats["name"] = portals.get(portal_id, {}).get("name", portal_id)
+        stats["portal_sessions"] = stb.getSessionTokenStats()
+        stats["http_pools"] = stb.getPoolStats()
+        stats["stream_links"] = stb.getLinkCacheStats()
+        stats["shadowsocks_tunnels"] = shadowsocks_tunnels.get_stats()
+        stats["shared_streams"] = stream_broadcasts.get_stats()
+        stats["stream_probes"] = stream_probes.get_stats()
+        stats["source_codecs"] = source_codecs.get_stats()
+        stats["ffmpeg_pool"] = ffmpeg_pool.get_stats()
+        stats["slot_scheduler"] = slot_scheduler.get_stats()
+        if stream_frontend:
+            stats["stream_frontend"] = stream_frontend.get_stats()
         return jsonify({
             "success": True,
             "stats": stats
@@ -9932,8 +12796,23 @@ if __name__ == "__main__":
         inactive_timeout = 30
         logger.warning("Invalid 'hls inactive timeout' value, using default: 30")
     
+    try:
+        stream_probes.ttl = int(settings.get("stream probe ttl", "30"))
+    except (ValueError, TypeError):
+        logger.warning("Invalid 'stream probe ttl' value, using default: 30")
+    source_codecs.enabled = settings.get("audio copy", "true") == "true"
+    try:
+        ffmpeg_pool.max_size = int(settings.get("ffmpeg warm pool", "2"))
+    except ValueError:
+        pass
+    try:
+        stb.setLinkCacheTtl(settings.get("link cache ttl", "300"))
+    except ValueError:
+        pass
+    
     hls_manager = HLSStreamManager(max_streams=max_streams, inactive_timeout=inactive_timeout)
     hls_manager.start_monitoring()
+    ffmpeg_pool.start()
     logger.info(f"HLS Stream Manager initialized (max_streams={max_streams}, timeout={inactive_timeout}s)")
     
     # Channel-Cache läuft unbegrenzt - nur manueller Refresh über Dashboard
@@ -9944,19 +12823,25 @@ if __name__ == "__main__":
     logger.info("Starting automatic log cleanup (every 6 hours, deletes logs older than 24 hours)")
     schedule_log_cleanup()
     
-    # Start automatic cleanup of occupied streams dictionary (memory leak prevention)
-    logger.info("Starting automatic cleanup of occupied streams (every 5 minutes)")
-    cleanup_occupied_streams()
+    # Async stream front end owns the public port; waitress moves behind it
+    waitress_host, waitress_port = "0.0.0.0", 8001
+    if settings.get("async streaming", "true") == "true":
+        stream_frontend = AsyncStreamFrontend(app, "0.0.0.0", 8001, backend_port=8002)
+        if stream_frontend.start():
+            waitress_host, waitress_port = "127.0.0.1", 8002
+        else:
+            stream_frontend = None
+    hls_ingest_port = waitress_port
     
     # Waitress Performance Configuration
     # Optimized for high-performance streaming and concurrent requests
-    logger.info("Starting Waitress server on 0.0.0.0:8001")
+    logger.info(f"Starting Waitress server on {waitress_host}:{waitress_port}")
     logger.info("Performance: 48 threads, 8192 channel timeout, 1MB buffers")
     
     waitress.serve(
         app,
-        host="0.0.0.0",
-        port=8001,
+        host=waitress_host,
+        port=waitress_port,
         threads=48,                    # Increased from 24 to 48 for better concurrency
         channel_timeout=8192,          # Increased timeout for long-running streams (2+ hours)
         recv_bytes=1048576,            # 1MB receive buffer (better for large requests)
@@ -1,9 +1,12 @@
+import http.cookiejar
 import requests
 from requests.adapters import HTTPAdapter, Retry
 from urllib.parse import urlparse
 import re
 import logging
+import threading
 import time
+import weakref
 from utils import parse_proxy_url, validate_proxy_url, get_proxy_type, create_shadowsocks_session
 
 # Try to import cloudscraper for Cloudflare bypass
@@ -24,76 +27,479 @@ except Exception as e:
 logger = logging.getLogger("MacReplayXC.stb")
 logger.setLevel(logging.DEBUG)
 
-# Session management with periodic refresh to prevent memory leaks
-_session = None
-_session_created = 0
-_SESSION_MAX_AGE = 300  # Refresh session every 5 minutes
+# ============================================================================
+# HTTP Connection Pool Registry (one pooled session per portal host/proxy)
+# ============================================================================
 
+_pools = {}  # (host, proxy, cloudscraper) -> {'session', 'created', 'last_used', 'streams'}
+_pools_lock = threading.Lock()
+_POOL_CONNECTIONS = 4        # Distinct hosts cached per adapter (redirect targets, CDNs)
+_POOL_MAXSIZE = 32           # Keep-alive connections per host
+_POOL_IDLE_TIMEOUT = 600     # Close pools unused for 10 minutes
+_POOL_EVICT_INTERVAL = 60
+_pool_last_evict = 0
+_pool_stats = {"hits": 0, "misses": 0, "evictions": 0}
 
-def _get_session(use_cloudscraper=False):
-    """Get or create a requests session with automatic refresh."""
-    global _session, _session_created
-    
-    current_time = time.time()
+
+class _PortalCookiePolicy(http.cookiejar.DefaultCookiePolicy):
+    """Cookie policy for pooled sessions.
+
+    Pooled sessions are shared by every MAC of a portal, so only Cloudflare
+    clearance cookies are stored on them. Portal cookies (PHPSESSID-style
+    sessions) go to the per-MAC jars below.
+    """
+
+    def set_ok(self, cookie, request):
+        if not cookie.name.startswith(("cf_", "__cf")):
+            return False
+        return super().set_ok(cookie, request)
+
+
+class _MacCookiePolicy(http.cookiejar.DefaultCookiePolicy):
+    """Cookie policy for per-MAC jars: keep portal cookies, not the STB cookies we
+    send or the Cloudflare cookies the shared session already holds."""
+
+    STB_COOKIES = frozenset((
+        "mac", "stb_lang", "timezone", "deviceId", "deviceId2",
+        "serial_number", "sn", "rand",
+    ))
+
+    def set_ok(self, cookie, request):
+        if cookie.name in self.STB_COOKIES or cookie.name.startswith(("cf_", "__cf")):
+            return False
+        return super().set_ok(cookie, request)
+
+
+_mac_cookie_jars = {}  # (host, mac) -> RequestsCookieJar with the portal's cookies for that MAC
+_mac_cookie_jars_lock = threading.Lock()
+_MAC_COOKIE_RE = re.compile(r"(?:^|;\s*)mac=([^;]+)")
+
+
+def _mac_cookies(url, mac, cookies):
+    """Cookies for one portal request: the MAC's stored portal cookies plus the STB cookies."""
+    with _mac_cookie_jars_lock:
+        jar = _mac_cookie_jars.get((urlparse(url).netloc, mac))
+        request_jar = jar.copy() if jar is not None else requests.cookies.RequestsCookieJar()
+    return requests.cookies.cookiejar_from_dict(cookies, cookiejar=request_jar)
+
+
+def _mac_cookie_hook(response, *args, **kwargs):
+    """requests response hook: store Set-Cookie in the jar of the MAC that made the request."""
+    if "Set-Cookie" not in response.headers:
+        return
+    match = _MAC_COOKIE_RE.search(response.request.headers.get("Cookie", ""))
+    if not match:
+        return
+    key = (urlparse(response.request.url).netloc, match.group(1))
+    with _mac_cookie_jars_lock:
+        jar = _mac_cookie_jars.get(key)
+        if jar is None:
+            jar = requests.cookies.RequestsCookieJar(policy=_MacCookiePolicy())
+            _mac_cookie_jars[key] = jar
+        try:
+            requests.cookies.extract_cookies_to_jar(jar, response.request, response.raw)
+        except Exception as e:
+            logger.debug(f"Could not store portal cookies for MAC {key[1]}: {e}")
+
+
+def _drop_mac_cookies(url, mac=None):
+    """Forget stored portal cookies for one MAC, or for every MAC of the portal."""
+    host = urlparse(url).netloc
+    with _mac_cookie_jars_lock:
+        for key in [key for key in _mac_cookie_jars if key[0] == host and mac in (None, key[1])]:
+            del _mac_cookie_jars[key]
+
+
+def _create_pooled_session(use_cloudscraper=False):
+    """Create a session with tuned keep-alive connection pools."""
+    session = None
     
-    # Create new session if none exists or if too old
-    if _session is None or (current_time - _session_created) > _SESSION_MAX_AGE:
-        if _session is not None:
-            try:
-                _session.close()
-            except:
-                pass
-        
-        # Use cloudscraper if available and requested (for Cloudflare bypass)
-        if use_cloudscraper and CLOUDSCRAPER_AVAILABLE:
-            try:
-                _session = cloudscraper.create_scraper(
-                    browser={
-                        'browser': 'chrome',
-                        'platform': 'linux',
-                        'desktop': True
-                    }
-                )
-                logger.info(f"✅ CloudScraper session created (v{CLOUDSCRAPER_VERSION}) - Cloudflare bypass active")
-            except Exception as e:
-                logger.error(f"❌ Failed to create CloudScraper session: {e}")
-                logger.info("Falling back to regular requests session")
-                _session = requests.Session()
-                retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-                _session.mount("http://", HTTPAdapter(max_retries=retries))
-                _session.mount("https://", HTTPAdapter(max_retries=retries))
-        else:
-            _session = requests.Session()
-            retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-            _session.mount("http://", HTTPAdapter(max_retries=retries))
-            _session.mount("https://", HTTPAdapter(max_retries=retries))
-            if use_cloudscraper and not CLOUDSCRAPER_AVAILABLE:
-                logger.debug("CloudScraper requested but not available - using regular session")
-            else:
-                logger.debug("Created new requests session")
+    # Use cloudscraper if available and requested (for Cloudflare bypass)
+    if use_cloudscraper and CLOUDSCRAPER_AVAILABLE:
+        try:
+            session = cloudscraper.create_scraper(
+                browser={
+                    'browser': 'chrome',
+                    'platform': 'linux',
+                    'desktop': True
+                }
+            )
+            logger.info(f"✅ CloudScraper session created (v{CLOUDSCRAPER_VERSION}) - Cloudflare bypass active")
+        except Exception as e:
+            logger.error(f"❌ Failed to create CloudScraper session: {e}")
+            logger.info("Falling back to regular requests session")
+            session = None
+    elif use_cloudscraper:
+        logger.debug("CloudScraper requested but not available - using regular session")
+    
+    if session is None:
+        session = requests.Session()
+    
+    retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(
+        pool_connections=_POOL_CONNECTIONS,
+        pool_maxsize=_POOL_MAXSIZE,
+        max_retries=retries,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return _prepare_shared_session(session)
+
+
+def _evict_idle_pools(now):
+    """Close pools that have been idle longer than _POOL_IDLE_TIMEOUT."""
+    global _pool_last_evict
+    if now - _pool_last_evict < _POOL_EVICT_INTERVAL:
+        return
+    _pool_last_evict = now
+    
+    with _pools_lock:
+        # A pool still carrying an open stream (relay, probe) is in use, however old its last lookup
+        idle = [
+            key for key, pool in _pools.items()
+            if now - pool['last_used'] > _POOL_IDLE_TIMEOUT
+            and not any(not response.raw.closed for response in list(pool['streams']))
+        ]
+        evicted = [_pools.pop(key) for key in idle]
+        _pool_stats["evictions"] += len(evicted)
+    for pool in evicted:
+        try:
+            pool['session'].close()
+        except:
+            pass
+    if evicted:
+        logger.debug(f"Closed {len(evicted)} idle HTTP pool(s)")
+
+
+def _track_stream(session, response):
+    """Register an open streaming response so its pool is not evicted under it."""
+    with _pools_lock:
+        for pool in _pools.values():
+            if pool['session'] is session:
+                pool['streams'].add(response)
+                pool['last_used'] = time.time()
+                break
+
+
+def _get_session(use_cloudscraper=False, url=None, proxy=None):
+    """Get the pooled session for (portal host, proxy, cloudscraper)."""
+    host = urlparse(url).netloc if url else ""
+    key = (host, proxy or "", bool(use_cloudscraper))
+    now = time.time()
+    
+    _evict_idle_pools(now)
+    
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool:
+            pool['last_used'] = now
+            _pool_stats["hits"] += 1
+            return pool['session']
         
-        _session_created = current_time
-    
-    return _session
+        _pool_stats["misses"] += 1
+        session = _create_pooled_session(use_cloudscraper)
+        _pools[key] = {'session': session, 'created': now, 'last_used': now, 'streams': weakref.WeakSet()}
+        logger.debug(f"Created HTTP pool for {host or 'default'} (proxy: {'yes' if proxy else 'no'}, cloudscraper: {bool(use_cloudscraper)})")
+        return session
 
 
 def clear_session():
-    """Clear the session to free memory."""
-    global _session, _session_created
-    if _session is not None:
+    """Close all pooled sessions to free memory."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
         try:
-            _session.close()
+            pool['session'].close()
         except:
             pass
-        _session = None
-        _session_created = 0
-        logger.debug("Cleared requests session")
+    if pools:
+        logger.debug(f"Cleared {len(pools)} HTTP pool(s)")
+
+
+def getPoolStats():
+    """Get HTTP connection pool statistics."""
+    with _pools_lock:
+        pools = [
+            {
+                "host": host or "default",
+                "proxy": bool(proxy),
+                "cloudscraper": cloudscraper_used,
+                "idle_seconds": int(time.time() - pool['last_used']),
+                "open_streams": sum(not response.raw.closed for response in list(pool['streams'])),
+            }
+            for (host, proxy, cloudscraper_used), pool in _pools.items()
+        ]
+        return dict(_pool_stats, active=len(pools), pools=pools)
+
+
+# ============================================================================
+# Portal Session Store (token + profile reuse per portal/MAC/proxy)
+# ============================================================================
+
+# (url, mac, proxy) -> {'token', 'profile', 'created', 'last_used', 'uses'}
+_session_tokens = {}
+_session_tokens_lock = threading.Lock()
+_session_handshake_locks = {}
+_SESSION_TOKEN_TTL = 1800  # Re-handshake after 30 minutes
+_session_token_stats = {"hits": 0, "handshakes": 0, "rehandshakes": 0, "failures": 0}
+_rejected_tokens = set()  # Tokens a portal answered with 401/403 or "Authorization failed"
+
+
+def _auth_rejection_hook(response, *args, **kwargs):
+    """requests response hook: remember bearer tokens the portal rejected."""
+    auth = response.request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer ") or auth == "Bearer undefined":
+        return
+    rejected = response.status_code in (401, 403)
+    if not rejected and response.status_code == 200:
+        try:
+            rejected = b"Authorization failed" in response.content[:1024]
+        except Exception:
+            pass
+    if rejected:
+        with _session_tokens_lock:
+            if len(_rejected_tokens) > 256:
+                _rejected_tokens.clear()  # Rejections nobody asked about (plain calls without callWithSession)
+            _rejected_tokens.add(auth[len("Bearer "):])
+
+
+def _prepare_shared_session(session):
+    """Set up a session shared by all MACs: Cloudflare-only cookie store and response hooks."""
+    if not isinstance(session.cookies.get_policy(), _PortalCookiePolicy):
+        session.cookies.set_policy(_PortalCookiePolicy())
+    for hook in (_auth_rejection_hook, _mac_cookie_hook):
+        if hook not in session.hooks["response"]:
+            session.hooks["response"].append(hook)
+    return session
+
+
+def _session_token_key(url, mac, proxy=None):
+    return (url, mac, proxy or "")
+
+
+def _get_session_entry(url, mac, proxy=None, force=False):
+    """Return (entry, reused) for a portal session, handshaking if needed."""
+    key = _session_token_key(url, mac, proxy)
+    with _session_tokens_lock:
+        handshake_lock = _session_handshake_locks.setdefault(key, threading.Lock())
+
+    # One handshake per key at a time - concurrent callers wait and reuse it
+    with handshake_lock:
+        now = time.time()
+        entry = _session_tokens.get(key)
+        if entry and not force and (now - entry['created']) < _SESSION_TOKEN_TTL:
+            entry['last_used'] = now
+            entry['uses'] += 1
+            with _session_tokens_lock:
+                _session_token_stats["hits"] += 1
+            return entry, True
+
+        token = getToken(url, mac, proxy)
+        if not token:
+            with _session_tokens_lock:
+                _session_token_stats["failures"] += 1
+                _session_tokens.pop(key, None)
+            return None, False
+
+        profile = getProfile(url, mac, token, proxy)
+        entry = {
+            'token': token,
+            'profile': profile or {},
+            'created': now,
+            'last_used': now,
+            'uses': 1,
+        }
+        with _session_tokens_lock:
+            _session_tokens[key] = entry
+            _session_token_stats["handshakes"] += 1
+        logger.debug(f"Portal session established for MAC {mac}")
+        return entry, False
+
+
+def getSessionToken(url, mac, proxy=None, force=False):
+    """Get a handshaken token for (portal, MAC, proxy), reusing a cached one.
+
+    getToken + getProfile only run when no token is cached, the cached one is
+    older than _SESSION_TOKEN_TTL, or force=True.
+    """
+    entry, _ = _get_session_entry(url, mac, proxy, force)
+    return entry['token'] if entry else None
+
+
+def getSessionProfile(url, mac, proxy=None):
+    """Get the profile fetched during the cached handshake (handshakes if needed)."""
+    entry, _ = _get_session_entry(url, mac, proxy)
+    return entry['profile'] if entry else {}
+
+
+def invalidateSessionToken(url, mac, proxy=None):
+    """Drop the cached token so the next call performs a fresh handshake."""
+    with _session_tokens_lock:
+        removed = _session_tokens.pop(_session_token_key(url, mac, proxy), None)
+    _drop_mac_cookies(url, mac)
+    if removed:
+        logger.debug(f"Invalidated portal session for MAC {mac}")
 
 
-def _get_proxy_session(proxy=None, use_cloudscraper=False):
+def invalidatePortalSessions(url):
+    """Drop all cached tokens for a portal (all MACs and proxies)."""
+    with _session_tokens_lock:
+        keys = [key for key in _session_tokens if key[0] == url]
+        for key in keys:
+            del _session_tokens[key]
+    _drop_mac_cookies(url)
+    return len(keys)
+
+
+def callWithSession(func, url, mac, *args, proxy=None, **kwargs):
+    """Call a portal API function with the cached session token.
+
+    func is called as func(url, mac, token, *args, proxy=proxy, **kwargs).
+    If the portal rejected a reused token (401/403 or "Authorization failed",
+    seen by _auth_rejection_hook) the session is re-handshaken once and the
+    call repeated. Legitimately empty results keep the session.
+    """
+    entry, reused = _get_session_entry(url, mac, proxy)
+    if not entry:
+        return None
+
+    token = entry['token']
+    result = func(url, mac, token, *args, proxy=proxy, **kwargs)
+    with _session_tokens_lock:
+        rejected = token in _rejected_tokens
+        _rejected_tokens.discard(token)
+    if not result and reused and rejected:
+        logger.info(f"Cached token for MAC {mac} rejected - re-handshaking")
+        with _session_tokens_lock:
+            _session_token_stats["rehandshakes"] += 1
+        entry, _ = _get_session_entry(url, mac, proxy, force=True)
+        if entry:
+            result = func(url, mac, entry['token'], *args, proxy=proxy, **kwargs)
+    return result
+
+
+def getSessionTokenStats():
+    """Get portal session store statistics."""
+    with _session_tokens_lock:
+        return dict(_session_token_stats, entries=len(_session_tokens), ttl=_SESSION_TOKEN_TTL)
+
+
+# ============================================================================
+# Stream Link Cache (create_link results per portal/MAC/cmd)
+# ============================================================================
+
+# (url, mac, kind, cmd, args, proxy) -> {'link', 'created', 'hits'}
+_stream_links = {}
+_stream_link_keys = {}  # link -> cache key, for invalidation by URL
+_stream_links_lock = threading.Lock()
+_link_ttls = {}  # url -> learned TTL in seconds (starts at _link_ttl_max)
+_link_ttl_max = 300  # Configured ceiling, 0 = cache disabled
+_LINK_TTL_GROWTH = 1.25  # Recovery per link that expired unharmed after being reused
+_LINK_TTL_CUT = 0.5  # Rejected at age a -> TTL a * _LINK_TTL_CUT
+_LINK_REJECT_STATUS = (403, 404)
+_stream_link_stats = {"hits": 0, "misses": 0, "expired": 0, "invalidations": 0, "ttl_cuts": 0}
+_FFMPEG_HTTP_REJECT = re.compile(r"(?:Server returned|HTTP error) (403|404)")
+
+
+def setLinkCacheTtl(seconds):
+    """Set the link cache TTL ceiling (0 disables the cache); learned TTLs start over from it."""
+    global _link_ttl_max
+    _link_ttl_max = max(0, int(seconds))
+    with _stream_links_lock:
+        _link_ttls.clear()
+        if not _link_ttl_max:
+            _stream_links.clear()
+            _stream_link_keys.clear()
+
+
+def _drop_link(key):
+    entry = _stream_links.pop(key, None)
+    if entry:
+        _stream_link_keys.pop(entry['link'], None)
+    return entry
+
+
+def getCachedLink(func, url, mac, cmd, *args, proxy=None, refresh=False):
+    """Get a create_link URL, reusing one the portal handed out recently.
+
+    func is getLink, getVodLink or getSeriesLink, called via callWithSession.
+    Links are kept for the portal's learned TTL (see invalidateLink).
+    refresh=True drops the cached link and asks the portal for a new one.
+    Returns (link, reused).
+    """
+    key = (url, mac, func.__name__, cmd, args, proxy or "")
+    now = time.time()
+    with _stream_links_lock:
+        ttl = _link_ttls.setdefault(url, _link_ttl_max)
+        entry = _drop_link(key) if refresh else _stream_links.get(key)
+        if entry and not refresh:
+            if now - entry['created'] < ttl:
+                entry['hits'] += 1
+                _stream_link_stats["hits"] += 1
+                return entry['link'], True
+            # Outlived the TTL without a rejection - the portal may allow longer
+            _drop_link(key)
+            _stream_link_stats["expired"] += 1
+            if entry['hits']:
+                _link_ttls[url] = min(_link_ttl_max, max(ttl + 1, int(ttl * _LINK_TTL_GROWTH)))
+        _stream_link_stats["misses"] += 1
+
+    link = callWithSession(func, url, mac, cmd, *args, proxy=proxy)
+    if link and ttl >= 1:
+        with _stream_links_lock:
+            _drop_link(key)
+            _stream_links[key] = {'link': link, 'created': time.time(), 'hits': 0}
+            _stream_link_keys[link] = key
+    return link, False
+
+
+def invalidateLink(link, status=None):
+    """Drop a cached link the upstream rejected.
+
+    A reused link rejected with 403/404 before its TTL ran out shows how long
+    the portal's links really live: that portal's TTL is cut to a fraction of
+    the link's age. Returns True if a cached link was dropped.
+    """
+    if not link:
+        return False
+    with _stream_links_lock:
+        key = _stream_link_keys.get(link)
+        entry = _drop_link(key) if key else None
+        if not entry:
+            return False
+        _stream_link_stats["invalidations"] += 1
+        if entry['hits'] and status in _LINK_REJECT_STATUS:
+            url = key[0]
+            age = time.time() - entry['created']
+            ttl = int(age * _LINK_TTL_CUT)
+            if ttl < _link_ttls.get(url, _link_ttl_max):
+                _link_ttls[url] = ttl
+                _stream_link_stats["ttl_cuts"] += 1
+                logger.info(f"Portal links expire after ~{int(age)}s - link cache TTL for {url} now {ttl}s")
+    logger.debug(f"Invalidated cached stream link ({status}): {link[:50]}...")
+    return True
+
+
+def invalidateLinkFromLog(link, line):
+    """invalidateLink for an ffmpeg stderr line reporting a 403/404 from the upstream."""
+    match = _FFMPEG_HTTP_REJECT.search(line)
+    return invalidateLink(link, int(match.group(1))) if match else False
+
+
+def getLinkCacheStats():
+    """Get stream link cache statistics (hit rate, learned TTL per portal)."""
+    with _stream_links_lock:
+        stats = dict(_stream_link_stats, entries=len(_stream_links), ttl_max=_link_ttl_max, portal_ttls=dict(_link_ttls))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups * 100, 1) if lookups else 0
+    return stats
+
+
+def _get_proxy_session(proxy=None, use_cloudscraper=False, url=None):
     """Get a session configured for the specified proxy type."""
     if not proxy:
-        return _get_session(use_cloudscraper)
+        return _get_session(use_cloudscraper, url=url)
     
     proxy_config = parse_proxy_url(proxy)
     proxy_type = get_proxy_type(proxy)
@@ -103,13 +509,13 @@ def _get_proxy_session(proxy=None, use_cloudscraper=False):
         ss_session = create_shadowsocks_session(proxy_config)
         if ss_session:
             logger.debug(f"Using Shadowsocks session for proxy: {proxy}")
-            return ss_session
+            return _prepare_shared_session(ss_session)
         else:
             logger.warning(f"Failed to create Shadowsocks session, falling back to regular session")
-            return _get_session(use_cloudscraper)
+            return _get_session(use_cloudscraper, url=url)
     else:
-        # Use regular session for HTTP/SOCKS proxies
-        return _get_session(use_cloudscraper)
+        # Use pooled session for HTTP/SOCKS proxies (proxies are passed per request)
+        return _get_session(use_cloudscraper, url=url, proxy=proxy)
 
 
 def getUrl(url, proxy=None):
@@ -175,7 +581,7 @@ def getUrl(url, proxy=None):
     }
 
     # Get appropriate session based on proxy type
-    session = _get_proxy_session(proxy, use_cloudscraper=True)
+    session = _get_proxy_session(proxy, use_cloudscraper=True, url=url)
     for path in urls:
         try:
             test_url = base_url + path
@@ -196,7 +602,7 @@ def getUrl(url, proxy=None):
     # Try without proxy (some portals don't like proxies) - skip for Shadowsocks
     if proxy_type != 'shadowsocks':
         logger.debug("Retrying without proxy...")
-        no_proxy_session = _get_session(use_cloudscraper=True)
+        no_proxy_session = _get_session(use_cloudscraper=True, url=url)
         for path in urls:
             try:
                 test_url = base_url + path
@@ -216,44 +622,210 @@ def getUrl(url, proxy=None):
     return None
 
 
+# ============================================================================
+# Portal Handshake Hints (memoized endpoint, STB model and HTTP methods)
+# ============================================================================
+
+# STB header profiles tried during handshake discovery (in this order)
+_STB_MODELS = {
+    "MAG250": {
+        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3",
+        "X-User-Agent": "Model: MAG250; Link: WiFi; MAC: {mac}",  # MAC matches legacy logic
+    },
+    "MAG254": {
+        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 4 rev: 2712 Safari/533.3",
+        "X-User-Agent": "Model: MAG254; Link: WiFi",
+    },
+    "MAG420": {
+        "User-Agent": "Mozilla/5.0 (Linux; Android 7.0; MAG420) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.84 Mobile Safari/537.36",
+        "X-User-Agent": "Model: MAG420; Link: WiFi",
+    },
+}
+
+# url -> {'handshake_url': str, 'model': str, 'methods': {action: 'GET'|'POST'}}
+_portal_hints = {}
+_portal_hints_lock = threading.Lock()
+_handshake_failures = {}  # url -> consecutive failures of the memoized handshake (any MAC), guarded by _portal_hints_lock
+_HINT_MAX_FAILURES = 3  # Re-run full discovery after this many failures in a row
+_DISCOVERY_COOLDOWN = 300  # Min seconds between failure-triggered rediscoveries of one portal
+_last_discovery = {}  # url -> time of the last failure-triggered discovery
+_portal_hints_listener = None
+
+
+def setPortalHintsListener(listener):
+    """Register a callback(url, hints) invoked when learned hints change (for persistence)."""
+    global _portal_hints_listener
+    _portal_hints_listener = listener
+
+
+def loadPortalHints(url, hints):
+    """Seed memoized handshake hints for a portal (e.g. from the portal config)."""
+    if not url or not hints:
+        return
+    with _portal_hints_lock:
+        _portal_hints[url] = {
+            'handshake_url': hints.get('handshake_url', ''),
+            'model': hints.get('model', ''),
+            'methods': dict(hints.get('methods', {})),
+        }
+
+
+def getPortalHints(url):
+    """Get a copy of the memoized handshake hints for a portal."""
+    with _portal_hints_lock:
+        hints = _portal_hints.get(url)
+        if not hints:
+            return {}
+        return dict(hints, methods=dict(hints['methods']))
+
+
+def _update_portal_hints(url, handshake_url=None, model=None, method_action=None, method=None):
+    """Update memoized hints and notify the listener if anything changed."""
+    with _portal_hints_lock:
+        hints = _portal_hints.setdefault(url, {'handshake_url': '', 'model': '', 'methods': {}})
+        before = (hints['handshake_url'], hints['model'], dict(hints['methods']))
+        if handshake_url is not None:
+            hints['handshake_url'] = handshake_url
+        if model is not None:
+            hints['model'] = model
+        if method_action:
+            hints['methods'][method_action] = method
+        changed = before != (hints['handshake_url'], hints['model'], hints['methods'])
+        snapshot = dict(hints, methods=dict(hints['methods']))
+
+    if changed and _portal_hints_listener:
+        try:
+            _portal_hints_listener(url, snapshot)
+        except Exception as e:
+            logger.error(f"Error persisting portal hints: {e}")
+
+
+def _record_handshake(url, ok):
+    """Count consecutive memoized-handshake failures per portal; returns the new count."""
+    with _portal_hints_lock:
+        if ok:
+            _handshake_failures.pop(url, None)
+            return 0
+        failures = _handshake_failures.get(url, 0) + 1
+        _handshake_failures[url] = failures
+        return failures
+
+
+def _claim_rediscovery(url):
+    """True if the portal's hint failed often enough and no rediscovery ran recently."""
+    now = time.time()
+    with _portal_hints_lock:
+        if _handshake_failures.get(url, 0) < _HINT_MAX_FAILURES:
+            return False
+        if now - _last_discovery.get(url, 0) < _DISCOVERY_COOLDOWN:
+            return False
+        _last_discovery[url] = now
+        return True
+
+
+def _portal_request(url, action, params, cookies, headers, proxy, timeout, parse):
+    """Send a portal API request, trying the memoized GET/POST method first.
+
+    parse(response) returns the result or raises/returns None on failure.
+    The method that produced a result is remembered per portal and action.
+    """
+    proxies = parse_proxy_url(proxy) if proxy else None
+    proxy_type = get_proxy_type(proxy) if proxy else 'none'
+    request_proxies = None if proxy_type == 'shadowsocks' else proxies
+
+    methods = ["GET", "POST"]
+    if getPortalHints(url).get('methods', {}).get(action) == "POST":
+        methods = ["POST", "GET"]
+
+    for method in methods:
+        try:
+            session = _get_proxy_session(proxy, url=url)
+            if method == "GET":
+                response = session.get(url, params=params, cookies=cookies, headers=headers,
+                                       proxies=request_proxies, timeout=timeout)
+            else:
+                response = session.post(url, data=params, cookies=cookies, headers=headers,
+                                        proxies=request_proxies, timeout=timeout)
+            result = parse(response)
+            if result:
+                _update_portal_hints(url, method_action=action, method=method)
+                return result
+        except requests.Timeout:
+            logger.debug(f"{method} {action} timed out for {url}")
+        except Exception as e:
+            logger.debug(f"{method} {action} failed: {e}")
+    return None
+
+
+def _parse_token(response):
+    if response.status_code == 200:
+        data = response.json()
+        if "js" in data and "token" in data["js"]:
+            return data["js"]["token"] or None
+    return None
+
+
 def getToken(url, mac, proxy=None):
-    """Get token with support for multiple portal endpoints."""
+    """Get token with support for multiple portal endpoints.
+
+    The endpoint and STB model that last worked for a portal are tried first.
+    A failing hint is only retried; full endpoint/model discovery runs again
+    once the portal's hint failed _HINT_MAX_FAILURES times in a row (any MAC),
+    at most once per _DISCOVERY_COOLDOWN seconds.
+    """
     # Parse proxy configuration for all proxy types
     proxies = parse_proxy_url(proxy) if proxy else None
     proxy_type = get_proxy_type(proxy) if proxy else 'none'
+    request_proxies = None if proxy_type == 'shadowsocks' else proxies
+
     # Prepare enhanced cookies and headers
-    import hashlib
-    import random
-    import string
-    
-    # Generate device IDs based on MAC
-    device_id = hashlib.sha256(mac.encode()).hexdigest()
-    device_id2 = hashlib.sha256((mac + "salt").encode()).hexdigest()
-    serial_number = hashlib.md5(mac.encode()).hexdigest().upper()
-    random_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
-    
-    cookies = {
-        "mac": mac,
-        "stb_lang": "en",
-        "timezone": "Europe/London",
-        "deviceId": device_id,
-        "deviceId2": device_id2,
-        "serial_number": serial_number,
-        "sn": serial_number,
-        "rand": random_id
-    }
-    
+    cookies = _mac_cookies(url, mac, _get_enhanced_cookies(mac))
+
     # Enhanced headers to bypass protections
     parsed = urlparse(url)
     base_url = f"{parsed.scheme}://{parsed.netloc}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3",
-        "Accept": "*/*",
-        "Referer": base_url + "/",
-        "X-User-Agent": f"Model: MAG250; Link: WiFi; MAC: {mac}", # Added MAC to match legacy logic
-        "Authorization": "Bearer undefined"
-    }
-    
+
+    def build_headers(model):
+        return {
+            "User-Agent": _STB_MODELS[model]["User-Agent"],
+            "Accept": "*/*",
+            "Referer": base_url + "/",
+            "X-User-Agent": _STB_MODELS[model]["X-User-Agent"].format(mac=mac),
+            "Authorization": "Bearer undefined"
+        }
+
+    def try_handshake(full_url, model):
+        response = _get_proxy_session(proxy, url=url).get(
+            full_url,
+            cookies=cookies,
+            headers=build_headers(model),
+            proxies=request_proxies,
+            timeout=20,
+        )
+        logger.debug(f"Token request status ({model}): {response.status_code}")
+        return response, _parse_token(response)
+
+    # 1. Memoized endpoint + model
+    hints = getPortalHints(url)
+    if hints.get('handshake_url') and hints.get('model') in _STB_MODELS:
+        full_url = hints['handshake_url']
+        try:
+            logger.debug(f"Trying memoized token endpoint: {full_url} ({hints['model']})")
+            _, token = try_handshake(full_url, hints['model'])
+            if token:
+                _record_handshake(url, True)
+                logger.info(f"Successfully got token for MAC {mac} using memoized endpoint: {full_url}")
+                return token
+        except Exception as e:
+            logger.debug(f"Memoized token endpoint failed: {e}")
+
+        failures = _record_handshake(url, False)
+        if not _claim_rediscovery(url):
+            logger.error(f"Failed to get token for MAC {mac} from memoized endpoint ({failures}/{_HINT_MAX_FAILURES})")
+            return None
+        logger.info(f"Memoized endpoint failed {failures} times for {url} - running full discovery")
+
+    # 2. Full discovery
     # If URL already contains a path (like /c/ or /stalker_portal/), use it
     url_path = parsed.path.rstrip('/')
     
@@ -291,70 +863,25 @@ def getToken(url, mac, proxy=None):
                 full_url = url + endpoint
             
             logger.debug(f"Trying token endpoint: {full_url}")
-            session = _get_proxy_session(proxy)
-            request_proxies = None if proxy_type == 'shadowsocks' else proxies
-            response = session.get(
-                full_url,
-                cookies=cookies,
-                headers=headers,
-                proxies=request_proxies,
-                timeout=20,
-            )
-            logger.debug(f"Token request status: {response.status_code}")
-            
-            # Try to parse response
-            if response.status_code == 200:
-                data = response.json()
-                if "js" in data and "token" in data["js"]:
-                    token = data["js"]["token"]
-                    if token:
-                        logger.info(f"Successfully got token for MAC {mac} using endpoint: {full_url}")
-                        return token
-            elif response.status_code == 403:
+            response, token = try_handshake(full_url, "MAG250")
+            if token:
+                _record_handshake(url, True)
+                logger.info(f"Successfully got token for MAC {mac} using endpoint: {full_url}")
+                _update_portal_hints(url, handshake_url=full_url, model="MAG250")
+                return token
+
+            if response.status_code == 403:
                 logger.debug(f"403 Forbidden on endpoint {endpoint} - trying MAG254/MAG420 headers and cookies")
-                
-                # Try with MAG254 headers
-                headers_mag254 = headers.copy()
-                headers_mag254["User-Agent"] = "Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 4 rev: 2712 Safari/533.3"
-                headers_mag254["X-User-Agent"] = "Model: MAG254; Link: WiFi"
-                
                 try:
-                    response = session.get(
-                        full_url,
-                        cookies=cookies,
-                        headers=headers_mag254,
-                        proxies=request_proxies,
-                        timeout=20,
-                    )
-                    if response.status_code == 200:
-                        data = response.json()
-                        if "js" in data and "token" in data["js"]:
-                            token = data["js"]["token"]
-                            if token:
-                                logger.info(f"Successfully got token for MAC {mac} using endpoint: {full_url} (MAG254 fallback)")
-                                return token
-                            
-                    # Start MAG 420 Fallback
-                    if response.status_code == 403:
-                         headers_mag420 = headers.copy()
-                         headers_mag420["User-Agent"] = "Mozilla/5.0 (Linux; Android 7.0; MAG420) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.84 Mobile Safari/537.36"
-                         headers_mag420["X-User-Agent"] = "Model: MAG420; Link: WiFi"
-                         
-                         response = session.get(
-                            full_url,
-                            cookies=cookies,
-                            headers=headers_mag420,
-                            proxies=request_proxies,
-                            timeout=20,
-                        )
-                         if response.status_code == 200:
-                            data = response.json()
-                            if "js" in data and "token" in data["js"]:
-                                token = data["js"]["token"]
-                                if token:
-                                    logger.info(f"Successfully got token for MAC {mac} using endpoint: {full_url} (MAG420 fallback)")
-                                    return token
-
+                    for model in ("MAG254", "MAG420"):
+                        response, token = try_handshake(full_url, model)
+                        if token:
+                            _record_handshake(url, True)
+                            logger.info(f"Successfully got token for MAC {mac} using endpoint: {full_url} ({model} fallback)")
+                            _update_portal_hints(url, handshake_url=full_url, model=model)
+                            return token
+                        if response.status_code != 403:
+                            break
                 except:
                     pass
 
@@ -399,7 +926,7 @@ def getProfile(url, mac, token, proxy=None):
     proxies = parse_proxy_url(proxy) if proxy else None
     proxy_type = get_proxy_type(proxy) if proxy else 'none'
     
-    cookies = _get_enhanced_cookies(mac)
+    cookies = _mac_cookies(url, mac, _get_enhanced_cookies(mac))
     
     # Enhanced headers
     parsed = urlparse(url)
@@ -424,7 +951,7 @@ def getProfile(url, mac, token, proxy=None):
              profile_url = f"{url}/portal.php?type=stb&action=get_profile&JsHttpRequest=1-xml"
              
         logger.debug(f"Getting profile for MAC {mac}")
-        session = _get_proxy_session(proxy)
+        session = _get_proxy_session(proxy, url=url)
         request_proxies = None if proxy_type == 'shadowsocks' else proxies
         
         response = session.get(
@@ -479,7 +1006,7 @@ def getExpires(url, mac, token, proxy=None):
     proxies = parse_proxy_url(proxy) if proxy else None
     proxy_type = get_proxy_type(proxy) if proxy else 'none'
     
-    cookies = _get_enhanced_cookies(mac)
+    cookies = _mac_cookies(url, mac, _get_enhanced_cookies(mac))
     
     # Enhanced headers
     parsed = urlparse(url)
@@ -504,7 +1031,7 @@ def getExpires(url, mac, token, proxy=None):
              expires_url = f"{url}/portal.php?type=account_info&action=get_main_info&JsHttpRequest=1-xml"
 
         logger.debug(f"Getting expiry for MAC {mac}")
-        session = _get_proxy_session(proxy)
+        session = _get_proxy_session(proxy, url=url)
         request_proxies = None if proxy_type == 'shadowsocks' else proxies
         
         response = session.get(
@@ -551,10 +1078,7 @@ def getExpires(url, mac, token, proxy=None):
 
 def getAllChannels(url, mac, token, proxy=None):
     """Get all channels with support for GET and POST methods."""
-    # Parse proxy configuration for all proxy types
-    proxies = parse_proxy_url(proxy) if proxy else None
-    proxy_type = get_proxy_type(proxy) if proxy else 'none'
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     
     # Enhanced headers
     parsed = urlparse(url)
@@ -574,59 +1098,22 @@ def getAllChannels(url, mac, token, proxy=None):
         "JsHttpRequest": "1-xml"
     }
     
-    # Try GET first (standard)
-    try:
-        logger.debug(f"Getting all channels for MAC {mac} (GET)")
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.get(
-            url,
-            params=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=30,
-        )
+    def parse(response):
         logger.debug(f"Channels request status: {response.status_code}")
-        channels = response.json()["js"]["data"]
-        if channels:
-            logger.info(f"Got {len(channels)} channels for MAC {mac}")
-            return channels
-    except Exception as e:
-        logger.debug(f"GET request failed: {e}, trying POST")
+        return response.json()["js"]["data"]
     
-    # Try POST as fallback (some portals require this)
-    try:
-        logger.debug(f"Getting all channels for MAC {mac} (POST)")
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.post(
-            url,
-            data=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=30,
-        )
-        logger.debug(f"Channels request status: {response.status_code}")
-        channels = response.json()["js"]["data"]
-        if channels:
-            logger.info(f"Got {len(channels)} channels for MAC {mac} via POST")
-            return channels
-    except requests.Timeout:
-        logger.error(f"Timeout getting channels for MAC {mac}")
-    except requests.RequestException as e:
-        logger.error(f"Request error getting channels for MAC {mac}: {e}")
-    except Exception as e:
-        logger.error(f"Error getting channels for MAC {mac}: {e}")
+    # Memoized method first, then the other one (some portals require POST)
+    logger.debug(f"Getting all channels for MAC {mac}")
+    channels = _portal_request(url, "get_all_channels", params, cookies, headers, proxy, 30, parse)
+    if channels:
+        logger.info(f"Got {len(channels)} channels for MAC {mac}")
+        return channels
+    logger.error(f"Error getting channels for MAC {mac}")
 
 
 def getGenres(url, mac, token, proxy=None):
     """Get genres with support for GET and POST methods."""
-    # Parse proxy configuration for all proxy types
-    proxies = parse_proxy_url(proxy) if proxy else None
-    proxy_type = get_proxy_type(proxy) if proxy else 'none'
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -638,43 +1125,8 @@ def getGenres(url, mac, token, proxy=None):
         "JsHttpRequest": "1-xml"
     }
     
-    # Try GET first
-    try:
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.get(
-            url,
-            params=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=10,
-        )
-        genreData = response.json()["js"]
-        if genreData:
-            return genreData
-    except Exception as e:
-        logger.debug(f"GET genres failed: {e}, trying POST")
-    
-    # Try POST as fallback
-    try:
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.post(
-            url,
-            data=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=10,
-        )
-        genreData = response.json()["js"]
-        if genreData:
-            return genreData
-    except:
-        pass
-    
-    return None
+    return _portal_request(url, "get_genres", params, cookies, headers, proxy, 10,
+                           lambda response: response.json()["js"])
 
 
 def getGenreNames(url, mac, token, proxy=None):
@@ -693,9 +1145,7 @@ def getGenreNames(url, mac, token, proxy=None):
 
 def getLink(url, mac, token, cmd, proxy=None):
     """Get stream link with support for GET and POST methods."""
-    proxies = parse_proxy_url(proxy) if proxy else None
-    proxy_type = get_proxy_type(proxy) if proxy else 'none'
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -713,52 +1163,35 @@ def getLink(url, mac, token, cmd, proxy=None):
         "JsHttpRequest": "1-xml"
     }
     
-    # Try GET first
-    try:
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.get(
-            url,
-            params=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=10,
-        )
-        data = response.json()
-        link = data["js"]["cmd"].split()[-1]
-        if link:
-            return link
-    except Exception as e:
-        logger.debug(f"GET link failed: {e}, trying POST")
-    
-    # Try POST as fallback
-    try:
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.post(
-            url,
-            data=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=10,
-        )
-        data = response.json()
-        link = data["js"]["cmd"].split()[-1]
-        if link:
-            return link
-    except:
-        pass
+    return _portal_request(url, "create_link", params, cookies, headers, proxy, 10,
+                           lambda response: response.json()["js"]["cmd"].split()[-1])
+
+
+def openStream(link, proxy=None, timeout=10):
+    """Open a streaming GET for a play link on the pooled session (follows redirects).
     
-    return None
+    The caller reads response.raw and must close the response.
+    """
+    proxies = parse_proxy_url(proxy) if proxy else None
+    proxy_type = get_proxy_type(proxy) if proxy else 'none'
+    request_proxies = None if proxy_type == 'shadowsocks' else proxies
+    headers = {
+        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
+        "Accept-Encoding": "identity",  # Relay the bytes as sent
+    }
+    session = _get_proxy_session(proxy, url=link)
+    response = session.get(link, headers=headers, proxies=request_proxies,
+                           stream=True, timeout=timeout, allow_redirects=True)
+    _track_stream(session, response)
+    if response.status_code in _LINK_REJECT_STATUS:
+        invalidateLink(link, response.status_code)
+    response.raise_for_status()
+    return response
 
 
 def getEpg(url, mac, token, period, proxy=None):
     """Get EPG with support for GET and POST methods."""
-    proxies = parse_proxy_url(proxy) if proxy else None
-    proxy_type = get_proxy_type(proxy) if proxy else 'none'
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -771,47 +1204,12 @@ def getEpg(url, mac, token, period, proxy=None):
         "JsHttpRequest": "1-xml"
     }
     
-    # Try GET first
-    try:
-        logger.debug(f"Getting EPG for MAC {mac} (GET)")
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.get(
-            url,
-            params=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=30,
-        )
-        data = response.json()["js"]["data"]
-        if data:
-            logger.debug(f"Got EPG data for {len(data)} channels via GET")
-            return data
-    except Exception as e:
-        logger.debug(f"GET EPG failed: {e}, trying POST")
-    
-    # Try POST as fallback
-    try:
-        logger.debug(f"Getting EPG for MAC {mac} (POST)")
-        session = _get_proxy_session(proxy)
-        request_proxies = None if proxy_type == 'shadowsocks' else proxies
-        response = session.post(
-            url,
-            data=params,
-            cookies=cookies,
-            headers=headers,
-            proxies=request_proxies,
-            timeout=30,
-        )
-        data = response.json()["js"]["data"]
-        if data:
-            logger.debug(f"Got EPG data for {len(data)} channels via POST")
-            return data
-    except Exception as e:
-        logger.debug(f"POST EPG failed: {e}")
-    
-    return None
+    logger.debug(f"Getting EPG for MAC {mac}")
+    data = _portal_request(url, "get_epg_info", params, cookies, headers, proxy, 30,
+                           lambda response: response.json()["js"]["data"])
+    if data:
+        logger.debug(f"Got EPG data for {len(data)} channels")
+    return data
 
 
 def parseM3U(content):
@@ -877,7 +1275,7 @@ def getM3UChannels(url, proxy=None):
     
     try:
         logger.debug(f"Fetching M3U playlist from {url}")
-        session = _get_proxy_session(proxy)
+        session = _get_proxy_session(proxy, url=url)
         request_proxies = None if proxy_type == 'shadowsocks' else proxies
         response = session.get(
             url,
@@ -907,7 +1305,7 @@ def getVodCategories(url, mac, token, proxy=None):
     """
     proxies = parse_proxy_url(proxy) if proxy else None
     proxy_type = get_proxy_type(proxy) if proxy else 'none'
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -921,7 +1319,7 @@ def getVodCategories(url, mac, token, proxy=None):
     
     try:
         logger.debug(f"Getting VOD categories for MAC {mac}")
-        session = _get_proxy_session(proxy)
+        session = _get_proxy_session(proxy, url=url)
         request_proxies = None if proxy_type == 'shadowsocks' else proxies
         response = session.get(
             url,
@@ -950,7 +1348,7 @@ def getSeriesCategories(url, mac, token, proxy=None):
     """
     proxies = parse_proxy_url(proxy) if proxy else None
     proxy_type = get_proxy_type(proxy) if proxy else 'none'
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -964,7 +1362,7 @@ def getSeriesCategories(url, mac, token, proxy=None):
     
     try:
         logger.debug(f"Getting Series categories for MAC {mac}")
-        session = _get_proxy_session(proxy)
+        session = _get_proxy_session(proxy, url=url)
         request_proxies = None if proxy_type == 'shadowsocks' else proxies
         response = session.get(
             url,
@@ -993,7 +1391,7 @@ def getVodItems(url, mac, token, category_id, page=1, proxy=None):
     Based on macvod.py implementation.
     """
     proxies = {"http": proxy, "https": proxy} if proxy else None
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -1025,7 +1423,7 @@ def getVodItems(url, mac, token, category_id, page=1, proxy=None):
     try:
         logger.info(f"Getting VOD items for category {category_id}, page {page}, MAC {mac[:15]}...")
         
-        response = _get_session().get(
+        response = _get_session(url=url).get(
             url,
             params=params,
             cookies=cookies,
@@ -1123,7 +1521,7 @@ def getSeriesItems(url, mac, token, category_id, page=1, proxy=None):
     Based on macvod.py implementation pattern.
     """
     proxies = {"http": proxy, "https": proxy} if proxy else None
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -1153,7 +1551,7 @@ def getSeriesItems(url, mac, token, category_id, page=1, proxy=None):
     try:
         logger.info(f"Getting Series items for category {category_id}, page {page}, MAC {mac[:15]}...")
         
-        response = _get_session().get(
+        response = _get_session(url=url).get(
             url,
             params=params,
             cookies=cookies,
@@ -1253,7 +1651,7 @@ def getSeriesInfo(url, mac, token, series_id, proxy=None, category_id="*"):
     from urllib.parse import quote
     
     proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -1282,7 +1680,7 @@ def getSeriesInfo(url, mac, token, series_id, proxy=None, category_id="*"):
     
     try:
         logger.info(f"Getting Series info for series {series_id}, category {category_id}")
-        response = _get_session().get(
+        response = _get_session(url=url).get(
             url,
             params=params,
             cookies=cookies,
@@ -1327,7 +1725,7 @@ def getVodLink(url, mac, token, cmd, proxy=None):
     from urllib.parse import quote
     
     proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -1346,7 +1744,7 @@ def getVodLink(url, mac, token, cmd, proxy=None):
     
     try:
         logger.debug(f"Getting VOD link for cmd: {cmd[:50]}...")
-        response = _get_session().get(
+        response = _get_session(url=url).get(
             url,
             params=params,
             cookies=cookies,
@@ -1378,7 +1776,7 @@ def getSeriesLink(url, mac, token, cmd, episode_num, season_id=None, episode_id=
     from urllib.parse import quote
     
     proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+    cookies = _mac_cookies(url, mac, {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"})
     headers = {
         "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
         "Authorization": "Bearer " + token,
@@ -1398,7 +1796,7 @@ def getSeriesLink(url, mac, token, cmd, episode_num, season_id=None, episode_id=
     
     try:
         logger.info(f"Getting Series link for episode {episode_num} (S{season_id}E{episode_id}) - series param: {episode_num}")
-        response = _get_session().get(
+        response = _get_session(url=url).get(
             url,
             params=params,
             cookies=cookies,
@@ -1447,7 +1845,7 @@ def testStreamLink(link, proxy=None, timeout=5):
         logger.debug(f"Testing stream link: {link[:80]}...")
         
         # Try HEAD request first (faster)
-        response = _get_session().head(
+        response = _get_session(url=link).head(
             link,
             headers=headers,
             proxies=proxies,
@@ -1461,7 +1859,7 @@ def testStreamLink(link, proxy=None, timeout=5):
         
         # If HEAD fails, try GET with range header (some servers don't support HEAD)
         headers["Range"] = "bytes=0-1024"
-        response = _get_session().get(
+        response = _get_session(url=link).get(
             link,
             headers=headers,
             proxies=proxies,
@@ -1477,6 +1875,8 @@ def testStreamLink(link, proxy=None, timeout=5):
                 logger.info(f"Stream link test passed (GET): {link[:50]}...")
                 return True
         
+        if response.status_code in _LINK_REJECT_STATUS:
+            invalidateLink(link, response.status_code)
         logger.warning(f"Stream link test failed with status {response.status_code}: {link[:50]}...")
         return False
         
@@ -1573,20 +1973,18 @@ def checkMacStatus(url, mac, proxy=None):
     - success: whether check was successful
     """
     try:
-        # Clear session to ensure clean state and avoid cookie pollution from previous MACs
-        clear_session()
-        
-        # Get token first
-        token = getToken(url, mac, proxy)
-        if not token:
+        # Fresh handshake (token + profile) - stored for reuse by the session store
+        entry, _ = _get_session_entry(url, mac, proxy, force=True)
+        if not entry:
             return {
                 'success': False,
                 'mac': mac,
                 'error': 'Failed to get authentication token'
             }
+        token = entry['token']
         
-        # Get profile information (contains watchdog_timeout)
-        profile = getProfile(url, mac, token, proxy)
+        # Profile information (contains watchdog_timeout)
+        profile = entry['profile']
         if not profile:
             return {
                 'success': False,
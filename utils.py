@@ -455,230 +455,446 @@ def get_supported_shadowsocks_method(requested_method):
     return 'aes-256-cfb'
 
 
-def create_shadowsocks_session(ss_config):
+def _apply_shadowsocks_compat():
+    """Apply Shadowsocks compatibility fix for Python 3.10+."""
+    try:
+        from shadowsocks_fix import apply_shadowsocks_fix
+        apply_shadowsocks_fix()
+    except ImportError:
+        # Fallback: apply fix inline
+        import sys
+        if sys.version_info >= (3, 10):
+            import collections.abc
+            import collections
+            if not hasattr(collections, 'MutableMapping'):
+                collections.MutableMapping = collections.abc.MutableMapping
+            if not hasattr(collections, 'Mapping'):
+                collections.Mapping = collections.abc.Mapping
+            if not hasattr(collections, 'Iterable'):
+                collections.Iterable = collections.abc.Iterable
+
+
+class _ShadowsocksLocalHandle:
+    """In-process shadowsocks local client (SOCKS5 on 127.0.0.1:local_port)."""
+    
+    def __init__(self, config):
+        _apply_shadowsocks_compat()
+        
+        from shadowsocks import asyncdns, eventloop, tcprelay, shell
+        from shadowsocks.common import to_bytes, to_str
+        import threading
+        
+        # Same normalisation as shell.get_config (skipped here): the ciphers
+        # hash the password, so it has to be bytes
+        config = dict(config)
+        config['password'] = to_bytes(config.get('password') or b'')
+        config['method'] = to_str(config.get('method') or 'aes-256-cfb')
+        config['server'] = to_str(config['server'])
+        config['server_port'] = int(config.get('server_port', 8388))
+        config['local_address'] = to_str(config.get('local_address', '127.0.0.1'))
+        config['local_port'] = int(config.get('local_port', 1080))
+        config['timeout'] = int(config.get('timeout', 300))
+        config.setdefault('port_password', None)
+        config.setdefault('fast_open', False)
+        config.setdefault('workers', 1)
+        config.setdefault('verbose', False)
+        config.setdefault('one_time_auth', False)
+        config.setdefault('prefer_ipv6', False)
+        try:
+            shell.check_config(config, True)
+        except SystemExit:
+            # check_config exits the process on bad configs (e.g. no password)
+            raise ValueError("Invalid Shadowsocks config (missing password or unsupported method)")
+        
+        self._dns_resolver = asyncdns.DNSResolver()
+        # Binds the local port immediately, so startup errors surface here
+        self._tcp_server = tcprelay.TCPRelay(config, self._dns_resolver, True)
+        self._loop = eventloop.EventLoop()
+        self._dns_resolver.add_to_loop(self._loop)
+        self._tcp_server.add_to_loop(self._loop)
+        
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"ss-local-{config['local_port']}",
+            daemon=True,
+        )
+        self._thread.start()
+    
+    def _run(self):
+        try:
+            self._loop.run()
+        except Exception as e:
+            logger.error(f"Shadowsocks local client error: {e}")
+    
+    def is_alive(self):
+        return self._thread.is_alive()
+    
+    def stop(self):
+        self._loop.stop()
+        try:
+            # Release the listening port right away so a restart can rebind it
+            self._tcp_server.close(next_tick=False)
+        except Exception:
+            pass
+        try:
+            self._dns_resolver.close()
+        except Exception:
+            pass
+
+
+def start_shadowsocks_local(config):
     """
-    Create a requests session configured to use Shadowsocks proxy.
+    Default tunnel launcher: start a shadowsocks local client in-process.
     
     Args:
-        ss_config (dict): Shadowsocks configuration with server, port, method, password
+        config (dict): shadowsocks local config (server, server_port, local_address,
+            local_port, password, method, timeout)
         
     Returns:
-        requests.Session: Configured session or None if failed
+        Handle with is_alive() and stop()
     """
-    try:
-        # Apply Shadowsocks compatibility fix for Python 3.10+
-        try:
-            from shadowsocks_fix import apply_shadowsocks_fix
-            apply_shadowsocks_fix()
-        except ImportError:
-            # Fallback: apply fix inline
-            import sys
-            if sys.version_info >= (3, 10):
-                import collections.abc
-                import collections
-                if not hasattr(collections, 'MutableMapping'):
-                    collections.MutableMapping = collections.abc.MutableMapping
-                if not hasattr(collections, 'Mapping'):
-                    collections.Mapping = collections.abc.Mapping
-                if not hasattr(collections, 'Iterable'):
-                    collections.Iterable = collections.abc.Iterable
-        
-        import shadowsocks.local
+    return _ShadowsocksLocalHandle(config)
+
+
+class ShadowsocksTunnelManager:
+    """
+    Long-lived Shadowsocks tunnels, one local SOCKS5 endpoint per distinct config.
+    
+    Tunnels are started on first use and reused by every later request. A
+    background thread health-checks each tunnel (launcher alive, local SOCKS5
+    greeting) and restarts it on the same local port on failure, so sessions
+    handed out earlier keep working.
+    
+    The launcher is injectable: any callable taking a shadowsocks local config
+    dict and returning an object with is_alive() and stop() works, e.g. a local
+    SOCKS5/Shadowsocks stand-in for testing.
+    """
+    
+    def __init__(self, launcher=None, health_interval=30, start_timeout=6, check_upstream=True):
         import threading
-        import time
-        import socket
-        import requests
         
-        # Check and adjust encryption method if needed
-        original_method = ss_config['method']
-        adjusted_method = get_supported_shadowsocks_method(original_method)
-        
-        if adjusted_method != original_method:
-            logger.warning(f"Shadowsocks method '{original_method}' not supported, using '{adjusted_method}' instead")
-        
-        logger.info(f"Creating Shadowsocks session for {ss_config['server']}:{ss_config['port']} using {adjusted_method}")
-        
-        # Find available local port for SOCKS proxy
+        self._launcher = launcher or start_shadowsocks_local
+        self.health_interval = health_interval
+        self.start_timeout = start_timeout
+        self.check_upstream = check_upstream
+        self._tunnels = {}  # (server, port, method, password) -> tunnel dict
+        self._lock = threading.Lock()
+        self._start_locks = {}
+        self._health_thread = None
+        self._stop_event = threading.Event()
+        self.stats = {"starts": 0, "reuses": 0, "restarts": 0, "failures": 0}
+    
+    @staticmethod
+    def _key(ss_config):
+        return (ss_config['server'], int(ss_config['port']), ss_config['method'], ss_config['password'])
+    
+    @staticmethod
+    def _free_port():
+        import socket
         sock = socket.socket()
-        sock.bind(('', 0))
-        local_port = sock.getsockname()[1]
-        sock.close()
-        
-        # Configure Shadowsocks local client with improved settings
-        config = {
-            'server': ss_config['server'],
-            'server_port': ss_config['port'],
-            'local_address': '127.0.0.1',
-            'local_port': local_port,
-            'password': ss_config['password'],
-            'method': adjusted_method,  # Use the adjusted/supported method
-            'timeout': 30,  # Shorter timeout for faster failure detection
-            'fast_open': False,
-            'workers': 1,
-            'verbose': True  # Enable verbose logging for debugging
-        }
-        
-        logger.debug(f"Shadowsocks config: server={config['server']}:{config['server_port']}, method={config['method']}, local_port={local_port}")
-        
-        # Test server connectivity first
-        logger.debug(f"Testing connectivity to Shadowsocks server {ss_config['server']}:{ss_config['port']}")
-        test_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        test_sock.settimeout(10)
         try:
-            result = test_sock.connect_ex((ss_config['server'], ss_config['port']))
-            if result != 0:
-                logger.error(f"Cannot connect to Shadowsocks server {ss_config['server']}:{ss_config['port']} - connection refused (error {result})")
-                logger.error("This could indicate:")
-                logger.error("1. Server is down or unreachable")
-                logger.error("2. Port is blocked by firewall")
-                logger.error("3. Incorrect server address or port")
-                logger.error("4. Network connectivity issues")
-                return None
-            else:
-                logger.debug(f"Successfully connected to Shadowsocks server {ss_config['server']}:{ss_config['port']}")
-        except Exception as e:
-            logger.error(f"Failed to test Shadowsocks server connectivity: {e}")
-            return None
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
         finally:
-            test_sock.close()
-        
-        # Start Shadowsocks local client in background thread
-        ss_error = []  # Capture errors from thread
-        
-        def run_ss_local():
-            try:
-                logger.debug("Starting Shadowsocks local client thread")
-                
-                # Alternative approach: Use shadowsocks programmatically
-                import sys
-                import os
-                import tempfile
-                import json
-                
-                # Create temporary config file
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-                    json.dump(config, f)
-                    config_file = f.name
-                
-                try:
-                    # Set sys.argv for shadowsocks (it reads from sys.argv)
-                    original_argv = sys.argv.copy()
-                    sys.argv = ['shadowsocks', '-c', config_file]
-                    
-                    # Call main without arguments (it reads from sys.argv)
-                    shadowsocks.local.main()
-                    
-                finally:
-                    # Restore original argv and cleanup
-                    sys.argv = original_argv
-                    try:
-                        os.unlink(config_file)
-                    except:
-                        pass
-                        
-            except Exception as e:
-                error_msg = f"Shadowsocks local client error: {e}"
-                logger.error(error_msg)
-                ss_error.append(error_msg)
-        
-        ss_thread = threading.Thread(target=run_ss_local, daemon=True)
-        ss_thread.start()
+            sock.close()
+    
+    @staticmethod
+    def _socks_ready(port, timeout=2):
+        """Check the local endpoint answers a SOCKS5 no-auth greeting."""
+        import socket
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+                sock.sendall(b'\x05\x01\x00')
+                return sock.recv(2) == b'\x05\x00'
+        except OSError:
+            return False
+    
+    @staticmethod
+    def _upstream_reachable(server, port, timeout=5):
+        import socket
+        try:
+            with socket.create_connection((server, port), timeout=timeout):
+                return True
+        except OSError:
+            return False
+    
+    def _launch(self, tunnel):
+        """Start the local client for a tunnel and wait until it answers."""
+        import time
         
-        # Wait for local client to start and test multiple times
-        max_attempts = 6
-        for attempt in range(max_attempts):
-            time.sleep(1)  # Wait 1 second between attempts
-            
-            # Check if thread had errors
-            if ss_error:
-                logger.error(f"Shadowsocks thread failed: {ss_error[0]}")
-                return None
-            
-            # Test if local SOCKS5 proxy is working
-            test_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            test_sock.settimeout(2)
+        tunnel['handle'] = self._launcher(tunnel['config'])
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            if self._socks_ready(tunnel['local_port'], timeout=1):
+                tunnel['healthy'] = True
+                tunnel['started'] = time.time()
+                return True
+            if not tunnel['handle'].is_alive():
+                break
+            time.sleep(0.05)
+        
+        self._stop_handle(tunnel)
+        tunnel['healthy'] = False
+        return False
+    
+    @staticmethod
+    def _stop_handle(tunnel):
+        handle = tunnel.get('handle')
+        tunnel['handle'] = None
+        if handle:
             try:
-                result = test_sock.connect_ex(('127.0.0.1', local_port))
-                if result == 0:
-                    logger.debug(f"Shadowsocks local proxy responding on port {local_port} (attempt {attempt + 1})")
-                    break
-                else:
-                    logger.debug(f"Shadowsocks local proxy not ready on port {local_port} (attempt {attempt + 1}/{max_attempts})")
+                handle.stop()
             except Exception as e:
-                logger.debug(f"Test connection failed (attempt {attempt + 1}): {e}")
-            finally:
-                test_sock.close()
-            
-            if attempt == max_attempts - 1:
-                logger.error(f"Shadowsocks local proxy failed to start on port {local_port} after {max_attempts} attempts")
-                logger.error("This could indicate:")
-                logger.error("1. Incorrect Shadowsocks server credentials")
-                logger.error("2. Unsupported encryption method")
-                logger.error("3. Server-side authentication failure")
-                logger.error("4. Network issues preventing local proxy startup")
-                return None
+                logger.debug(f"Error stopping Shadowsocks tunnel: {e}")
+    
+    @staticmethod
+    def _create_session(local_port):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
         
-        # Create session with SOCKS5 proxy pointing to local Shadowsocks client
         session = requests.Session()
         session.proxies = {
             'http': f'socks5://127.0.0.1:{local_port}',
             'https': f'socks5://127.0.0.1:{local_port}'
         }
         
-        # Set reasonable timeouts and retries
-        from requests.adapters import HTTPAdapter
-        from urllib3.util.retry import Retry
-        
         retry_strategy = Retry(
             total=3,
             backoff_factor=1,
             status_forcelist=[429, 500, 502, 503, 504],
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = HTTPAdapter(pool_maxsize=32, max_retries=retry_strategy)
         session.mount("http://", adapter)
         session.mount("https://", adapter)
+        return session
+    
+    def _start_lock(self, key):
+        import threading
+        with self._lock:
+            lock = self._start_locks.get(key)
+            if lock is None:
+                lock = self._start_locks[key] = threading.Lock()
+            return lock
+    
+    def get_session(self, ss_config):
+        """
+        Get the shared session for a Shadowsocks config, starting the tunnel if needed.
+        
+        Args:
+            ss_config (dict): Shadowsocks configuration with server, port, method, password
+            
+        Returns:
+            requests.Session: Session proxied through the local tunnel, or None if it could not start
+        """
+        key = self._key(ss_config)
+        
+        with self._lock:
+            tunnel = self._tunnels.get(key)
+            if tunnel and tunnel['healthy']:
+                self.stats["reuses"] += 1
+                return tunnel['session']
+        
+        # Only one thread starts a given tunnel; the others wait and reuse it
+        with self._start_lock(key):
+            with self._lock:
+                tunnel = self._tunnels.get(key)
+                if tunnel and tunnel['healthy']:
+                    self.stats["reuses"] += 1
+                    return tunnel['session']
+            
+            if tunnel is None:
+                original_method = ss_config['method']
+                adjusted_method = get_supported_shadowsocks_method(original_method)
+                if adjusted_method != original_method:
+                    logger.warning(f"Shadowsocks method '{original_method}' not supported, using '{adjusted_method}' instead")
+                
+                local_port = self._free_port()
+                tunnel = {
+                    'config': {
+                        'server': ss_config['server'],
+                        'server_port': int(ss_config['port']),
+                        'local_address': '127.0.0.1',
+                        'local_port': local_port,
+                        'password': ss_config['password'],
+                        'method': adjusted_method,
+                        'timeout': 30,
+                        'fast_open': False,
+                        'workers': 1,
+                    },
+                    'local_port': local_port,
+                    'session': self._create_session(local_port),
+                    'handle': None,
+                    'healthy': False,
+                    'started': None,
+                    'restarts': 0,
+                    'last_check': None,
+                    'upstream_ok': None,
+                }
+            
+            logger.info(f"Starting Shadowsocks tunnel to {ss_config['server']}:{ss_config['port']} on local port {tunnel['local_port']}")
+            try:
+                started = self._launch(tunnel)
+            except Exception as e:
+                _log_shadowsocks_error(e, ss_config)
+                started = False
+            
+            if not started:
+                self.stats["failures"] += 1
+                logger.error(f"Shadowsocks tunnel to {ss_config['server']}:{ss_config['port']} failed to start")
+                return None
+            
+            with self._lock:
+                self._tunnels[key] = tunnel
+                self.stats["starts"] += 1
+            self._ensure_health_thread()
+            return tunnel['session']
+    
+    def _ensure_health_thread(self):
+        import threading
+        with self._lock:
+            if self._health_thread and self._health_thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._health_thread = threading.Thread(
+                target=self._health_loop, name="ss-tunnel-health", daemon=True
+            )
+            self._health_thread.start()
+    
+    def _health_loop(self):
+        while not self._stop_event.wait(self.health_interval):
+            self.check_tunnels()
+    
+    def check_tunnels(self):
+        """Health-check all tunnels once and restart the broken ones."""
+        import time
         
-        # Test the session with a simple request
+        with self._lock:
+            tunnels = list(self._tunnels.items())
+        
+        for key, tunnel in tunnels:
+            with self._start_lock(key):
+                handle = tunnel.get('handle')
+                ok = bool(handle and handle.is_alive()) and self._socks_ready(tunnel['local_port'])
+                tunnel['last_check'] = time.time()
+                if self.check_upstream:
+                    config = tunnel['config']
+                    tunnel['upstream_ok'] = self._upstream_reachable(config['server'], config['server_port'])
+                    if not tunnel['upstream_ok']:
+                        logger.warning(f"Shadowsocks server {config['server']}:{config['server_port']} unreachable")
+                if ok:
+                    continue
+                
+                logger.warning(f"Shadowsocks tunnel on local port {tunnel['local_port']} unhealthy - restarting")
+                tunnel['healthy'] = False
+                self._stop_handle(tunnel)
+                restarted = self._relaunch(tunnel)
+                if not restarted:
+                    # Old port may be taken by now - move the tunnel (and its session) to a new one
+                    self._rebind(tunnel, self._free_port())
+                    restarted = self._relaunch(tunnel)
+                tunnel['restarts'] += 1
+                self.stats["restarts"] += 1
+                if not restarted:
+                    # Next get_session() starts a fresh tunnel
+                    self.stats["failures"] += 1
+                    with self._lock:
+                        self._tunnels.pop(key, None)
+    
+    def _relaunch(self, tunnel):
         try:
-            logger.debug("Testing Shadowsocks session with connectivity check")
-            test_response = session.get('http://httpbin.org/ip', timeout=10)
-            if test_response.status_code == 200:
-                logger.info(f"Shadowsocks session working correctly - external IP: {test_response.json().get('origin', 'unknown')}")
-            else:
-                logger.warning(f"Shadowsocks session test returned status {test_response.status_code}")
+            return self._launch(tunnel)
         except Exception as e:
-            logger.warning(f"Shadowsocks session test failed (session may still work for IPTV): {e}")
-        
-        logger.info(f"Shadowsocks session created successfully with local SOCKS5 proxy on port {local_port}")
-        return session
-        
-    except ImportError as e:
+            logger.error(f"Shadowsocks tunnel restart on port {tunnel['local_port']} failed: {e}")
+            return False
+    
+    @staticmethod
+    def _rebind(tunnel, local_port):
+        """Point a tunnel and its already handed-out session at a new local port."""
+        tunnel['local_port'] = local_port
+        tunnel['config']['local_port'] = local_port
+        tunnel['session'].proxies = {
+            'http': f'socks5://127.0.0.1:{local_port}',
+            'https': f'socks5://127.0.0.1:{local_port}'
+        }
+    
+    def stop_all(self):
+        """Stop the health checker and all tunnels."""
+        self._stop_event.set()
+        with self._lock:
+            tunnels = list(self._tunnels.values())
+            self._tunnels.clear()
+        for tunnel in tunnels:
+            self._stop_handle(tunnel)
+            try:
+                tunnel['session'].close()
+            except Exception:
+                pass
+    
+    def get_stats(self):
+        """Get tunnel statistics."""
+        with self._lock:
+            tunnels = [
+                {
+                    "server": f"{tunnel['config']['server']}:{tunnel['config']['server_port']}",
+                    "local_port": tunnel['local_port'],
+                    "healthy": tunnel['healthy'],
+                    "upstream_ok": tunnel['upstream_ok'],
+                    "restarts": tunnel['restarts'],
+                }
+                for tunnel in self._tunnels.values()
+            ]
+        return dict(self.stats, active=len(tunnels), tunnels=tunnels)
+
+
+def _log_shadowsocks_error(e, ss_config):
+    """Log a Shadowsocks startup error with hints for the common causes."""
+    if isinstance(e, ImportError):
         logger.error(f"Shadowsocks library not available: {e}")
         logger.error("Install with: pip install shadowsocks==2.8.2")
         logger.error("Note: Some systems may require: pip install shadowsocks-libev")
-        return None
-    except Exception as e:
-        error_msg = str(e)
-        if "MutableMapping" in error_msg:
-            logger.error("Shadowsocks compatibility issue detected (Python 3.10+ collections.MutableMapping)")
-            logger.error("Solutions:")
-            logger.error("1. Install compatible version: pip install shadowsocks-libev")
-            logger.error("2. Use Python 3.9 or earlier")
-            logger.error("3. Use SOCKS5 proxy instead of Shadowsocks")
-        elif "method" in error_msg and "not supported" in error_msg:
-            logger.error("Shadowsocks encryption method not supported")
-            logger.error(f"Requested method: {ss_config.get('method', 'unknown')}")
-            logger.error("Supported methods: aes-256-cfb, aes-192-cfb, aes-128-cfb, chacha20, salsa20")
-            logger.error("Solutions:")
-            logger.error("1. Change server to use aes-256-cfb instead of aes-256-gcm")
-            logger.error("2. Use SOCKS5 proxy: socks5://server:port")
-            logger.error("3. Use Gluetun for method conversion")
-        else:
-            logger.error(f"Failed to create Shadowsocks session: {e}")
-            logger.error("Check your Shadowsocks configuration:")
-            logger.error(f"- Server: {ss_config.get('server', 'unknown')}")
-            logger.error(f"- Port: {ss_config.get('port', 'unknown')}")
-            logger.error(f"- Method: {ss_config.get('method', 'unknown')}")
-            logger.error("- Ensure server is running and accessible")
-            logger.error("- Verify credentials are correct")
-        return None
\ No newline at end of file
+        return
+    
+    error_msg = str(e)
+    if "MutableMapping" in error_msg:
+        logger.error("Shadowsocks compatibility issue detected (Python 3.10+ collections.MutableMapping)")
+        logger.error("Solutions:")
+        logger.error("1. Install compatible version: pip install shadowsocks-libev")
+        logger.error("2. Use Python 3.9 or earlier")
+        logger.error("3. Use SOCKS5 proxy instead of Shadowsocks")
+    elif "method" in error_msg and "not supported" in error_msg:
+        logger.error("Shadowsocks encryption method not supported")
+        logger.error(f"Requested method: {ss_config.get('method', 'unknown')}")
+        logger.error("Supported methods: aes-256-cfb, aes-192-cfb, aes-128-cfb, chacha20, salsa20")
+        logger.error("Solutions:")
+        logger.error("1. Change server to use aes-256-cfb instead of aes-256-gcm")
+        logger.error("2. Use SOCKS5 proxy: socks5://server:port")
+        logger.error("3. Use Gluetun for method conversion")
+    else:
+        logger.error(f"Failed to create Shadowsocks session: {e}")
+        logger.error("Check your Shadowsocks configuration:")
+        logger.error(f"- Server: {ss_config.get('server', 'unknown')}")
+        logger.error(f"- Port: {ss_config.get('port', 'unknown')}")
+        logger.error(f"- Method: {ss_config.get('method', 'unknown')}")
+        logger.error("- Ensure server is running and accessible")
+        logger.error("- Verify credentials are correct")
+
+
+# Shared tunnel manager used by create_shadowsocks_session()
+shadowsocks_tunnels = ShadowsocksTunnelManager()
+
+
+def create_shadowsocks_session(ss_config):
+    """
+    Get a requests session configured to use Shadowsocks proxy.
+    
+    The session is bound to a long-lived local tunnel managed by
+    shadowsocks_tunnels, so repeated calls for the same config are cheap.
+    
+    Args:
+        ss_config (dict): Shadowsocks configuration with server, port, method, password
+        
+    Returns:
+        requests.Session: Configured session or None if failed
+    """
+    return shadowsocks_tunnels.get_session(ss_config)